@@ -3,14 +3,15 @@
 """Aux module to calculate differences between sites when accepting or rejecting cookies
    Relies on a yaml configuration file created for browser cookie analysis automation"""
 import os
+import sys
 import json
 import logging
-import yaml
 from collections import Counter
 
 # from PIL import Image
 CWD = os.path.dirname(__file__)
-CONFIG_PATH = os.path.join(CWD, "..", "config")
+sys.path.append(os.path.join(os.path.abspath(CWD), ".."))
+from triki_config import iter_sites  # noqa: E402
 
 LOG = logging.getLogger()
 
@@ -33,16 +34,10 @@ def _set_logging():
 
 def _config():
     """
-    read sites configuration and accept and reject flows for cookie extraction
+    read sites configuration and accept and reject flows for cookie extraction,
+    sites are parsed lazily through the cached loader of triki
     """
-    config = None
-    try:
-        with open("%s/sites.yaml" % CONFIG_PATH, "r", encoding="utf8") as f:
-            config = yaml.load(f, Loader=yaml.FullLoader)
-    except Exception as e:
-        LOG.error("Could not load triki configuration: %s", e)
-        raise e
-    return config
+    return {"sites": iter_sites()}
 
 
 def clean_incomplete_flows(d):
@@ -3,8 +3,13 @@
 
 import os
 import argparse
+import calendar
+import hashlib
+import json
 import logging
 import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from shutil import rmtree
 from sqlite3 import Error
 import csv
@@ -61,53 +66,848 @@ QUERY_CREATE_STATS_TABLE = """CREATE TABLE IF NOT EXISTS stats (
 
                             ); """
 
+QUERY_CREATE_MANIFEST_TABLE = """CREATE TABLE IF NOT EXISTS imported_files (
+                                path VARCHAR(1024) PRIMARY KEY NOT NULL,
+                                size INTEGER NOT NULL,
+                                mtime INTEGER NOT NULL,
+                                hash VARCHAR(40) NOT NULL,
+                                imported_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+                            ); """
+
+# ROLLUPS, aggregates maintained on import for dashboard queries
+QUERY_CREATE_ROLLUP_FLOW_TABLE = """CREATE TABLE IF NOT EXISTS rollup_site_date_flow (
+                                url varchar(255) NOT NULL,
+                                date DATETIME NOT NULL,
+                                flow VARCHAR(15) NOT NULL,
+                                block_third_party BOOLEAN NOT NULL,
+
+                                cookies INTEGER NOT NULL,
+                                hosts INTEGER NOT NULL,
+                                persistent INTEGER NOT NULL,
+                                secure INTEGER NOT NULL,
+                                httponly INTEGER NOT NULL,
+                                samesite_none INTEGER NOT NULL,
+                                samesite_lax INTEGER NOT NULL,
+                                samesite_strict INTEGER NOT NULL,
+
+                                PRIMARY KEY (url, date, flow, block_third_party)
+                            ); """
+
+QUERY_CREATE_ROLLUP_HOST_TABLE = """CREATE TABLE IF NOT EXISTS rollup_host_date (
+                                host VARCHAR(255) NOT NULL,
+                                date DATETIME NOT NULL,
+
+                                cookies INTEGER NOT NULL,
+                                site_flows INTEGER NOT NULL,
+                                persistent INTEGER NOT NULL,
+                                secure INTEGER NOT NULL,
+                                httponly INTEGER NOT NULL,
+                                samesite_none INTEGER NOT NULL,
+                                samesite_lax INTEGER NOT NULL,
+                                samesite_strict INTEGER NOT NULL,
+
+                                PRIMARY KEY (host, date)
+                            ); """
+
+# INDEXES, for the usual access patterns: flows of a url and date,
+# cookies of a host and trends over dates
+QUERY_CREATE_COOKIES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_cookies_flow ON cookies (url, date, flow, block_third_party)",
+    "CREATE INDEX IF NOT EXISTS idx_cookies_host_date ON cookies (host, date)",
+    "CREATE INDEX IF NOT EXISTS idx_cookies_date ON cookies (date)",
+]
+QUERY_CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_stats_url_date ON stats (url, date)",
+    "CREATE INDEX IF NOT EXISTS idx_rollup_flow_date ON rollup_site_date_flow (date)",
+    "CREATE INDEX IF NOT EXISTS idx_rollup_host_date_date ON rollup_host_date (date)",
+]
+
+# Aggregates over the cookies of the flows matching the WHERE clause
+ROLLUP_COLUMNS = """count(*), coalesce(sum(is_persistent), 0), coalesce(sum(is_secure), 0),
+                    coalesce(sum(is_httponly), 0), coalesce(sum(samesite = -1), 0),
+                    coalesce(sum(samesite = 0), 0), coalesce(sum(samesite = 1), 0)"""
+QUERY_ROLLUP_FLOW = """INSERT OR REPLACE INTO rollup_site_date_flow(url, date, flow, block_third_party,
+                           cookies, persistent, secure, httponly, samesite_none, samesite_lax, samesite_strict, hosts)
+                       SELECT ?1, ?2, ?3, ?4, %s, count(DISTINCT host) FROM cookies
+                       WHERE url = ?1 AND date = ?2 AND flow = ?3 AND block_third_party = ?4""" % ROLLUP_COLUMNS
+# ?5 is 1 to add the cookies of a flow and -1 to subtract them
+QUERY_ROLLUP_HOST = """INSERT INTO rollup_host_date(host, date,
+                           cookies, persistent, secure, httponly, samesite_none, samesite_lax, samesite_strict, site_flows)
+                       SELECT host, date, %s, 1 FROM cookies
+                       WHERE url = ?1 AND date = ?2 AND flow = ?3 AND block_third_party = ?4
+                       GROUP BY host
+                       ON CONFLICT (host, date) DO UPDATE SET
+                           cookies = cookies + ?5 * excluded.cookies,
+                           persistent = persistent + ?5 * excluded.persistent,
+                           secure = secure + ?5 * excluded.secure,
+                           httponly = httponly + ?5 * excluded.httponly,
+                           samesite_none = samesite_none + ?5 * excluded.samesite_none,
+                           samesite_lax = samesite_lax + ?5 * excluded.samesite_lax,
+                           samesite_strict = samesite_strict + ?5 * excluded.samesite_strict,
+                           site_flows = site_flows + ?5 * excluded.site_flows""" % ROLLUP_COLUMNS
+QUERY_ROLLUP_HOST_CLEAN = "DELETE FROM rollup_host_date WHERE site_flows <= 0"
+# Backfill of the rollups from existing data
+QUERY_BACKFILL_ROLLUP_FLOW = """INSERT OR REPLACE INTO rollup_site_date_flow(url, date, flow, block_third_party,
+                                    cookies, persistent, secure, httponly, samesite_none, samesite_lax, samesite_strict, hosts)
+                                SELECT url, date, flow, block_third_party, %s, count(DISTINCT host) FROM cookies
+                                GROUP BY url, date, flow, block_third_party""" % ROLLUP_COLUMNS
+QUERY_BACKFILL_ROLLUP_HOST = """INSERT OR REPLACE INTO rollup_host_date(host, date,
+                                    cookies, persistent, secure, httponly, samesite_none, samesite_lax, samesite_strict, site_flows)
+                                SELECT host, date, %s, count(DISTINCT url || '|' || flow || '|' || block_third_party) FROM cookies
+                                GROUP BY host, date""" % ROLLUP_COLUMNS
+
 # INSERTS (Querys and Values)
 # Querys
 QUERY_INSERT_TABLE_COOKIES = "INSERT INTO cookies(url, date, flow, block_third_party, host, name, value, path, expires_utc, is_secure, is_httponly, has_expires, is_persistent, priority, samesite, source_scheme) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 QUERY_INSERT_TABLE_STATS = "INSERT INTO stats(url, date, flow, block_third_party, total, session, max_exp_days, avg_exp_days, secure_flag, httponly_flag, samesite_none_flag, samesite_lax_flag, samesite_strict_flag) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+QUERY_UPSERT_MANIFEST = "INSERT OR REPLACE INTO imported_files(path, size, mtime, hash) VALUES(?, ?, ?, ?)"
 
+# DELETES, rows previously imported for a flow csv
+QUERY_DELETE_FLOW = {
+    QUERY_INSERT_TABLE_COOKIES: "DELETE FROM cookies WHERE url = ? AND date = ? AND flow = ? AND block_third_party = ?",
+    QUERY_INSERT_TABLE_STATS: "DELETE FROM stats WHERE url = ? AND date = ? AND flow = ? AND block_third_party = ?",
+}
 
-def _csv_to_db(conn_db, path, url, date, csv_dict, sql):
-    for key in csv_dict.keys():
-        csv_name = csv_dict[key]
-        csv_path = os.path.join(path, csv_name)
-        block_third_party = "third_party" in key
-        flow = key.split("_")[0]
-        attributes_rows = [url, date, flow, block_third_party]
-        values = []
-        with open(csv_path, newline='') as File:
-            reader = csv.reader(File)
-            reader = list(reader)[1:]
-            for row in reader:
-                if sql == QUERY_INSERT_TABLE_STATS:
-                    row = row[1:]
-                row = attributes_rows + row
-                values.append(tuple(row))
+
+# DELTA STORAGE
+# Delta databases keep every cookie record once, content addressed, with the
+# ranges of snapshots of each flow where it was observed. The cookies table is
+# replaced by a view rebuilding every snapshot from them.
+# Chrome cookies epoch, as in triki.py
+CHROME_EPOCH_OFFSET = 11644473600
+MICROSECONDS_PER_DAY = 86400 * 1000000
+QUERY_CREATE_RECORDS_TABLE = """CREATE TABLE IF NOT EXISTS cookie_records (
+                                id INTEGER PRIMARY KEY NOT NULL,
+
+                                host VARCHAR(255) NOT NULL,
+                                name VARCHAR(255) NOT NULL,
+                                value VARCHAR(255),
+                                path VARCHAR(255) NOT NULL,
+                                expires_utc INTEGER,
+                                lifetime_days INTEGER,
+                                is_secure BOOLEAN NOT NULL,
+                                is_httponly BOOLEAN NOT NULL,
+                                has_expires BOOLEAN NOT NULL,
+                                is_persistent BOOLEAN NOT NULL,
+                                priority BOOLEAN NOT NULL,
+                                samesite BOOLEAN NOT NULL,
+                                source_scheme integer NOT NULL
+                            ); """
+
+QUERY_CREATE_SNAPSHOTS_TABLE = """CREATE TABLE IF NOT EXISTS snapshots (
+                                url varchar(255) NOT NULL,
+                                date DATETIME NOT NULL,
+                                flow VARCHAR(15) NOT NULL,
+                                block_third_party BOOLEAN NOT NULL,
+
+                                PRIMARY KEY (url, flow, block_third_party, date)
+                            ); """
+
+# Part of the expiration of persistent cookies below a day, only for the
+# snapshots where it is not 0. Records keep whole days so that they are shared.
+QUERY_CREATE_EXPIRES_TABLE = """CREATE TABLE IF NOT EXISTS cookie_expires (
+                                url varchar(255) NOT NULL,
+                                date DATETIME NOT NULL,
+                                flow VARCHAR(15) NOT NULL,
+                                block_third_party BOOLEAN NOT NULL,
+
+                                record INTEGER NOT NULL,
+                                expires_offset INTEGER NOT NULL,
+                                PRIMARY KEY (url, flow, block_third_party, date, record)
+                            ) WITHOUT ROWID; """
+
+# last_date is NULL while the record is observed in the last snapshot of the flow
+QUERY_CREATE_RANGES_TABLE = """CREATE TABLE IF NOT EXISTS cookie_ranges (
+                                url varchar(255) NOT NULL,
+                                flow VARCHAR(15) NOT NULL,
+                                block_third_party BOOLEAN NOT NULL,
+
+                                record INTEGER NOT NULL,
+                                first_date DATETIME NOT NULL,
+                                last_date DATETIME
+                            ); """
+
+QUERY_CREATE_COOKIES_VIEW = """CREATE VIEW IF NOT EXISTS cookies AS
+                               SELECT s.url, s.date, s.flow, s.block_third_party,
+                                      r.host, r.name, r.value, r.path,
+                                      coalesce(r.expires_utc,
+                                               (CAST(strftime('%%s', substr(s.date, 1, 4) || '-' || substr(s.date, 5, 2) || '-' || substr(s.date, 7, 2)) AS INTEGER)
+                                                + %s) * 1000000 + r.lifetime_days * %s
+                                               + coalesce(e.expires_offset, 0)) AS expires_utc,
+                                      r.is_secure, r.is_httponly, r.has_expires, r.is_persistent,
+                                      r.priority, r.samesite, r.source_scheme
+                               FROM snapshots s
+                               JOIN cookie_ranges g ON g.url = s.url AND g.flow = s.flow
+                                                   AND g.block_third_party = s.block_third_party
+                                                   AND g.first_date <= s.date
+                                                   AND (g.last_date IS NULL OR g.last_date >= s.date)
+                               JOIN cookie_records r ON r.id = g.record
+                               LEFT JOIN cookie_expires e ON e.url = s.url AND e.date = s.date AND e.flow = s.flow
+                                                          AND e.block_third_party = s.block_third_party
+                                                          AND e.record = r.id""" % (CHROME_EPOCH_OFFSET, MICROSECONDS_PER_DAY)
+
+QUERY_CREATE_DELTA_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_ranges_flow ON cookie_ranges (url, flow, block_third_party, last_date)",
+    "CREATE INDEX IF NOT EXISTS idx_ranges_record ON cookie_ranges (record)",
+]
+
+QUERY_INSERT_SNAPSHOT = "INSERT INTO snapshots(url, date, flow, block_third_party) VALUES(?, ?, ?, ?)"
+QUERY_DELETE_SNAPSHOT = "DELETE FROM snapshots WHERE url = ? AND date = ? AND flow = ? AND block_third_party = ?"
+QUERY_INSERT_EXPIRES = "INSERT OR REPLACE INTO cookie_expires(url, date, flow, block_third_party, record, expires_offset) VALUES(?, ?, ?, ?, ?, ?)"
+QUERY_DELETE_EXPIRES = "DELETE FROM cookie_expires WHERE url = ? AND date = ? AND flow = ? AND block_third_party = ?"
+QUERY_INSERT_RECORD = "INSERT OR IGNORE INTO cookie_records(id, host, name, value, path, expires_utc, lifetime_days, is_secure, is_httponly, has_expires, is_persistent, priority, samesite, source_scheme) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+QUERY_INSERT_RANGE = "INSERT INTO cookie_ranges(url, flow, block_third_party, record, first_date, last_date) VALUES(?, ?, ?, ?, ?, ?)"
+QUERY_UPDATE_RANGE_FIRST = "UPDATE cookie_ranges SET first_date = ? WHERE rowid = ?"
+QUERY_UPDATE_RANGE_LAST = "UPDATE cookie_ranges SET last_date = ? WHERE rowid = ?"
+QUERY_DELETE_RANGE = "DELETE FROM cookie_ranges WHERE rowid = ?"
+# Date of a snapshot as stored and the dates of the snapshots before and after it
+QUERY_SNAPSHOT_NEIGHBOURS = """SELECT date,
+                                   (SELECT max(date) FROM snapshots
+                                    WHERE url = ?1 AND flow = ?3 AND block_third_party = ?4 AND date < s.date),
+                                   (SELECT min(date) FROM snapshots
+                                    WHERE url = ?1 AND flow = ?3 AND block_third_party = ?4 AND date > s.date)
+                               FROM snapshots s
+                               WHERE url = ?1 AND date = ?2 AND flow = ?3 AND block_third_party = ?4"""
+# Ranges of a flow around a snapshot (?2) between the previous (?5) and next (?6) ones,
+# the last column tells if the range spans the snapshot
+QUERY_SNAPSHOT_RANGES = """SELECT rowid, record, first_date, last_date,
+                                  first_date < ?2 AND (last_date IS NULL OR last_date > ?2)
+                           FROM cookie_ranges
+                           WHERE url = ?1 AND flow = ?3 AND block_third_party = ?4
+                                 AND (last_date IS NULL OR last_date >= coalesce(?5, ?2))
+                                 AND first_date <= coalesce(?6, ?2)"""
+# Cookies delta logs written by triki --sink delta in the site folders
+DELTA_LOG_PREFIX = "cookies_"
+DELTA_LOG_SUFFIX = ".jsonl"
+# Records written to a delta log and the cookies of its last snapshot, kept
+# next to it so that appending a line does not replay the whole log
+DELTA_STATE_SUFFIX = ".state"
+
+
+# FLOW TYPES
+# Suffixes added by triki to the flow type for the browser options of a site,
+# flows blocking resources are stored as a flow of their own
+FLOW_SUFFIXES = ["block_all", "block_third_party", "do_not_track", "block_resources"]
+FLOW_BLOCK_SUFFIXES = ["block_all", "block_third_party"]
+FLOW_OWN_SUFFIXES = ["block_resources"]
+
+# BULK LOAD
+# Rows inserted between commits and pragmas used while loading data
+TRANSACTION_ROWS = 200000
+PRAGMAS_BULK_LOAD = ["PRAGMA temp_store = MEMORY", "PRAGMA cache_size = -131072"]
+# A crash only loses a database being created, existing ones keep a journal
+PRAGMAS_BULK_LOAD_FRESH = ["PRAGMA journal_mode = MEMORY", "PRAGMA synchronous = OFF"]
+PRAGMAS_BULK_LOAD_EXISTING = ["PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL"]
+# Parsed date directories waiting to be written per worker when importing in parallel
+PENDING_DIRS_PER_WORKER = 4
+
+
+def _read_csv(csv_path, attributes_rows, sql):
+    """ stream the rows of a csv file prefixed with the flow attributes """
+    with open(csv_path, newline='') as File:
+        reader = csv.reader(File)
+        # Skip header
+        next(reader, None)
+        for row in reader:
+            if sql == QUERY_INSERT_TABLE_STATS:
+                row = row[1:]
+            yield tuple(attributes_rows + row)
+
+
+def _file_hash(path, size=None):
+    """ hash of a file or of its first size bytes """
+    sha1 = hashlib.sha1()
+    remaining = size
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20 if remaining is None else min(1 << 20, remaining)), b""):
+            sha1.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha1.hexdigest()
+
+
+def _load_manifest(conn_db):
+    """ files already imported indexed by path
+    :return: dict path -> (size, mtime, hash)
+    """
+    cur = conn_db.execute("SELECT path, size, mtime, hash FROM imported_files")
+    return {row[0]: row[1:] for row in cur}
+
+
+def _prepare_csv(csv_path, url, date, key, sql, known, parse=False):
+    """ check a csv against its manifest record and describe how to import it
+    :param known: manifest record of the csv or None if never imported
+    :param parse: read the rows now instead of streaming them when written
+    :return: None if the csv is unchanged, a dict describing the import otherwise
+    """
+    manifest_path = os.path.abspath(csv_path)
+    file_stat = os.stat(csv_path)
+    if known and tuple(known[:2]) == (file_stat.st_size, file_stat.st_mtime_ns):
+        return None
+    file_hash = _file_hash(csv_path)
+    flow, block_third_party = _flow_key_attributes(key)
+    attributes_rows = [url, date, flow, block_third_party]
+    job = {
+        "path": manifest_path,
+        "sql": sql,
+        "attributes_rows": attributes_rows,
+        "record": (file_stat.st_size, file_stat.st_mtime_ns, file_hash),
+        "known": known,
+        "changed": not (known and known[2] == file_hash),
+        "rows": None,
+    }
+    if parse and job["changed"]:
+        job["rows"] = list(_read_csv(csv_path, attributes_rows, sql))
+    return job
+
+
+def _job_rows(job):
+    if job["rows"] is not None:
+        return job["rows"]
+    return _read_csv(job["path"], job["attributes_rows"], job["sql"])
+
+
+def _update_rollups(conn_db, attributes_rows, sign):
+    """ add (sign 1) or subtract (sign -1) the cookies of a flow to the rollups """
+    conn_db.execute(QUERY_ROLLUP_HOST, attributes_rows + [sign])
+    if sign < 0:
+        conn_db.execute(QUERY_ROLLUP_HOST_CLEAN)
+    conn_db.execute(QUERY_ROLLUP_FLOW, attributes_rows)
+
+
+def _delete_flow(conn_db, sql, attributes_rows, rollups):
+    """ delete the rows previously imported for a flow """
+    if rollups and sql == QUERY_INSERT_TABLE_COOKIES:
+        _update_rollups(conn_db, attributes_rows, -1)
+    if sql == QUERY_INSERT_TABLE_COOKIES and _is_delta_database(conn_db):
+        _delete_snapshot(conn_db, attributes_rows)
+    else:
+        conn_db.execute(QUERY_DELETE_FLOW[sql], attributes_rows)
+
+
+def _insert_flow(conn_db, sql, attributes_rows, rows):
+    """ insert the rows of a flow prefixed with its attributes, delta
+    databases store the cookies as a snapshot of the flow
+    :return: number of inserted rows
+    """
+    if sql == QUERY_INSERT_TABLE_COOKIES and _is_delta_database(conn_db):
+        return _insert_snapshot(conn_db, attributes_rows, (row[len(attributes_rows):] for row in rows))
+    return _insert_table(conn_db, sql, rows)
+
+
+def _write_csv(conn_db, job, manifest, rollups=True):
+    """ import a csv described by _prepare_csv and record it in the manifest
+    :return: number of inserted rows
+    """
+    inserted = 0
+    sql = job["sql"]
+    attributes_rows = job["attributes_rows"]
+    # Each csv file is loaded completely or not at all
+    conn_db.execute("SAVEPOINT csv_file")
+    try:
+        if not job["changed"]:
+            LOG.debug("Unchanged content: %s", job["path"])
+        else:
+            if job["known"]:
+                LOG.info("Reloading changed file: %s", job["path"])
+                _delete_flow(conn_db, sql, attributes_rows, rollups)
+            conn_db.execute("SAVEPOINT csv_rows")
             try:
-                _insert_table(conn_db, sql, values)
-            except Error as e:
-                LOG.error(e)
-                raise e
+                inserted = _insert_flow(conn_db, sql, attributes_rows, _job_rows(job))
+            except sqlite3.IntegrityError:
+                # Imported before the manifest existed, replace the rows
+                conn_db.execute("ROLLBACK TO csv_rows")
+                _delete_flow(conn_db, sql, attributes_rows, rollups)
+                inserted = _insert_flow(conn_db, sql, attributes_rows, _job_rows(job))
+            conn_db.execute("RELEASE csv_rows")
+            if rollups and sql == QUERY_INSERT_TABLE_COOKIES:
+                _update_rollups(conn_db, attributes_rows, 1)
+        conn_db.execute(QUERY_UPSERT_MANIFEST, (job["path"],) + job["record"])
+    except Error as e:
+        conn_db.execute("ROLLBACK TO csv_file")
+        conn_db.execute("RELEASE csv_file")
+        LOG.error(e)
+        raise e
+    conn_db.execute("RELEASE csv_file")
+    manifest[job["path"]] = job["record"]
+    return inserted
+
 
+def _csv_to_db(conn_db, path, url, date, csv_dict, sql, manifest, rollups):
+    inserted = 0
+    for key in csv_dict.keys():
+        csv_path = os.path.join(path, csv_dict[key])
+        job = _prepare_csv(csv_path, url, date, key, sql, manifest.get(os.path.abspath(csv_path)))
+        if job:
+            inserted += _write_csv(conn_db, job, manifest, rollups)
+    return inserted
 
-def _save_csv_to_db(conn_db, site_dict):
+
+def _save_csv_to_db(conn_db, site_dict, manifest, rollups):
     root_path = site_dict["root_path"]
     url = site_dict["url"]
+    inserted = 0
     for dir_name in site_dict["dates"].keys():
         cookies_dict = site_dict["dates"][dir_name]["cookies"]
         stats_dict = site_dict["dates"][dir_name]["stats"]
         path = os.path.join(root_path, dir_name)
-        _csv_to_db(conn_db, path, url, dir_name, cookies_dict, QUERY_INSERT_TABLE_COOKIES)
-        _csv_to_db(conn_db, path, url, dir_name, stats_dict, QUERY_INSERT_TABLE_STATS)
+        inserted += _csv_to_db(conn_db, path, url, dir_name, cookies_dict, QUERY_INSERT_TABLE_COOKIES, manifest, rollups)
+        inserted += _csv_to_db(conn_db, path, url, dir_name, stats_dict, QUERY_INSERT_TABLE_STATS, manifest, rollups)
+    return inserted
 
 
-def _save_to_db(conn_db, site_dict):
+def _save_to_db(conn_db, site_dict, manifest, rollups):
     url = site_dict["url"]
+    inserted = 0
     try:
-        _save_csv_to_db(conn_db, site_dict)
-        LOG.info("Insert: %s.", url)
+        inserted = _save_csv_to_db(conn_db, site_dict, manifest, rollups)
+        if inserted:
+            LOG.info("Insert: %s.", url)
     except Exception as e:
         LOG.error("Insert failed: %s (%s)", url, e)
+    return inserted
+
+
+def _parse_flow_type(flow_parts):
+    """ split the parts of a triki flow type, that may be followed by other
+    parts (hostname of a csv name), into its flow and cookie blocking
+    :return: flow, block_third_party
+    """
+    flow = flow_parts[0]
+    block_third_party = False
+    position = 1
+    matched = True
+    while matched:
+        matched = False
+        for suffix in FLOW_SUFFIXES:
+            suffix_parts = suffix.split("_")
+            if flow_parts[position:position + len(suffix_parts)] == suffix_parts:
+                position += len(suffix_parts)
+                block_third_party = block_third_party or suffix in FLOW_BLOCK_SUFFIXES
+                if suffix in FLOW_OWN_SUFFIXES:
+                    flow += "_" + suffix
+                matched = True
+                break
+    return flow, block_third_party
+
+
+def _flow_key_attributes(key):
+    """ flow and block_third_party of a flow key of _get_CSVs """
+    if key.endswith("_third_party"):
+        return key[:-len("_third_party")], True
+    return key, False
+
+
+def flow_attributes(url, date, flow_type):
+    """ url, date, flow and block_third_party columns of a triki flow type,
+    the same ones obtained from the name of its csv files
+    """
+    flow, block_third_party = _parse_flow_type(flow_type.split("_"))
+    return [url, date, flow, block_third_party]
+
+
+def save_flow(conn_db, attributes_rows, cookie_rows, stats_row, rollups=True):
+    """ store the results of a flow replacing any previous results for it,
+    transactions are handled by the caller
+    :param cookie_rows: iterable of cookie values in HEADER_COOKIES order
+    :param stats_row: stats values in HEADER_STATS order without the url, or
+                      a callable returning them once cookie_rows is consumed
+    :return: number of inserted cookies
+    """
+    for sql in (QUERY_INSERT_TABLE_COOKIES, QUERY_INSERT_TABLE_STATS):
+        _delete_flow(conn_db, sql, attributes_rows, rollups)
+    inserted = _insert_flow(conn_db, QUERY_INSERT_TABLE_COOKIES, attributes_rows,
+                            (tuple(attributes_rows) + tuple(row) for row in cookie_rows))
+    if callable(stats_row):
+        stats_row = stats_row()
+    _insert_table(conn_db, QUERY_INSERT_TABLE_STATS, [tuple(attributes_rows) + tuple(stats_row)])
+    if rollups:
+        _update_rollups(conn_db, attributes_rows, 1)
+    return inserted
+
+
+def _is_delta_database(conn_db):
+    return _table_exists(conn_db, "cookie_ranges")
+
+
+def _snapshot_time(date):
+    """ chrome time of the midnight of a snapshot date (YYYYMMDD), None for
+    dates that are not days (e.g. benchmark runs)
+    """
+    try:
+        seconds = calendar.timegm(time.strptime(str(date), "%Y%m%d"))
+    except ValueError:
+        return None
+    return (seconds + CHROME_EPOCH_OFFSET) * 1000000
+
+
+def cookie_record(row, date):
+    """ content addressed record of a cookie observed in a snapshot, the
+    expiration of persistent cookies is kept as whole days from the snapshot
+    date so that a cookie renewed on every visit is the same record. The
+    rest of the expiration is returned apart to rebuild it exactly.
+    :param row: cookie values in HEADER_COOKIES order
+    :return: record id, record values in cookie_records order (without id),
+             microseconds of the expiration below a day (0 for records with
+             expires_utc)
+    """
+    host, name, value, path, expires_utc = row[:5]
+    flags = [int(flag) for flag in row[5:]]
+    expires_utc = int(expires_utc)
+    lifetime_days = None
+    offset = 0
+    snapshot_time = _snapshot_time(date)
+    # flags[3] is is_persistent
+    if flags[3] and snapshot_time is not None:
+        lifetime_days, offset = divmod(expires_utc - snapshot_time, MICROSECONDS_PER_DAY)
+        expires_utc = None
+    record = [host, name, value, path, expires_utc, lifetime_days] + flags
+    digest = hashlib.sha1(json.dumps(record).encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True), record, offset
+
+
+def record_row(record, date, offset=0):
+    """ cookie values in HEADER_COOKIES order of a record observed in a snapshot """
+    host, name, value, path, expires_utc, lifetime_days = record[:6]
+    if expires_utc is None:
+        expires_utc = _snapshot_time(date) + lifetime_days * MICROSECONDS_PER_DAY + offset
+    return [host, name, value, path, expires_utc] + list(record[6:])
+
+
+def _insert_snapshot(conn_db, attributes_rows, cookie_rows):
+    """ store the cookies of a flow as a new snapshot: only the records never
+    seen before and the ranges changed by the snapshot are written
+    :return: number of cookies of the snapshot
+    """
+    url, date, flow, block_third_party = attributes_rows
+    records, offsets = {}, {}
+    for row in cookie_rows:
+        record_id, record, offset = cookie_record(row, date)
+        records[record_id] = record
+        offsets[record_id] = offset
+    conn_db.execute(QUERY_INSERT_SNAPSHOT, attributes_rows)
+    date, previous, following = conn_db.execute(QUERY_SNAPSHOT_NEIGHBOURS, attributes_rows).fetchone()
+    conn_db.executemany(QUERY_INSERT_EXPIRES, [
+        (url, date, flow, block_third_party, record_id, offset)
+        for record_id, offset in offsets.items() if offset
+    ])
+    # Ranges reaching the last snapshot are left open
+    last_date = date if following is not None else None
+    ranges = conn_db.execute(QUERY_SNAPSHOT_RANGES,
+                             (url, date, flow, block_third_party, previous, following)).fetchall()
+    ending, starting, spanning = {}, {}, set()
+    new_ranges = []
+    for rowid, record_id, first, last, spans in ranges:
+        if spans:
+            spanning.add(record_id)
+            if record_id not in records:
+                # Observed before and after this snapshot but not in it
+                conn_db.execute(QUERY_UPDATE_RANGE_LAST, (previous, rowid))
+                if following is not None:
+                    new_ranges.append((url, flow, block_third_party, record_id, following, last))
+        elif last is not None and last == previous:
+            ending[record_id] = rowid
+        elif first == following:
+            starting[record_id] = (rowid, last)
+    conn_db.executemany(QUERY_INSERT_RECORD, [
+        [record_id] + record for record_id, record in records.items()
+        if record_id not in spanning and record_id not in ending and record_id not in starting
+    ])
+    for record_id in records:
+        if record_id in spanning:
+            continue
+        if record_id in ending and record_id in starting:
+            # The snapshot joins the ranges before and after it
+            rowid, last = starting[record_id]
+            conn_db.execute(QUERY_UPDATE_RANGE_LAST, (last, ending[record_id]))
+            conn_db.execute(QUERY_DELETE_RANGE, (rowid,))
+        elif record_id in ending:
+            conn_db.execute(QUERY_UPDATE_RANGE_LAST, (last_date, ending[record_id]))
+        elif record_id in starting:
+            conn_db.execute(QUERY_UPDATE_RANGE_FIRST, (date, starting[record_id][0]))
+        else:
+            new_ranges.append((url, flow, block_third_party, record_id, date, last_date))
+    conn_db.executemany(QUERY_INSERT_RANGE, new_ranges)
+    return len(records)
+
+
+def _delete_snapshot(conn_db, attributes_rows):
+    """ delete a snapshot of a delta database shrinking the ranges ending
+    or starting at it, records are kept
+    """
+    url, date, flow, block_third_party = attributes_rows
+    row = conn_db.execute(QUERY_SNAPSHOT_NEIGHBOURS, attributes_rows).fetchone()
+    if row is None:
+        return
+    date, previous, following = row
+    ranges = conn_db.execute(QUERY_SNAPSHOT_RANGES,
+                             (url, date, flow, block_third_party, previous, following)).fetchall()
+    for rowid, record_id, first, last, spans in ranges:
+        if first == date:
+            if last == date or following is None:
+                conn_db.execute(QUERY_DELETE_RANGE, (rowid,))
+            else:
+                conn_db.execute(QUERY_UPDATE_RANGE_FIRST, (following, rowid))
+        elif last is not None and last == date:
+            conn_db.execute(QUERY_UPDATE_RANGE_LAST, (previous, rowid))
+        elif following is None and last is not None and last == previous:
+            # The previous snapshot becomes the last one
+            conn_db.execute(QUERY_UPDATE_RANGE_LAST, (None, rowid))
+    conn_db.execute(QUERY_DELETE_EXPIRES, (url, date, flow, block_third_party))
+    conn_db.execute(QUERY_DELETE_SNAPSHOT, (url, date, flow, block_third_party))
+
+
+def _replay_delta_log(lines):
+    """ replay the lines of a cookies delta log
+    :return: iterator of (snapshot, records, keys) for every line, with the
+             records written so far and the keys of the cookies of the snapshot
+             mapped to their expiration offset (see cookie_record), both are
+             updated in place by the next line
+    """
+    records = {}
+    keys = {}
+    for line in lines:
+        if not line.endswith(b"\n" if isinstance(line, bytes) else "\n"):
+            # Last line of a flow killed while appending, see append_delta_log
+            LOG.warning("Skipping partial line of delta log: %.80r", line)
+            break
+        snapshot = json.loads(line)
+        records.update(snapshot["records"])
+        for key in snapshot["removed"]:
+            del keys[key]
+        keys.update(dict.fromkeys(snapshot["added"], 0))
+        # Only the offsets changed since the previous line are written
+        keys.update(snapshot.get("offsets", {}))
+        yield snapshot, records, keys
+
+
+def read_delta_log(lines):
+    """ snapshots of a cookies delta log written by triki --sink delta
+    :return: iterator of (snapshot, cookie rows in HEADER_COOKIES order)
+    """
+    for snapshot, records, keys in _replay_delta_log(lines):
+        yield snapshot, [record_row(records[key], snapshot["date"], offset) for key, offset in keys.items()]
+
+
+def _delta_log_state(path):
+    """ ids of the records written to a cookies delta log and the keys and
+    expiration offsets of its last snapshot. They are read from the state file
+    next to the log, the log is replayed if it does not match the log size.
+    """
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    try:
+        with open(path + DELTA_STATE_SUFFIX) as f:
+            state = json.load(f)
+        if state["size"] == size:
+            return set(state["records"]), state["keys"]
+    except (OSError, ValueError, KeyError):
+        pass
+    records, keys = {}, {}
+    if size:
+        LOG.info("Replaying %s to rebuild its state", path)
+        with open(path, "rb") as f:
+            for _, records, keys in _replay_delta_log(f):
+                pass
+    return set(records), keys
+
+
+def _save_delta_log_state(path, records, keys):
+    """ write the state of a cookies delta log, renamed into place """
+    tmp_path = "%s%s.%s" % (path, DELTA_STATE_SUFFIX, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"size": os.path.getsize(path), "records": sorted(records), "keys": keys}, f)
+    os.replace(tmp_path, path + DELTA_STATE_SUFFIX)
+
+
+def _truncate_partial_line(path):
+    """ drop the partial last line left in a cookies delta log by a flow
+    killed while appending, so that the next line is not appended to it
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - 4096, 0)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            LOG.warning("Truncating partial line of %s", path)
+            f.truncate(position)
+
+
+def append_delta_log(path, snapshot, cookie_rows, stats_row):
+    """ append the results of a flow to its cookies delta log, a json line
+    with the records never written to the log, the keys of the cookies
+    added and removed since its previous snapshot and the expiration offsets
+    that changed since then
+    :param snapshot: url, date, flow_type and site_url of the flow
+    :param cookie_rows: iterable of cookie values in HEADER_COOKIES order
+    :param stats_row: stats values in HEADER_STATS order without the url, or
+                      a callable returning them once cookie_rows is consumed
+    :return: number of cookies
+    """
+    _truncate_partial_line(path)
+    records, keys = _delta_log_state(path)
+    cookies, offsets = {}, {}
+    for row in cookie_rows:
+        record_id, record, offset = cookie_record(row, snapshot["date"])
+        cookies[str(record_id)] = record
+        offsets[str(record_id)] = offset
+    if callable(stats_row):
+        stats_row = stats_row()
+    line = dict(
+        snapshot,
+        stats=list(stats_row),
+        records={key: record for key, record in cookies.items() if key not in records},
+        added=[key for key in cookies if key not in keys],
+        removed=[key for key in keys if key not in cookies],
+        offsets={key: offset for key, offset in offsets.items() if keys.get(key, 0) != offset},
+    )
+    # A single write on a file opened for appending
+    with open(path, "a") as f:
+        f.write(json.dumps(line) + "\n")
+    records.update(cookies)
+    _save_delta_log_state(path, records, offsets)
+    return len(cookies)
+
+
+def _delta_logs(site_path):
+    with os.scandir(site_path) as files:
+        return [_file.name for _file in files if _file.is_file()
+                and _file.name.startswith(DELTA_LOG_PREFIX) and _file.name.endswith(DELTA_LOG_SUFFIX)]
+
+
+def _import_delta_log(conn_db, path, manifest, rollups):
+    """ import the snapshots of a cookies delta log. Logs only grow, when the
+    lines imported before are unchanged they are replayed but not written again
+    :return: number of cookies of the imported snapshots
+    """
+    manifest_path = os.path.abspath(path)
+    known = manifest.get(manifest_path)
+    file_stat = os.stat(path)
+    if known and tuple(known[:2]) == (file_stat.st_size, file_stat.st_mtime_ns):
+        return 0
+    record = (file_stat.st_size, file_stat.st_mtime_ns, _file_hash(path))
+    imported = 0
+    if known and known[0] <= file_stat.st_size and _file_hash(path, known[0]) == known[2]:
+        imported = known[0]
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    inserted = 0
+    offset = 0
+    conn_db.execute("SAVEPOINT delta_log")
+    try:
+        for line, (snapshot, records, keys) in zip(lines, _replay_delta_log(lines)):
+            offset += len(line)
+            if offset <= imported:
+                continue
+            attributes_rows = flow_attributes(snapshot["url"], snapshot["date"], snapshot["flow_type"])
+            rows = (record_row(records[key], snapshot["date"], expires_offset)
+                    for key, expires_offset in keys.items())
+            inserted += save_flow(conn_db, attributes_rows, rows, snapshot["stats"], rollups) + 1
+        conn_db.execute(QUERY_UPSERT_MANIFEST, (manifest_path,) + record)
+    except Exception as e:
+        conn_db.execute("ROLLBACK TO delta_log")
+        conn_db.execute("RELEASE delta_log")
+        LOG.error(e)
+        raise e
+    conn_db.execute("RELEASE delta_log")
+    manifest[manifest_path] = record
+    return inserted
+
+
+def _import_delta_logs(conn_db, site_path, url, manifest, rollups):
+    """ import the cookies delta logs of a site folder """
+    inserted = 0
+    try:
+        for log_name in _delta_logs(site_path):
+            inserted += _import_delta_log(conn_db, os.path.join(site_path, log_name), manifest, rollups)
+        if inserted:
+            LOG.info("Insert: %s.", url)
+    except Exception as e:
+        LOG.error("Insert failed: %s (%s)", url, e)
+    return inserted
+
+
+def _results_files(results_paths):
+    """ results files to import, folders (e.g. the data folders of the nodes
+    of a sweep) are replaced by the results files they hold
+    """
+    for path in results_paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.startswith("results_") and name.endswith(".jsonl"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def _import_results_to_db(conn_db, results_paths, fresh=False):
+    """ import the append-only results files written by triki (--sink jsonl),
+    every line holds the cookies and stats of a flow
+    """
+    LOG.info("[!] Importing results files...\n")
+    start = time.monotonic()
+    total_rows = 0
+    pending_rows = 0
+    rollups = _table_exists(conn_db, "rollup_host_date")
+    previous = _begin_bulk_load(conn_db, fresh)
+    for results_path in _results_files(results_paths):
+        with open(results_path) as f:
+            for line in f:
+                record = json.loads(line)
+                attributes_rows = flow_attributes(record["url"], record["date"], record["flow_type"])
+                conn_db.execute("SAVEPOINT flow")
+                try:
+                    inserted = save_flow(conn_db, attributes_rows, record["cookies"], record["stats"], rollups)
+                except Error as e:
+                    conn_db.execute("ROLLBACK TO flow")
+                    LOG.error("Insert failed: %s %s (%s)", record["url"], record["flow_type"], e)
+                    inserted = 0
+                conn_db.execute("RELEASE flow")
+                total_rows += inserted + 1
+                pending_rows += inserted + 1
+                if pending_rows >= TRANSACTION_ROWS:
+                    conn_db.execute("COMMIT")
+                    conn_db.execute("BEGIN")
+                    pending_rows = 0
+        LOG.info("Insert: %s.", results_path)
+    _end_bulk_load(conn_db, previous)
+
+    elapsed = time.monotonic() - start
+    LOG.info("[*] Imported %s rows in %.1f seconds (%d rows/s)", total_rows, elapsed,
+             total_rows / elapsed if elapsed else 0)
+    LOG.info("[*] Results imported successfully!\n")
+
+
+def _begin_bulk_load(conn_db, fresh=False):
+    """ tune the connection for bulk inserts handling transactions explicitly,
+    journaling is only disabled when the database file was just created.
+    Returns the journal mode and synchronous setting to restore at the end
+    """
+    conn_db.commit()
+    conn_db.isolation_level = None
+    previous = (conn_db.execute("PRAGMA journal_mode").fetchone()[0],
+                conn_db.execute("PRAGMA synchronous").fetchone()[0])
+    for pragma in PRAGMAS_BULK_LOAD + (PRAGMAS_BULK_LOAD_FRESH if fresh else PRAGMAS_BULK_LOAD_EXISTING):
+        conn_db.execute(pragma)
+    conn_db.execute("BEGIN")
+    return previous
+
+
+def _end_bulk_load(conn_db, previous):
+    journal_mode, synchronous = previous
+    conn_db.execute("COMMIT")
+    conn_db.execute("PRAGMA journal_mode = %s" % journal_mode)
+    conn_db.execute("PRAGMA synchronous = %d" % synchronous)
+    conn_db.isolation_level = ""
 
 
 def _get_directories(path):
@@ -124,22 +924,122 @@ def _get_CSVs(path):
     with os.scandir(path) as files:
         for _file in files:
             if _file.is_file() and _file.name.endswith('.csv'):
-                type_list = _file.name.split("_")[:3]
-                is_block = "block" in type_list[2]
+                type_list = _file.name.split("_")
                 table_name = type_list[0]
+                flow_name, is_block = _parse_flow_type(type_list[1:])
                 if is_block:
-                    flow_name = type_list[1] + "_third_party"
-                else:
-                    flow_name = type_list[1]
+                    flow_name += "_third_party"
                 csv_dict[table_name][flow_name] = _file.name
 
         return csv_dict
 
 
-def _import_data_to_db(conn_db, data_path):
+def _scan_site(data_path, site_name):
+    """ list the date directories of a site, run by the pipeline workers """
+    return site_name, _get_directories(os.path.join(data_path, site_name))
+
+
+def _parse_date_dir(url, date, path, known_files):
+    """ find and parse the csv files of a site date directory that need to be
+    imported, run by the pipeline workers
+    :param known_files: manifest records of the files in the directory
+    :return: list of jobs ready to be written by _write_csv
+    """
+    jobs = []
+    csv_dict = _get_CSVs(path)
+    for table, sql in (("cookies", QUERY_INSERT_TABLE_COOKIES), ("stats", QUERY_INSERT_TABLE_STATS)):
+        for key, csv_name in csv_dict[table].items():
+            csv_path = os.path.join(path, csv_name)
+            known = known_files.get(os.path.abspath(csv_path))
+            job = _prepare_csv(csv_path, url, date, key, sql, known, parse=True)
+            if job:
+                jobs.append(job)
+    return jobs
+
+
+def _write_date_dir(conn_db, url, future, manifest, rollups):
+    """ write the jobs parsed for a site date directory """
+    inserted = 0
+    try:
+        for job in future.result():
+            inserted += _write_csv(conn_db, job, manifest, rollups)
+        if inserted:
+            LOG.info("Insert: %s.", url)
+    except Exception as e:
+        LOG.error("Insert failed: %s (%s)", url, e)
+    return inserted
+
+
+def _import_data_to_db_parallel(conn_db, data_path, workers, fresh=False):
+    """ import data with a pool of workers scanning directories and parsing
+    csv files while this thread is the only one writing to the database.
+    The number of parsed directories waiting to be written is bounded.
+    """
+    LOG.info("[!] Browsing data path with %s workers...\n", workers)
+    start = time.monotonic()
+    total_rows = 0
+    pending_rows = 0
+    manifest = _load_manifest(conn_db)
+    # Rollups are computed at the end when loading an empty database
+    rollups = _table_exists(conn_db, "rollup_host_date")
+    # Manifest records grouped by directory, only those are sent to workers
+    known_by_dir = {}
+    for path, record in manifest.items():
+        known_by_dir.setdefault(os.path.dirname(path), {})[path] = record
+    max_pending = workers * PENDING_DIRS_PER_WORKER
+    pending = {}
+
+    def write_completed(return_when):
+        nonlocal total_rows, pending_rows
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            url = pending.pop(future)
+            inserted = _write_date_dir(conn_db, url, future, manifest, rollups)
+            total_rows += inserted
+            pending_rows += inserted
+            if pending_rows >= TRANSACTION_ROWS:
+                conn_db.execute("COMMIT")
+                conn_db.execute("BEGIN")
+                pending_rows = 0
+
+    previous = _begin_bulk_load(conn_db, fresh)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        site_dir = _get_directories(data_path)
+        scans = executor.map(_scan_site, [data_path] * len(site_dir), site_dir)
+        for site_name, dates_per_site in scans:
+            for date_site in dates_per_site:
+                path = os.path.abspath(os.path.join(data_path, site_name, date_site))
+                future = executor.submit(_parse_date_dir, site_name, date_site, path,
+                                         known_by_dir.get(path, {}))
+                pending[future] = site_name
+                # Backpressure, wait for the writer before parsing more
+                if len(pending) >= max_pending:
+                    write_completed(FIRST_COMPLETED)
+            # Delta logs are replayed by the writer, only their changes are written
+            inserted = _import_delta_logs(conn_db, os.path.join(data_path, site_name), site_name, manifest, rollups)
+            total_rows += inserted
+            pending_rows += inserted
+        while pending:
+            write_completed(FIRST_COMPLETED)
+    _end_bulk_load(conn_db, previous)
+
+    elapsed = time.monotonic() - start
+    LOG.info("[*] Imported %s rows in %.1f seconds (%d rows/s)", total_rows, elapsed,
+             total_rows / elapsed if elapsed else 0)
+    LOG.info("[*] Site data imported successfully!\n")
+
+
+def _import_data_to_db(conn_db, data_path, fresh=False):
     site_dict = {}
     LOG.info("[!] Browsing data path...\n")
     site_dir = _get_directories(data_path)
+    start = time.monotonic()
+    total_rows = 0
+    pending_rows = 0
+    manifest = _load_manifest(conn_db)
+    # Rollups are computed at the end when loading an empty database
+    rollups = _table_exists(conn_db, "rollup_host_date")
+    previous = _begin_bulk_load(conn_db, fresh)
 
     for site_name in site_dir:
         site_path = os.path.join(data_path, site_name)
@@ -151,17 +1051,30 @@ def _import_data_to_db(conn_db, data_path):
             date_site_path = os.path.join(site_path, date_site)
             csv_per_date_dict = _get_CSVs(date_site_path)
             site_dict["dates"][date_site] = csv_per_date_dict
-        _save_to_db(conn_db, site_dict)
+        inserted = _save_to_db(conn_db, site_dict, manifest, rollups)
+        inserted += _import_delta_logs(conn_db, site_path, site_name, manifest, rollups)
+        total_rows += inserted
+        pending_rows += inserted
+        if pending_rows >= TRANSACTION_ROWS:
+            conn_db.execute("COMMIT")
+            conn_db.execute("BEGIN")
+            pending_rows = 0
+    _end_bulk_load(conn_db, previous)
 
+    elapsed = time.monotonic() - start
+    LOG.info("[*] Imported %s rows in %.1f seconds (%d rows/s)", total_rows, elapsed,
+             total_rows / elapsed if elapsed else 0)
     LOG.info("[*] Site data imported successfully!\n")
 
 
 def _insert_table(conn, sql, values):
+    """ insert every row given by the values iterable in a single executemany,
+    transactions are handled by the caller
+    :return: number of inserted rows
+    """
     cur = conn.cursor()
-    for value in values:
-        cur.execute(sql, value)
-    conn.commit()
-    return cur.lastrowid
+    cur.executemany(sql, values)
+    return cur.rowcount
 
 
 def _create_table(conn, create_table_sql):
@@ -178,13 +1091,55 @@ def _create_table(conn, create_table_sql):
         raise e
 
 
-def _create_database(conn):
-    query_table_list = [QUERY_CREATE_COOKIES_TABLE, QUERY_CREATE_STATS_TABLE]
+def _create_database(conn, delta=False):
+    """ create the tables missing in the database
+    :param delta: keep cookie records once with the snapshots where they were
+                  observed, the cookies table is a view over them
+    """
+    query_table_list = [QUERY_CREATE_COOKIES_TABLE, QUERY_CREATE_STATS_TABLE, QUERY_CREATE_MANIFEST_TABLE]
+    if delta:
+        if _table_exists(conn, "cookies"):
+            raise ValueError("The database stores full copies of the cookies, it can not be used as a delta database")
+        if _table_exists(conn, "cookie_ranges") and not _table_exists(conn, "cookie_expires"):
+            # The view of older delta databases rebuilds expirations at day precision
+            conn.execute("DROP VIEW IF EXISTS cookies")
+        query_table_list = [QUERY_CREATE_RECORDS_TABLE, QUERY_CREATE_SNAPSHOTS_TABLE, QUERY_CREATE_RANGES_TABLE,
+                            QUERY_CREATE_EXPIRES_TABLE, QUERY_CREATE_COOKIES_VIEW] + query_table_list[1:]
     for query in query_table_list:
         _create_table(conn, query)
     LOG.info("[*] Successful database creation.\n")
 
 
+def _table_exists(conn, table):
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cur.fetchone() is not None
+
+
+def _upgrade_database(conn):
+    """ add the indexes and rollup tables missing in databases created by
+    older versions, rollups are computed from the existing cookies
+    """
+    rollups = [
+        ("rollup_site_date_flow", QUERY_CREATE_ROLLUP_FLOW_TABLE, QUERY_BACKFILL_ROLLUP_FLOW),
+        ("rollup_host_date", QUERY_CREATE_ROLLUP_HOST_TABLE, QUERY_BACKFILL_ROLLUP_HOST),
+    ]
+    try:
+        for table, create_sql, backfill_sql in rollups:
+            if not _table_exists(conn, table):
+                _create_table(conn, create_sql)
+                conn.execute(backfill_sql)
+                LOG.info("[*] Created rollup table %s.\n", table)
+        if _is_delta_database(conn):
+            indexes = QUERY_CREATE_DELTA_INDEXES + QUERY_CREATE_INDEXES
+        else:
+            indexes = QUERY_CREATE_COOKIES_INDEXES + QUERY_CREATE_INDEXES
+        for index_sql in indexes:
+            conn.execute(index_sql)
+        conn.commit()
+    except Error as e:
+        raise e
+
+
 def _create_connection(db_file):
     """ create a database connection to a SQLite database """
     try:
@@ -220,12 +1175,24 @@ def run(params):
                 rmtree(DATABASE_PATH)
             os.makedirs(DATABASE_PATH)
 
-        conn_db = _create_connection("%s/site_cookies.db" % (DATABASE_PATH))
-        if not params.keep_db:
-            _create_database(conn_db)
+        db_path = "%s/site_cookies.db" % (DATABASE_PATH)
+        fresh = not os.path.exists(db_path)
+        conn_db = _create_connection(db_path)
+        # Tables are created only if missing, so existing databases get
+        # any table added by newer versions
+        _create_database(conn_db, params.delta)
+        # Indexes slow down bulk loads, a new database gets them after loading
+        if params.keep_db:
+            _upgrade_database(conn_db)
 
         # Import data
-        _import_data_to_db(conn_db, params.data_path)
+        if params.results_paths:
+            _import_results_to_db(conn_db, params.results_paths, fresh)
+        elif params.workers > 1:
+            _import_data_to_db_parallel(conn_db, params.data_path, params.workers, fresh)
+        else:
+            _import_data_to_db(conn_db, params.data_path, fresh)
+        _upgrade_database(conn_db)
     except Exception as e:
         LOG.error("Found error %s", e)
     finally:
@@ -235,10 +1202,17 @@ def run(params):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--import', '-i', dest="data_path", type=str, default=None, required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--import', '-i', dest="data_path", type=str, default=None,
                         help='Import data to the database. --import / -i <directory_data>')
+    source.add_argument('--results', '-r', dest="results_paths", type=str, nargs="+", default=None,
+                        help='Import the results files written by triki --sink jsonl, or every results file of the given folders')
     parser.add_argument('--keep-database', '-k', action="store_true", default=False, dest="keep_db",
                         help='Keep existing database, useful to only import new data')
+    parser.add_argument('--delta', action="store_true", default=False, dest="delta",
+                        help='Store each cookie record once with the snapshots where it was observed instead of a copy per date')
+    parser.add_argument('--workers', '-w', dest="workers", type=int, default=1,
+                        help='Number of processes scanning and parsing csv files, a single one writes to the database')
 
     params = parser.parse_args()
     run(params)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Batch computation of Triki cookie statistics for many site-days at once.
+   Statistics are computed either from the cookies table of the SQLite
+   database in a single query or from the cookies csv files and delta logs
+   of the data folder, expiration days are relative to the date of each snapshot"""
+import os
+import sys
+import argparse
+import csv
+import logging
+import sqlite3
+
+import arrow
+
+CWD = os.path.dirname(__file__)
+sys.path.append(os.path.join(os.path.abspath(CWD), ".."))
+from triki_cookies import CHROME_EPOCH_OFFSET, HEADER_COOKIES, HEADER_STATS, MICROSECONDS_PER_DAY, chrome_time, cookie_stats  # noqa: E402
+from triki_database import (DATABASE_PATH, _delta_logs, _flow_key_attributes, _get_CSVs,  # noqa: E402
+                            _get_directories, flow_attributes, read_delta_log)
+
+HEADER_BATCH_STATS = ["url", "date", "flow", "block_third_party"] + HEADER_STATS[1:]
+
+LOG = logging.getLogger()
+
+# Chrome time of the snapshot date (YYYYMMDD) of each cookie
+SQL_SNAPSHOT_TIME = """(CAST(strftime('%%s', substr(date, 1, 4) || '-' || substr(date, 5, 2) || '-' || substr(date, 7, 2)) AS INTEGER)
+                        + %s) * 1000000""" % CHROME_EPOCH_OFFSET
+# Floor division so that days match the ones computed by triki
+SQL_EXP_DAYS = """(expires_utc - snapshot) / %(day)s - ((expires_utc - snapshot) %% %(day)s < 0)""" % {
+    "day": MICROSECONDS_PER_DAY}
+
+QUERY_BATCH_STATS = """SELECT s.url, s.date, s.flow, s.block_third_party,
+                              coalesce(c.total, 0), coalesce(c.session, 0), coalesce(c.persistent, 0),
+                              coalesce(c.sum_exp_days, 0), coalesce(c.max_exp_days, 0),
+                              coalesce(c.secure, 0), coalesce(c.httponly, 0), coalesce(c.samesite_none, 0),
+                              coalesce(c.samesite_lax, 0), coalesce(c.samesite_strict, 0)
+                       FROM stats s LEFT JOIN (
+                           SELECT url, date, flow, block_third_party,
+                                  count(*) AS total,
+                                  sum(NOT is_persistent) AS session,
+                                  sum(is_persistent) AS persistent,
+                                  sum(CASE WHEN is_persistent THEN exp_days END) AS sum_exp_days,
+                                  max(CASE WHEN is_persistent THEN exp_days END) AS max_exp_days,
+                                  sum(is_secure) AS secure,
+                                  sum(is_httponly) AS httponly,
+                                  sum(samesite = -1) AS samesite_none,
+                                  sum(samesite = 0) AS samesite_lax,
+                                  sum(samesite = 1) AS samesite_strict
+                           FROM (SELECT *, %s AS exp_days
+                                 FROM (SELECT *, %s AS snapshot FROM cookies))
+                           GROUP BY url, date, flow, block_third_party
+                       ) c USING (url, date, flow, block_third_party)
+                       ORDER BY s.url, s.date, s.flow, s.block_third_party""" % (SQL_EXP_DAYS, SQL_SNAPSHOT_TIME)
+
+QUERY_UPDATE_STATS = """UPDATE stats SET total = ?, session = ?, max_exp_days = ?, avg_exp_days = ?,
+                               secure_flag = ?, httponly_flag = ?, samesite_none_flag = ?,
+                               samesite_lax_flag = ?, samesite_strict_flag = ?
+                        WHERE url = ? AND date = ? AND flow = ? AND block_third_party = ?"""
+
+
+def _set_logging():
+    """
+    Setup logging based on envvars and opinated defaults
+    """
+    log_level = os.getenv("TRIKI_LOG_LEVEL", "INFO")
+    quiet = os.getenv("TRIKI_NO_LOG_FILE")
+    handlers = [logging.StreamHandler()]
+    if not quiet:
+        handlers.append(logging.FileHandler("triki_stats.log"))
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)-15s %(levelname)s: %(message)s",
+        handlers=handlers,
+    )
+
+
+def stats_from_database(conn):
+    """
+    Compute the statistics of every flow stored in the database with a single query
+    """
+    for row in conn.execute(QUERY_BATCH_STATS):
+        url, date, flow, block_third_party, total, session, persistent, sum_exp_days = row[:8]
+        max_exp_days, secure, httponly, samesite_none, samesite_lax, samesite_strict = row[8:]
+        yield {
+            "url": url,
+            "date": date,
+            "flow": flow,
+            "block_third_party": block_third_party,
+            "total": total,
+            "session": session,
+            "max_exp_days": max_exp_days,
+            "avg_exp_days": int(round(sum_exp_days / persistent)) if persistent else 0,
+            "secure_flag": secure,
+            "httponly_flag": httponly,
+            "samesite_none_flag": samesite_none,
+            "samesite_lax_flag": samesite_lax,
+            "samesite_strict_flag": samesite_strict,
+        }
+
+
+def stats_from_data(data_path):
+    """
+    Compute the statistics of every cookies csv and delta log snapshot in the data folder
+    """
+    for site_name in sorted(_get_directories(data_path)):
+        site_path = os.path.join(data_path, site_name)
+        for date in sorted(_get_directories(site_path)):
+            date_path = os.path.join(site_path, date)
+            now = chrome_time(arrow.get(date, "YYYYMMDD"))
+            for key, csv_name in sorted(_get_CSVs(date_path)["cookies"].items()):
+                with open(os.path.join(date_path, csv_name), newline="") as f:
+                    stats = cookie_stats(csv.DictReader(f), site_name, now)
+                stats["date"] = date
+                flow, block_third_party = _flow_key_attributes(key)
+                stats["flow"] = flow
+                stats["block_third_party"] = int(block_third_party)
+                yield stats
+        for log_name in sorted(_delta_logs(site_path)):
+            yield from stats_from_delta_log(os.path.join(site_path, log_name), site_name)
+
+
+def stats_from_delta_log(log_path, site_name):
+    """
+    Compute the statistics of the snapshots of a cookies delta log, a flow
+    run again on the same date replaces its previous snapshot
+    """
+    snapshots = {}
+    with open(log_path, "rb") as f:
+        for snapshot, rows in read_delta_log(f):
+            now = chrome_time(arrow.get(snapshot["date"], "YYYYMMDD"))
+            stats = cookie_stats((dict(zip(HEADER_COOKIES, row)) for row in rows), site_name, now)
+            _, stats["date"], stats["flow"], block_third_party = flow_attributes(
+                site_name, snapshot["date"], snapshot["flow_type"])
+            stats["block_third_party"] = int(block_third_party)
+            snapshots[snapshot["date"]] = stats
+    for date in sorted(snapshots):
+        yield snapshots[date]
+
+
+def update_database(conn, batch_stats):
+    """
+    Replace the statistics of the stats table with the computed ones
+    """
+    conn.executemany(
+        QUERY_UPDATE_STATS,
+        (tuple(stats[field] for field in HEADER_STATS[1:]) +
+         (stats["url"], stats["date"], stats["flow"], stats["block_third_party"])
+         for stats in batch_stats),
+    )
+    conn.commit()
+
+
+def run(params):
+    _set_logging()
+    if params.data_path:
+        batch_stats = stats_from_data(params.data_path)
+    else:
+        conn = sqlite3.connect(params.database)
+        batch_stats = stats_from_database(conn)
+        if params.update_db:
+            # Materialize before updating the table being read
+            batch_stats = list(batch_stats)
+            update_database(conn, batch_stats)
+            LOG.info("Updated %s rows of the stats table", len(batch_stats))
+    rows = 0
+    with open(params.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=HEADER_BATCH_STATS, extrasaction="ignore")
+        writer.writeheader()
+        for stats in batch_stats:
+            writer.writerow(stats)
+            rows += 1
+    LOG.info("Computed statistics for %s flows in %s", rows, params.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', '-d', dest="database", type=str,
+                        default=os.path.join(DATABASE_PATH, "site_cookies.db"),
+                        help='SQLite database created by triki_database.py')
+    parser.add_argument('--data', '-i', dest="data_path", type=str, default=None,
+                        help='Compute the statistics from the csv files of a data folder instead')
+    parser.add_argument('--output', '-o', dest="output", type=str, default="stats_batch.csv",
+                        help='csv file where the statistics are written')
+    parser.add_argument('--update-database', '-u', action="store_true", default=False, dest="update_db",
+                        help='Replace the statistics of the stats table with the computed ones')
+
+    params = parser.parse_args()
+    run(params)
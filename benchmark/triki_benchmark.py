@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline benchmark of Triki. Serves synthetic sites with a OneTrust like
+   cookie banner from a local HTTP server and runs the flows of the example
+   configuration against them, reporting the time spent on every flow and
+   phase and the number of flows processed per hour."""
+import os
+import sys
+import argparse
+import csv
+import logging
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shutil import rmtree
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+
+CWD = os.path.dirname(__file__)
+sys.path.append(os.path.join(os.path.abspath(CWD), ".."))
+import triki  # noqa: E402
+import triki_config  # noqa: E402
+
+EXAMPLE_CONFIG = os.path.join(CWD, "..", "config", "sites-example.yaml")
+# Synthetic sites are subdomains of localhost (chrome resolves them to the
+# loopback) and their trackers are served from the loopback ip, a
+# different site for chrome
+SITE_HOST = "site%s.localhost"
+TRACKER_HOST = "127.0.0.1"
+PHASES = triki.TIMING_PHASES + ["other"]
+HEADER_BENCHMARK = ["url", "flow_type", "wall"] + PHASES + ["error"]
+
+# cookies set by the site document, the consent call and the tracker frame
+FIRST_PARTY_COOKIES = [
+    "fp_session=1; Path=/",
+    "fp_lax=1; Path=/; Max-Age=86400; SameSite=Lax",
+    "fp_strict=1; Path=/; Max-Age=31536000; SameSite=Strict; HttpOnly",
+    "fp_none=1; Path=/; Max-Age=3600; SameSite=None; Secure",
+]
+CONSENT_COOKIES = {
+    "accept": [
+        "_ga=GA1.1.1; Path=/; Max-Age=63072000; SameSite=Lax",
+        "_gid=GA1.1.2; Path=/; Max-Age=86400",
+        "_fbp=fb.1.1; Path=/; Max-Age=7776000; SameSite=Lax",
+    ],
+    "reject": [],
+}
+TRACKER_COOKIES = [
+    "tp_id=1; Path=/; Max-Age=34128000; SameSite=None; Secure",
+    "tp_session=1; Path=/; SameSite=None; Secure",
+    "tp_lax=1; Path=/; Max-Age=86400; SameSite=Lax",
+]
+
+SITE_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Site %(site)s</title>
+<style>@font-face { font-family: "Site"; src: url("/static/site.woff2"); } body { font-family: "Site"; }</style>
+</head>
+<body>
+<h1>Synthetic site %(site)s</h1>
+<img src="/static/hero.jpg" width="600" height="300">
+<p>Content of the page.</p>
+<video src="/static/intro.mp4" autoplay muted width="320" height="180"></video>
+<iframe id="tracker-frame" src="http://%(tracker)s/tracker?site=%(site)s" width="10" height="10"></iframe>
+<script>
+function setConsent(choice) {
+    var expires = new Date(Date.now() + 365 * 86400000).toUTCString();
+    document.cookie = "OptanonAlertBoxClosed=" + new Date().toISOString() + "; path=/; expires=" + expires + "; SameSite=Lax";
+    document.cookie = "OptanonConsent=groups%%3D" + (choice === "accept" ? "1,2,3,4" : "1") + "; path=/; expires=" + expires + "; SameSite=Lax";
+    fetch("/consent?choice=" + choice);
+    if (choice === "accept") {
+        var frame = document.createElement("iframe");
+        frame.src = "http://%(tracker)s/tracker?site=%(site)s&consent=1";
+        document.body.appendChild(frame);
+    }
+    document.getElementById("onetrust-consent-sdk").remove();
+}
+setTimeout(function () {
+    var sdk = document.createElement("div");
+    sdk.id = "onetrust-consent-sdk";
+    sdk.innerHTML = '<div id="onetrust-banner-sdk" style="position:fixed;bottom:0;width:100%%;padding:20px;background:#eee">' +
+        '<p>We use cookies</p>' +
+        '<button id="onetrust-pc-btn-handler">Cookie settings</button>' +
+        '<button id="onetrust-accept-btn-handler">Accept all</button></div>' +
+        '<div id="onetrust-pc-sdk" style="display:none;position:fixed;top:0;padding:20px;background:#ddd">' +
+        '<button class="ot-pc-refuse-all-handler">Reject all</button></div>';
+    document.body.appendChild(sdk);
+    document.getElementById("onetrust-accept-btn-handler").onclick = function () { setConsent("accept"); };
+    document.getElementById("onetrust-pc-btn-handler").onclick = function () {
+        document.getElementById("onetrust-pc-sdk").style.display = "block";
+    };
+    document.querySelector(".ot-pc-refuse-all-handler").onclick = function () { setConsent("reject"); };
+}, %(banner_delay)s);
+</script>
+</body>
+</html>
+"""
+# Size of the images, fonts and videos of the sites, what blocking them saves
+STATIC_SIZE = 512 * 1024
+# Static files can be cached like on real sites (to measure --shared-cache),
+# documents and responses setting cookies are requested on every visit
+STATIC_MAX_AGE = 86400
+TRACKER_PAGE = """<!DOCTYPE html>
+<html><body><img src="/pixel?site=%(site)s" width="1" height="1"></body></html>
+"""
+
+LOG = logging.getLogger()
+
+
+def _set_logging():
+    """
+    Setup logging based on envvars and opinated defaults
+    """
+    log_level = os.getenv("TRIKI_LOG_LEVEL", "INFO")
+    quiet = os.getenv("TRIKI_NO_LOG_FILE")
+    handlers = [logging.StreamHandler()]
+    if not quiet:
+        handlers.append(logging.FileHandler("triki_benchmark.log"))
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)-15s %(levelname)s: %(message)s",
+        handlers=handlers,
+    )
+
+
+class BannerHandler(BaseHTTPRequestHandler):
+    """
+    Serves the synthetic sites, their consent calls and the tracker frames
+    """
+
+    page_delay = 0
+    banner_delay = 0
+
+    def _send(self, body, cookies=(), content_type="text/html", cache_control="no-store"):
+        if not isinstance(body, bytes):
+            body = body.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", cache_control)
+        for cookie in cookies:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        host = self.headers.get("Host", "").split(":")[0]
+        if url.path == "/" and host.endswith(".localhost"):
+            # Slow sites take a while to send the document
+            sleep(self.page_delay)
+            self._send(
+                SITE_PAGE % {
+                    "site": host.split(".")[0][len("site"):],
+                    "tracker": "%s:%s" % (TRACKER_HOST, self.server.server_port),
+                    "banner_delay": int(self.banner_delay * 1000),
+                },
+                FIRST_PARTY_COOKIES,
+            )
+        elif url.path == "/consent":
+            choice = query.get("choice", ["reject"])[0]
+            self._send("{}", CONSENT_COOKIES.get(choice, []), "application/json")
+        elif url.path == "/tracker":
+            self._send(TRACKER_PAGE % {"site": query.get("site", [""])[0]}, TRACKER_COOKIES)
+        elif url.path.startswith("/static/"):
+            self._send(
+                b"\0" * STATIC_SIZE,
+                content_type="application/octet-stream",
+                cache_control="max-age=%s" % STATIC_MAX_AGE,
+            )
+        elif url.path == "/pixel":
+            self._send("", ["tp_pixel=1; Path=/; Max-Age=2592000; SameSite=None; Secure"], "image/gif")
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        LOG.debug("server: " + format, *args)
+
+
+def start_server(page_delay=0, banner_delay=0, port=0):
+    """
+    Start the synthetic sites server in a background thread
+    """
+    handler = type(
+        "BenchmarkHandler",
+        (BannerHandler,),
+        {"page_delay": page_delay, "banner_delay": banner_delay},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOG.info("Serving synthetic sites on port %s", server.server_port)
+    return server
+
+
+def benchmark_sites(port, sites, max_sleep):
+    """
+    Flows of the example configuration pointed to the synthetic sites,
+    sleep and settle steps wait max_sleep seconds at most
+    """
+    with open(EXAMPLE_CONFIG, "r", encoding="utf8") as f:
+        flows = yaml.load(f, Loader=triki_config.YAML_LOADER)["sites"]
+    result = []
+    for number in range(sites):
+        for flow in flows:
+            site = dict(flow)
+            site["url"] = "http://%s:%s/" % (SITE_HOST % number, port)
+            site["flow"] = []
+            for step in flow["flow"]:
+                step = dict(step)
+                if step["action"] in ("sleep", "settle"):
+                    step["value"] = min(step["value"], max_sleep)
+                site["flow"].append(step)
+            result.append(site)
+    return result
+
+
+def run_benchmark(sites, params, data_path, today):
+    """
+    Run every flow sequentially, returns a row per flow with the timings
+    of each phase measured by triki
+    """
+    triki.compile_sites(sites, params)
+    triki.DATA_PATH = data_path
+    triki.SCREENSHOTS_PATH = os.path.join(data_path, "screenshots")
+    rows = []
+    try:
+        for site in sites:
+            url, flow_type, error, timings = triki.process_site(site, today, params)
+            row = {"url": url, "flow_type": flow_type, "wall": timings["wall"], "error": error or ""}
+            row.update((phase, timings["phases"].get(phase, 0)) for phase in PHASES)
+            rows.append(row)
+            LOG.info(
+                "%s %s: %.2fs (%s)%s",
+                url,
+                flow_type,
+                row["wall"],
+                ", ".join("%s %.2fs" % (phase, row[phase]) for phase in PHASES),
+                " failed: %s" % error if error else "",
+            )
+    finally:
+        triki.close_browser_pool()
+        triki.close_result_sink()
+        triki.close_screenshot_writer()
+    return rows
+
+
+def report(rows, output):
+    """
+    Write the flows timings and log the summary of the benchmark
+    """
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=HEADER_BENCHMARK)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {key: round(value, 4) if isinstance(value, float) else value
+                 for key, value in row.items()}
+            )
+    walls = [row["wall"] for row in rows]
+    total = sum(walls)
+    failed = len([row for row in rows if row["error"]])
+    LOG.info("Flows: %s, failed: %s, total %.1fs", len(rows), failed, total)
+    LOG.info(
+        "Wall per flow: mean %.2fs, p50 %.2fs, p95 %.2fs",
+        total / len(rows) if rows else 0,
+        triki.percentile(walls, 50),
+        triki.percentile(walls, 95),
+    )
+    for phase in PHASES:
+        LOG.info(
+            "  %-8s mean %.2fs",
+            phase,
+            sum(row[phase] for row in rows) / len(rows) if rows else 0,
+        )
+    # Flows of a site run one after another, a site takes all of them
+    site_walls = {}
+    for row in rows:
+        site_walls[row["url"]] = site_walls.get(row["url"], 0) + row["wall"]
+    site_walls = list(site_walls.values())
+    LOG.info(
+        "Wall per site (%s sites): mean %.2fs, p50 %.2fs, p95 %.2fs",
+        len(site_walls),
+        total / len(site_walls) if site_walls else 0,
+        triki.percentile(site_walls, 50),
+        triki.percentile(site_walls, 95),
+    )
+    LOG.info(
+        "Sites per hour: %.1f (%.0f flows per hour)",
+        len(site_walls) * 3600 / total if total else 0,
+        len(rows) * 3600 / total if total else 0,
+    )
+    LOG.info("Timings of every flow in %s", output)
+
+
+def run(params, triki_args):
+    _set_logging()
+    triki_params = triki._arg_parser().parse_args(triki_args)
+    if triki_params.workers > 1:
+        LOG.warning("The benchmark runs flows sequentially, --workers is ignored")
+    server = start_server(params.page_delay, params.banner_delay, params.port)
+    data_path = tempfile.mkdtemp(prefix="triki_benchmark_")
+    # Benchmark results never end up with the real ones
+    if triki_params.sink == "jsonl":
+        triki_params.results_path = os.path.join(data_path, "results.jsonl")
+    elif triki_params.sink == "database" and "--database" not in triki_args:
+        triki_params.database = os.path.join(data_path, "site_cookies.db")
+    try:
+        sites = benchmark_sites(server.server_port, params.sites, params.max_sleep)
+        LOG.info("Running %s flows over %s synthetic sites", len(sites), params.sites)
+        rows = run_benchmark(sites, triki_params, data_path, "benchmark")
+    finally:
+        server.shutdown()
+        server.server_close()
+        if params.keep_data:
+            LOG.info("Benchmark data kept in %s", data_path)
+        else:
+            rmtree(data_path, ignore_errors=True)
+        rmtree(triki.PROFILE_PATH, ignore_errors=True)
+    report(rows, params.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        epilog="Any other option is passed to triki, e.g. --headless or --warm-browsers 1"
+    )
+    parser.add_argument('--sites', '-n', dest="sites", type=int, default=5,
+                        help='Number of synthetic sites, each one runs the flows of the example configuration')
+    parser.add_argument('--page-delay', dest="page_delay", type=float, default=0.5,
+                        help='Seconds the server waits before sending each site')
+    parser.add_argument('--banner-delay', dest="banner_delay", type=float, default=1,
+                        help='Seconds until the cookie banner shows up once the site is loaded')
+    parser.add_argument('--max-sleep', dest="max_sleep", type=float, default=2,
+                        help='Maximum seconds of the sleep and settle steps of the flows')
+    parser.add_argument('--port', dest="port", type=int, default=0,
+                        help='Port of the synthetic sites server, a free one by default')
+    parser.add_argument('--output', '-o', dest="output", type=str, default="benchmark_results.csv",
+                        help='csv file where the timings of every flow are written')
+    parser.add_argument('--keep-data', action="store_true", default=False, dest="keep_data",
+                        help='Keep the cookies and screenshots of the benchmark')
+
+    params, triki_args = parser.parse_known_args()
+    run(params, triki_args)
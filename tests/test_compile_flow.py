@@ -0,0 +1,137 @@
+import unittest
+
+import triki
+
+
+def _site(flow, **options):
+    site = {"url": "https://www.example.com", "flow_type": "accept", "flow": flow}
+    site.update(options)
+    return site
+
+
+class CompileFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.params = triki._arg_parser().parse_args([])
+
+    def assertInvalid(self, site, message):
+        with self.assertRaises(ValueError) as raised:
+            triki.compile_flow(site, self.params)
+        self.assertIn(message, str(raised.exception))
+
+    def test_compiled_steps(self):
+        banner = {"by": "id", "value": "banner"}
+        accept = {"by": "xpath", "value": "//button", "javascript": True}
+        flow = [
+            {"action": "delay", "element": banner, "value": 10},
+            {"action": "screenshot", "element": banner, "filename": "banner"},
+            {"action": "navigate_frame", "element": {"index": 0}},
+            {"action": "click", "element": accept},
+            {"action": "keys", "element": banner, "value": "text"},
+            {"action": "submit", "element": banner},
+            {"action": "sleep", "value": 5},
+            {"action": "settle", "value": 20, "quiet": 2},
+            {"action": "screenshot", "element": "None"},
+        ]
+        steps = triki.compile_flow(_site(flow), self.params)
+        self.assertEqual(
+            [(function, args) for function, args, _ in steps],
+            [
+                (triki._value_step, (triki.delay, banner, 10)),
+                (triki._screenshot_step, (banner, "banner", False)),
+                (triki._element_step, (triki.navigate_frame, {"index": 0})),
+                (triki._element_step, (triki.click, accept)),
+                (triki._value_step, (triki.keys, banner, "text")),
+                (triki._element_step, (triki.submit, banner)),
+                (triki._sleep_step, (5,)),
+                (triki._settle_step, (20, 2)),
+                (triki._screenshot_step, (None, None, False)),
+            ],
+        )
+        self.assertEqual([step for _, _, step in steps], flow)
+
+    def test_sleep_becomes_settle(self):
+        self.params.settle = True
+        steps = triki.compile_flow(_site([{"action": "sleep", "value": 5}]), self.params)
+        self.assertEqual(steps[0][:2], (triki._settle_step, (5, triki.SETTLE_QUIET_SECONDS)))
+
+    def test_unknown_action(self):
+        self.assertInvalid(_site([{"action": "scroll", "value": 5}]), "step 1: unknown action 'scroll'")
+        self.assertInvalid(_site([{"value": 5}]), "unknown action None")
+
+    def test_unknown_step_key(self):
+        self.assertInvalid(_site([{"action": "sleep", "vaule": 5}]), "unknown keys vaule")
+
+    def test_bad_locator_strategy(self):
+        flow = [
+            {"action": "sleep", "value": 1},
+            {"action": "click", "element": {"by": "css", "value": "#accept"}},
+        ]
+        self.assertInvalid(_site(flow), "step 2: unknown locator strategy 'css'")
+
+    def test_missing_element_keys(self):
+        self.assertInvalid(_site([{"action": "click"}]), "missing element")
+        self.assertInvalid(_site([{"action": "click", "element": {"by": "id"}}]), "element without value")
+        self.assertInvalid(_site([{"action": "click", "element": {"value": "accept"}}]), "element without by")
+        self.assertInvalid(
+            _site([{"action": "click", "element": {"by": "id", "value": "a", "wait": 1}}]),
+            "unknown element keys wait",
+        )
+        self.assertInvalid(
+            _site([{"action": "click", "element": {"by": "id", "value": "a", "multiple": True}}]),
+            "multiple elements need a match text",
+        )
+
+    def test_invalid_values(self):
+        self.assertInvalid(_site([{"action": "sleep"}]), "missing value")
+        self.assertInvalid(_site([{"action": "sleep", "value": -1}]), "value must be a number of seconds")
+        self.assertInvalid(_site([{"action": "keys", "element": {"by": "id", "value": "a"}}]), "missing value")
+        self.assertInvalid(
+            _site([{"action": "delay", "element": {"by": "id", "value": "a", "condition": "gone"}, "value": 1}]),
+            "unknown condition 'gone'",
+        )
+        self.assertInvalid(
+            _site([{"action": "navigate_frame", "element": {"index": "0"}}]), "frame index must be an integer"
+        )
+
+    def test_invalid_site(self):
+        self.assertInvalid({"url": "https://www.example.com", "flow": []}, "site without flow_type")
+        self.assertInvalid(_site([], url="example"), "url without hostname")
+        self.assertInvalid(_site({"action": "sleep"}), "flow must be a list of steps")
+
+    def test_blocked_urls(self):
+        site = _site([], block_resources=["font", "*://i.ytimg.com/*.jpg", "*tracker*.gif"])
+        triki.compile_flow(site, self.params)
+        self.assertEqual(
+            site["blocked_urls"],
+            triki.RESOURCE_PATTERNS["font"] + ["*://i.ytimg.com/*.jpg", "*tracker*.gif"],
+        )
+
+    def test_blocked_urls_never_block_cookie_setters(self):
+        for resource, message in [
+            ("script", "script can set cookies"),
+            ("*://*/*", "blocks every url"),
+            ("*", "blocks every url"),
+            ("https://www.example.com*", "blocks the site itself"),
+            ("*.js", "may block documents, scripts or requests"),
+            ("*tracker*", "may block documents, scripts or requests"),
+            ("*://*.youtube.com/*", "may block documents, scripts or requests"),
+            ("*/collect?*", "may block documents, scripts or requests"),
+        ]:
+            with self.subTest(resource=resource):
+                self.assertInvalid(_site([], block_resources=[resource]), message)
+
+    def test_compile_sites_rejects_invalid_flows(self):
+        sites = [_site([{"action": "sleep", "value": 1}]), _site([{"action": "scroll"}])]
+        with self.assertLogs(level="ERROR") as logs, self.assertRaises(ValueError):
+            triki.compile_sites(sites, self.params)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("steps", sites[0])
+
+    def test_compile_sites_consumes_iterators(self):
+        sites = (_site([{"action": "sleep", "value": seconds}]) for seconds in (1, 2))
+        compiled = triki.compile_sites(sites, self.params)
+        self.assertEqual([site["steps"][0][1] for site in compiled], [(1,), (2,)])
+
+
+if __name__ == "__main__":
+    unittest.main()
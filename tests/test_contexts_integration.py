@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from shutil import which
+from unittest import mock
+
+import triki
+import triki_cdp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmark"))
+import triki_benchmark  # noqa: E402
+
+
+def _chrome_available():
+    try:
+        triki_cdp._chrome_binary()
+    except FileNotFoundError:
+        return False
+    return bool(which("chromedriver"))
+
+
+@unittest.skipUnless(_chrome_available(), "chrome and chromedriver are needed to run the flows")
+class ContextsIntegrationTest(unittest.TestCase):
+    """
+    The synthetic sites of the benchmark visited with selenium and in
+    browser contexts set the same cookies
+    """
+
+    def setUp(self):
+        self.server = triki_benchmark.start_server()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.sites = triki_benchmark.benchmark_sites(self.server.server_port, 2, 1)
+
+    def run_flows(self, *args):
+        data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_path)
+        params = triki._arg_parser().parse_args(["--headless", "--sink", "jsonl"] + list(args))
+        params.results_path = os.path.join(data_path, "results.jsonl")
+        sites = [dict(site) for site in self.sites]
+        with mock.patch.object(triki, "DATA_PATH", data_path), mock.patch.object(
+            triki, "SCREENSHOTS_PATH", os.path.join(data_path, "screenshots")
+        ):
+            if params.contexts:
+                results = triki_cdp.run_contexts(triki.compile_sites(sites, params), "20261016", params)
+                triki.close_result_sink()
+                errors = [error for _, _, error, _ in results if error]
+            else:
+                rows = triki_benchmark.run_benchmark(sites, params, data_path, "20261016")
+                errors = [row["error"] for row in rows if row["error"]]
+        shutil.rmtree(triki.PROFILE_PATH, ignore_errors=True)
+        self.assertEqual(errors, [])
+        cookies = {}
+        with open(params.results_path, encoding="utf8") as f:
+            for record in map(json.loads, f):
+                names = {(cookie[0], cookie[1]) for cookie in record["cookies"]}
+                cookies[(record["site_url"], record["flow_type"])] = names
+        return cookies
+
+    def test_same_cookies_in_both_modes(self):
+        selenium_cookies = self.run_flows()
+        self.assertEqual(len(selenium_cookies), len(self.sites))
+        self.assertEqual(self.run_flows("--contexts", "2"), selenium_cookies)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import triki
+import triki_cookies
+
+triki_database = triki._triki_database()
+
+DATES = ["20261014", "20261015", "20261016"]
+STATS = [2, 1, 365, 182, 1, 1, 1, 0, 0]
+
+
+def _cookies(date, visit_seconds):
+    """
+    A session cookie and a persistent one renewed for a year on every visit
+    """
+    visit = triki_cookies.chrome_time(triki_cookies.arrow.get(date, "YYYYMMDD").shift(seconds=visit_seconds))
+    return [
+        [".example.com", "session", "1", "/", 0, 1, 1, 0, 0, 1, 0, 2],
+        [".example.com", "_ga", "GA1", "/", visit + 365 * triki_cookies.MICROSECONDS_PER_DAY + 1234, 1, 0, 1, 1, 1, 0, 2],
+    ]
+
+
+class DeltaLogTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "cookies_accept_www_example_com.jsonl")
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.snapshots = [
+            (date, _cookies(date, visit_seconds)) for date, visit_seconds in zip(DATES, (3600, 50000, 80123))
+        ]
+
+    def append(self, date, cookies):
+        snapshot = {"url": "www.example.com", "date": date, "flow_type": "accept", "site_url": "https://www.example.com"}
+        return triki_database.append_delta_log(self.path, snapshot, cookies, STATS)
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return [(snapshot["date"], rows) for snapshot, rows in triki_database.read_delta_log(f)]
+
+    def test_exact_expirations(self):
+        for date, cookies in self.snapshots:
+            self.append(date, cookies)
+        self.assertEqual(self.read(), self.snapshots)
+        with open(self.path, "rb") as f:
+            lines = [json.loads(line) for line in f]
+        # The renewed cookie is the same record with another offset
+        self.assertEqual([len(line["records"]) for line in lines], [2, 0, 0])
+        self.assertEqual([len(line["offsets"]) for line in lines], [1, 1, 1])
+
+    def test_appends_do_not_replay_the_log(self):
+        self.append(*self.snapshots[0])
+        with mock.patch.object(triki_database, "_replay_delta_log", side_effect=AssertionError("replayed")):
+            for date, cookies in self.snapshots[1:]:
+                self.append(date, cookies)
+        self.assertEqual(self.read(), self.snapshots)
+
+    def test_state_is_rebuilt_when_stale(self):
+        self.append(*self.snapshots[0])
+        os.remove(self.path + triki_database.DELTA_STATE_SUFFIX)
+        self.append(*self.snapshots[1])
+        # The state of another copy of the log
+        with open(self.path + triki_database.DELTA_STATE_SUFFIX, "w") as f:
+            f.write('{"size": 1, "records": [], "keys": {}}')
+        self.append(*self.snapshots[2])
+        self.assertEqual(self.read(), self.snapshots)
+        with open(self.path, "rb") as f:
+            self.assertEqual([len(line["records"]) for line in map(json.loads, f)], [2, 0, 0])
+
+    def test_partial_line_is_dropped(self):
+        self.append(*self.snapshots[0])
+        # A flow killed while appending the second snapshot
+        with open(self.path, "a") as f:
+            f.write('{"url": "www.example.com", "date": "2026')
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.read(), self.snapshots[:1])
+        for date, cookies in self.snapshots[1:]:
+            self.append(date, cookies)
+        self.assertEqual(self.read(), self.snapshots)
+
+    def test_import_rolls_back_invalid_log(self):
+        self.append(*self.snapshots[0])
+        # A line of another version of triki without stats
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"url": "www.example.com", "date": DATES[1], "flow_type": "accept",
+                                "records": {}, "added": [], "removed": [], "offsets": {}}) + "\n")
+        conn = sqlite3.connect(":memory:")
+        self.addCleanup(conn.close)
+        triki_database._create_database(conn, delta=True)
+        with self.assertRaises(KeyError):
+            triki_database._import_delta_log(conn, self.path, {}, rollups=False)
+        self.assertEqual(conn.execute("SELECT count(*) FROM cookie_records").fetchone(), (0,))
+        self.assertFalse(conn.in_transaction)
+
+
+class DeltaDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.addCleanup(self.conn.close)
+        triki_database._create_database(self.conn, delta=True)
+
+    def save(self, date, cookies):
+        attributes_rows = triki_database.flow_attributes("www.example.com", date, "accept")
+        triki_database.save_flow(self.conn, attributes_rows, cookies, STATS, rollups=False)
+
+    def snapshot(self, date):
+        return [
+            list(row)
+            for row in self.conn.execute(
+                "SELECT host, name, value, path, expires_utc, is_secure, is_httponly, has_expires,"
+                " is_persistent, priority, samesite, source_scheme FROM cookies WHERE date = ? ORDER BY name DESC",
+                (date,),
+            )
+        ]
+
+    def test_exact_expirations(self):
+        snapshots = [(date, _cookies(date, visit_seconds)) for date, visit_seconds in zip(DATES, (3600, 50000, 80123))]
+        for date, cookies in snapshots:
+            self.save(date, cookies)
+        for date, cookies in snapshots:
+            self.assertEqual(self.snapshot(date), cookies)
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM cookie_records").fetchone(), (2,))
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM cookie_ranges").fetchone(), (2,))
+
+    def test_replaced_snapshot(self):
+        self.save(DATES[0], _cookies(DATES[0], 3600))
+        self.save(DATES[0], _cookies(DATES[0], 7200))
+        self.assertEqual(self.snapshot(DATES[0]), _cookies(DATES[0], 7200))
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM cookie_expires").fetchone(), (1,))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from selenium.common.exceptions import StaleElementReferenceException
+
+import triki
+
+
+class FakeElement:
+    def __init__(self, text):
+        self.label = text
+        self.stale = False
+
+    @property
+    def text(self):
+        if self.stale:
+            raise StaleElementReferenceException("stale element reference")
+        return self.label
+
+
+class FakeDriver:
+    def __init__(self, elements):
+        self.elements = elements
+        self.lookups = 0
+
+    def execute_script(self, script, by, value, match):
+        self.lookups += 1
+        for element in self.elements:
+            if match in element.label.lower():
+                return element
+        return None
+
+    def find_element(self, by, value):
+        self.lookups += 1
+        return self.elements[0]
+
+
+class ElementCacheTest(unittest.TestCase):
+    def setUp(self):
+        triki.clear_element_cache()
+        self.addCleanup(triki.clear_element_cache)
+        self.accept = {"by": "tag name", "value": "button", "multiple": True, "match": "Accept"}
+
+    def test_cached_element_is_reused(self):
+        button = FakeElement("Accept all")
+        driver = FakeDriver([button])
+        self.assertIs(triki._locate_element(driver, self.accept), button)
+        self.assertIs(triki._locate_element(driver, self.accept), button)
+        self.assertEqual(driver.lookups, 1)
+
+    def test_relabeled_element_is_located_again(self):
+        first, second = FakeElement("Accept all"), FakeElement("Reject")
+        driver = FakeDriver([first, second])
+        self.assertIs(triki._locate_element(driver, self.accept), first)
+        # The banner switched panes, relabeling its buttons in place
+        first.label, second.label = "Settings", "Accept selected"
+        self.assertIs(triki._locate_element(driver, self.accept), second)
+
+    def test_stale_element_is_located_again(self):
+        first = FakeElement("Accept all")
+        driver = FakeDriver([first])
+        triki._locate_element(driver, self.accept)
+        first.stale = True
+        driver.elements = [FakeElement("Accept all")]
+        self.assertIs(triki._locate_element(driver, self.accept), driver.elements[0])
+
+    def test_single_locators_are_cached(self):
+        driver = FakeDriver([FakeElement("Accept")])
+        el = {"by": "id", "value": "accept"}
+        triki._locate_element(driver, el)
+        triki._locate_element(driver, el)
+        self.assertEqual(driver.lookups, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+import triki
+
+
+class MissingElementDriver:
+    def find_element(self, by, value):
+        raise NoSuchElementException("Unable to locate element: %s" % value)
+
+
+class FlowErrorsTest(unittest.TestCase):
+    def test_delay_timeout_is_deterministic(self):
+        with self.assertRaises(NoSuchElementException) as raised:
+            triki.delay(MissingElementDriver(), {"by": "id", "value": "banner"}, 0)
+        self.assertFalse(triki._is_transient(raised.exception))
+
+    def test_browser_errors_are_transient(self):
+        self.assertTrue(triki._is_transient(WebDriverException("chrome not reachable")))
+        self.assertTrue(triki._is_transient(ConnectionRefusedError()))
+        self.assertFalse(triki._is_transient(KeyError("url")))
+
+
+class FakePool:
+    """
+    Runs the flows when submitted, the first pool breaks as if a worker
+    was killed
+    """
+
+    pools = []
+
+    def __init__(self):
+        self.broken = not self.pools
+        self.pools.append(self)
+        self.shutdown_calls = 0
+
+    def submit(self, function, site, today, params, attempt):
+        if self.broken and len(self.pools) > 1:
+            raise BrokenProcessPool("submitted to a broken pool")
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        else:
+            future.set_result((site["url"], site["flow_type"], None, None))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shutdown_calls += 1
+
+
+class BrokenPoolTest(unittest.TestCase):
+    def setUp(self):
+        FakePool.pools = []
+        self.params = triki._arg_parser().parse_args(["--workers", "2", "--retry-backoff", "0"])
+        patcher = mock.patch.object(triki, "_worker_pool", side_effect=lambda params, handlers: (FakePool(), mock.Mock()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.journal = mock.patch.object(triki, "record_journal").start()
+        self.addCleanup(mock.patch.stopall)
+        self.sites = [
+            {"url": "https://www.example.com", "flow_type": "accept"},
+            {"url": "https://www.example.org", "flow_type": "accept"},
+        ]
+
+    def test_flows_of_a_broken_pool_are_retried(self):
+        results = triki._run_parallel(self.sites, "20261016", self.params, [])
+        self.assertEqual(len(FakePool.pools), 2)
+        self.assertEqual(FakePool.pools[0].shutdown_calls, 1)
+        self.assertEqual(sorted(results), [(site["url"], "accept", None, None) for site in self.sites])
+
+    def test_lost_flows_are_not_journaled(self):
+        self.params.retries = 0
+        results = triki._run_parallel(self.sites, "20261016", self.params, [])
+        self.assertEqual([error[:18] for _, _, error, _ in results], ["BrokenProcessPool("] * 2)
+        self.journal.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import struct
+import unittest
+import zlib
+
+import triki
+
+
+def _chunk(kind, data):
+    return struct.pack("!I4s", len(data), kind) + data + struct.pack("!I", zlib.crc32(kind + data))
+
+
+def _png(width=64, height=64):
+    header = struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    rows = b"".join(b"\x00" + b"\x10\x20\x30" * width for _ in range(height))
+    return (
+        triki.PNG_SIGNATURE
+        + _chunk(b"IHDR", header)
+        + _chunk(b"IDAT", zlib.compress(rows, 0))
+        + _chunk(b"IEND", b"")
+    )
+
+
+class RecompressPngTest(unittest.TestCase):
+    def test_recompress(self):
+        png = _png()
+        recompressed = triki._recompress_png(png)
+        self.assertLess(len(recompressed), len(png))
+        self.assertTrue(recompressed.startswith(triki.PNG_SIGNATURE + _chunk(b"IHDR", png[16:29])))
+        self.assertTrue(recompressed.endswith(_chunk(b"IEND", b"")))
+
+    def test_truncated_png_is_kept(self):
+        png = _png()
+        for length in (len(png) - 1, len(png) - 20, len(triki.PNG_SIGNATURE) + 5, 40):
+            with self.subTest(length=length):
+                self.assertEqual(triki._recompress_png(png[:length]), png[:length])
+
+    def test_not_a_png_is_kept(self):
+        self.assertEqual(triki._recompress_png(b"GIF89a"), b"GIF89a")
+        self.assertEqual(triki._recompress_png(b""), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import unittest
+
+import triki
+import triki_cdp
+
+
+def _site(flow):
+    return {"url": "https://www.example.com", "flow_type": "accept", "flow": flow}
+
+
+class CompileStepsTest(unittest.TestCase):
+    def setUp(self):
+        self.params = triki._arg_parser().parse_args([])
+
+    def test_every_action_runs_in_contexts(self):
+        el = {"by": "id", "value": "banner"}
+        flow = [
+            {"action": "screenshot", "element": el},
+            {"action": "navigate_frame", "element": {"index": 0}},
+            {"action": "click", "element": el},
+            {"action": "delay", "element": el, "value": 1},
+            {"action": "sleep", "value": 1},
+            {"action": "keys", "element": el, "value": "text"},
+            {"action": "submit", "element": el},
+            {"action": "settle", "value": 1},
+        ]
+        self.assertEqual(
+            sorted({step["action"] for step in flow}), sorted(triki.TRIKI_AVAILABLE_ACTIONS)
+        )
+        steps = triki_cdp.compile_steps(triki.compile_flow(_site(flow), self.params))
+        self.assertEqual(
+            [(function, args) for function, args, _ in steps],
+            [
+                (triki_cdp._screenshot_step, (el, None, False)),
+                (triki_cdp._element_step, (triki_cdp.navigate_frame, {"index": 0})),
+                (triki_cdp._element_step, (triki_cdp.click, el)),
+                (triki_cdp._value_step, (triki_cdp.delay, el, 1)),
+                (triki_cdp._sleep_step, (1,)),
+                (triki_cdp._value_step, (triki_cdp.keys, el, "text")),
+                (triki_cdp._element_step, (triki_cdp.submit, el)),
+                (triki_cdp._settle_step, (1, triki.SETTLE_QUIET_SECONDS)),
+            ],
+        )
+        for function, _, _ in steps:
+            self.assertTrue(asyncio.iscoroutinefunction(function))
+
+    def test_unsupported_step(self):
+        def _scroll_step(driver, site_path, value):
+            pass
+
+        with self.assertRaises(ValueError) as raised:
+            triki_cdp.compile_steps([(_scroll_step, (1,), {"action": "scroll"})])
+        self.assertIn("step 1: scroll is not supported", str(raised.exception))
+        with self.assertRaises(ValueError):
+            triki_cdp.compile_steps([(triki._element_step, (print, None), {"action": "print"})])
+
+
+class RunBlockingTest(unittest.TestCase):
+    def test_runs_outside_the_event_loop(self):
+        async def main():
+            thread = await triki_cdp.run_blocking(threading.get_ident)
+            await triki_cdp.close_io_executor()
+            return thread
+
+        self.assertNotEqual(asyncio.run(main()), threading.get_ident())
+        self.assertEqual(triki_cdp.IO_EXECUTOR, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
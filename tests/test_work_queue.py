@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import triki
+
+DATE = "20261016"
+
+
+def _site(url, flow_type="accept"):
+    return {"url": url, "flow_type": flow_type, "flow": [{"action": "sleep", "value": 1}]}
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "queue.db")
+        self.sites = [
+            _site("https://www.example.com"),
+            _site("https://www.example.com", "reject"),
+            _site("https://www.example.org"),
+        ]
+        self.now = 1000.0
+        patcher = mock.patch("triki.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+        shutil.rmtree(self.folder)
+
+    def open_queue(self, date=DATE):
+        conn, date = triki.open_work_queue(self.path, self.sites, date)
+        self.connections.append(conn)
+        return conn, date
+
+    def test_starts_sweep_with_every_flow(self):
+        conn, date = self.open_queue()
+        self.assertEqual(date, DATE)
+        rows = conn.execute("SELECT host, state, attempts FROM work ORDER BY position").fetchall()
+        self.assertEqual(
+            rows,
+            [("www.example.com", "pending", 0), ("www.example.com", "pending", 0), ("www.example.org", "pending", 0)],
+        )
+        key, site, attempt = triki.lease_flow(conn, DATE, "a", 3)
+        self.assertEqual(key, triki._journal_key(self.sites[0], DATE))
+        self.assertEqual(site, {key: value for key, value in self.sites[0].items() if key != "steps"})
+        self.assertEqual(attempt, 1)
+
+    def test_one_lease_per_host(self):
+        conn, _ = self.open_queue()
+        first = triki.lease_flow(conn, DATE, "a", 3)
+        second = triki.lease_flow(conn, DATE, "b", 3)
+        # The reject flow of example.com waits for the accept one
+        self.assertEqual(second[1]["url"], "https://www.example.org")
+        self.assertIsNone(triki.lease_flow(conn, DATE, "b", 3))
+        triki.complete_flow(conn, first[0], "a", (first[1]["url"], "accept", None, None), None)
+        third = triki.lease_flow(conn, DATE, "b", 3)
+        self.assertEqual((third[1]["url"], third[1]["flow_type"]), ("https://www.example.com", "reject"))
+
+    def test_expired_lease_is_leased_by_another_node(self):
+        conn, _ = self.open_queue()
+        key, _, _ = triki.lease_flow(conn, DATE, "a", 3)
+        self.now += triki.LEASE_SECONDS - 1
+        self.assertNotEqual(triki.lease_flow(conn, DATE, "b", 3)[0], key)
+        # Node a died without heartbeats
+        self.now += 2
+        leased = triki.lease_flow(conn, DATE, "b", 3)
+        self.assertEqual((leased[0], leased[2]), (key, 2))
+        # Node a can not complete a flow it lost
+        triki.complete_flow(conn, key, "a", ("", "", None, None), None)
+        self.assertEqual(conn.execute("SELECT state, node FROM work WHERE key = ?", (key,)).fetchone(), ("leased", "b"))
+
+    def test_heartbeat_keeps_lease(self):
+        conn, _ = self.open_queue()
+        key, _, _ = triki.lease_flow(conn, DATE, "a", 3)
+        self.now += triki.LEASE_SECONDS - 1
+        conn.execute(triki.QUERY_HEARTBEAT, (self.now + triki.LEASE_SECONDS, "a"))
+        self.now += 2
+        self.assertNotEqual(triki.lease_flow(conn, DATE, "b", 3)[0], key)
+
+    def test_expired_lease_without_attempts_fails(self):
+        conn, _ = self.open_queue()
+        key, _, _ = triki.lease_flow(conn, DATE, "a", 1)
+        self.now += triki.LEASE_SECONDS + 1
+        self.assertNotEqual(triki.lease_flow(conn, DATE, "b", 1)[0], key)
+        self.assertEqual(conn.execute("SELECT state FROM work WHERE key = ?", (key,)).fetchone(), ("failed",))
+
+    def test_release_on_interrupt(self):
+        conn, _ = self.open_queue()
+        leased = [triki.lease_flow(conn, DATE, "a", 3)[0], triki.lease_flow(conn, DATE, "a", 3)[0]]
+        conn.execute(triki.QUERY_RELEASE_WORK, ("a",))
+        self.assertEqual(
+            conn.execute("SELECT state, attempts, lease_until FROM work WHERE key IN (?, ?)", leased).fetchall(),
+            [("pending", 0, None), ("pending", 0, None)],
+        )
+        key, _, attempt = triki.lease_flow(conn, DATE, "b", 3)
+        self.assertEqual((key, attempt), (leased[0], 1))
+
+    def test_retry_after_backoff(self):
+        conn, _ = self.open_queue()
+        key, site, _ = triki.lease_flow(conn, DATE, "a", 3)
+        triki.complete_flow(conn, key, "a", (site["url"], "accept", "WebDriverException()", None), 30)
+        # Other flows of the site go on during the backoff
+        other, site, _ = triki.lease_flow(conn, DATE, "a", 3)
+        self.assertNotEqual(other, key)
+        triki.complete_flow(conn, other, "a", (site["url"], "reject", None, None), None)
+        self.now += 31
+        key_attempt = triki.lease_flow(conn, DATE, "a", 3)
+        self.assertEqual((key_attempt[0], key_attempt[2]), (key, 2))
+
+    def test_join_unfinished_sweep(self):
+        self.open_queue()
+        conn, date = self.open_queue("20261017")
+        self.assertEqual(date, DATE)
+        self.assertEqual(conn.execute("SELECT count(*) FROM work").fetchone(), (3,))
+        self.assertEqual(conn.execute("SELECT date FROM sweeps").fetchall(), [(DATE,)])
+
+    def test_finish_sweep(self):
+        conn, _ = self.open_queue()
+        leased = triki.lease_flow(conn, DATE, "a", 3)
+        while leased:
+            self.assertFalse(triki.finish_sweep(conn, DATE))
+            triki.complete_flow(conn, leased[0], "a", (leased[1]["url"], "", None, None), None)
+            leased = triki.lease_flow(conn, DATE, "a", 3)
+        self.assertTrue(triki.finish_sweep(conn, DATE))
+        # The finished sweep is not run again, the next date starts another
+        self.assertIsNone(self.open_queue()[1])
+        self.assertEqual(self.open_queue("20261017")[1], "20261017")
+
+
+if __name__ == "__main__":
+    unittest.main()
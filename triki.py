@@ -5,57 +5,263 @@
    cookies created during the visit and creating statistics around them.
    It also screenshots the site and some of its important elements
    regarding cookies."""
+import argparse
+import atexit
 import csv
+import fnmatch
+import glob
+import hashlib
+import heapq
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
 import os
 import platform
+import signal
 import sqlite3
+import struct
+import subprocess
 import sys
-from collections import Counter
-from shutil import rmtree
-from time import sleep
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import (FIRST_COMPLETED, BrokenExecutor,
+                                ProcessPoolExecutor, wait)
+from contextlib import contextmanager
+from io import BytesIO
+from queue import Queue
+from shutil import copyfile, rmtree, which
+from time import monotonic, sleep, time
 from urllib.parse import urlparse
 
 import arrow
-import yaml
 from selenium.common.exceptions import (ElementClickInterceptedException,
+                                        InvalidSelectorException,
                                         NoSuchElementException,
-                                        TimeoutException)
+                                        NoSuchFrameException,
+                                        StaleElementReferenceException,
+                                        TimeoutException, WebDriverException)
 from selenium.webdriver import Chrome, ChromeOptions
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+from triki_config import iter_sites
+from triki_cookies import (CHROME_EPOCH_OFFSET, HEADER_COOKIES, HEADER_STATS,
+                           _add_cookie_stats, _cookie_stats_result,
+                           _new_cookie_stats)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, shared caches need file locks
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:
+    # Thumbnails of the screenshots need Pillow
+    Image = None
 
-# from PIL import Image
 CWD = os.path.dirname(__file__)
 DATA_PATH = os.path.join(CWD, "data")
-CONFIG_PATH = os.path.join(CWD, "config")
+ANALYSIS_PATH = os.path.join(CWD, "analysis")
 PROFILE_PATH = os.path.abspath(os.path.join(CWD, "profile"))
-HEADER_COOKIES = [
-    "host_key",
-    "name",
-    "value",
-    "path",
-    "expires_utc",
-    "is_secure",
-    "is_httponly",
-    "has_expires",
-    "is_persistent",
-    "priority",
-    "samesite",
-    "source_scheme",
+# HTTP caches shared by the flows of each site, outside of their profiles
+CACHE_PATH = os.path.abspath(os.path.join(CWD, "cache"))
+# Seconds waiting for chrome to exit before handing its cache to other flows
+CACHE_RELEASE_SECONDS = 10
+# Prefix used by each parallel worker to build its own isolated profile
+WORKER_PROFILE_PREFIX = "%s_worker_" % PROFILE_PATH
+# Chrome cookies sqlite encoding of the DevTools protocol cookie enums
+CDP_SAMESITE = {"None": 0, "Lax": 1, "Strict": 2}
+CDP_PRIORITY = {"Low": 0, "Medium": 1, "High": 2}
+CDP_SOURCE_SCHEME = {"Unset": 0, "NonSecure": 1, "Secure": 2}
+
+# Sink where this process stores flow results when not using csv files
+RESULT_SINK = {}
+
+# Warm browsers kept alive by this process keyed by their chrome prefs
+BROWSER_POOL = OrderedDict()
+# Origins contacted by each browser session, collected from its performance log
+VISITED_ORIGINS = {}
+
+# Settle waits: seconds without network or cookie activity to consider the
+# site settled, polling interval and in flight requests tolerated (long polls)
+SETTLE_QUIET_SECONDS = 3
+SETTLE_POLL_SECONDS = 0.5
+SETTLE_MAX_INFLIGHT = 2
+
+# Timings of the flow being processed by this process: seconds per phase
+# (excluding nested phases) and per step. Phases not timed are "other".
+FLOW_TIMINGS = {}
+TIMING_STACK = []
+TIMING_PHASES = ["profile", "launch", "load", "steps", "cookies", "export", "reset", "close"]
+SLOWEST_FLOWS = 5
+# Journal of the flows completed by the current run, see open_journal
+RUN_JOURNAL = {}
+# Site options that change the outcome of a flow (see _site_prefs)
+SITE_OPTIONS = [
+    "language",
+    "block_all_cookies",
+    "block_third_party_cookies",
+    "enable_do_not_track",
+    "blocked_urls",
 ]
-HEADER_STATS = [
-    "url",
-    "total",
-    "session",
-    "max_exp_days",
-    "avg_exp_days",
-    "secure_flag",
-    "httponly_flag",
-    "samesite_none_flag",
-    "samesite_lax_flag",
-    "samesite_strict_flag",
+# Adaptive concurrency (--adaptive): seconds between adjustments, free
+# memory needed to start one more browser and below which browsers are
+# halved, cpu load per core to grow and to shrink, and the slowdown of
+# launches and page loads (over the best seen) taken as thrashing
+ADAPTIVE_INTERVAL = 5
+ADAPTIVE_FLOW_MB = 600
+ADAPTIVE_MIN_MB = 512
+ADAPTIVE_SCALE_UP_LOAD = 0.7
+ADAPTIVE_MAX_LOAD = 1.0
+ADAPTIVE_SLOWDOWN = 1.5
+ADAPTIVE_WINDOW = 10
+# Work queue shared by the nodes of a sweep (--queue): seconds a leased
+# flow belongs to its node without heartbeats, seconds between heartbeats
+# and between polls of a node waiting for flows leased by other nodes
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+QUEUE_POLL_SECONDS = 10
+QUERY_CREATE_QUEUE = [
+    """CREATE TABLE IF NOT EXISTS sweeps (
+        date TEXT PRIMARY KEY,
+        started TEXT NOT NULL,
+        finished TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS work (
+        key TEXT PRIMARY KEY,
+        date TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        host TEXT NOT NULL,
+        site TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        node TEXT,
+        lease_until REAL,
+        not_before REAL NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS work_state ON work(date, state, position)",
 ]
+QUERY_INSERT_WORK = """INSERT OR IGNORE INTO work(key, date, position, host, site)
+                       VALUES(?, ?, ?, ?, ?)"""
+# Flows of a dead node (lease expired) that used every attempt
+QUERY_EXPIRE_WORK = """UPDATE work SET state = 'failed', error = ?
+                       WHERE date = ? AND state = 'leased' AND lease_until < ? AND attempts >= ?"""
+# First flow due or abandoned by a dead node whose site is not being
+# visited by any node
+QUERY_NEXT_WORK = """SELECT key, site, attempts FROM work
+                     WHERE date = ? AND ((state = 'pending' AND not_before <= ?)
+                                         OR (state = 'leased' AND lease_until < ?))
+                       AND host NOT IN (SELECT host FROM work
+                                        WHERE date = ? AND state = 'leased' AND lease_until >= ?)
+                     ORDER BY position LIMIT 1"""
+QUERY_LEASE_WORK = """UPDATE work SET state = 'leased', node = ?, lease_until = ?, attempts = attempts + 1
+                      WHERE key = ?"""
+QUERY_RELEASE_WORK = """UPDATE work SET state = 'pending', lease_until = NULL, attempts = attempts - 1
+                        WHERE node = ? AND state = 'leased'"""
+QUERY_HEARTBEAT = "UPDATE work SET lease_until = ? WHERE node = ? AND state = 'leased'"
+QUERY_COMPLETE_WORK = """UPDATE work SET state = ?, error = ?, lease_until = NULL
+                         WHERE key = ? AND node = ? AND state = 'leased'"""
+QUERY_RETRY_WORK = """UPDATE work SET state = 'pending', not_before = ?, error = ?, lease_until = NULL
+                      WHERE key = ? AND node = ? AND state = 'leased'"""
+# Screenshots are stored once by their content and linked from the folders
+# of the flows that took them, see store_screenshot
+SCREENSHOTS_PATH = os.path.abspath(os.path.join(CWD, "screenshots"))
+THUMBNAIL_SIZE = (480, 270)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Writer thread of this process storing screenshots while flows go on,
+# flows wait for it only if this many screenshots are pending
+SCREENSHOT_WRITER = {}
+SCREENSHOT_QUEUE_SIZE = 32
+# Shared cache locked by the flow being processed by this process
+SITE_CACHE = {}
+# Browser of the flow being processed and whether its deadline expired
+FLOW_WATCHDOG = {}
+# Errors that will happen again if the flow is retried (the site changed,
+# the flow is wrong), any other browser or connection error is retried
+DETERMINISTIC_ERRORS = (
+    NoSuchElementException,
+    NoSuchFrameException,
+    InvalidSelectorException,
+    KeyError,
+    TypeError,
+    ValueError,
+)
+TRANSIENT_ERRORS = (WebDriverException, OSError, Urllib3HTTPError)
+HEADER_FAILED = ["url", "flow_type", "attempts", "transient", "error"]
+# Elements located during the current flow keyed by their locator
+ELEMENT_CACHE = {}
+# Selenium locator strategies accepted in the configuration
+LOCATOR_STRATEGIES = [
+    "id",
+    "xpath",
+    "link text",
+    "partial link text",
+    "name",
+    "tag name",
+    "class name",
+    "css selector",
+]
+DELAY_CONDITIONS = {
+    "element_to_be_clickable": EC.element_to_be_clickable,
+    "presence_of_element_located": EC.presence_of_element_located,
+    "visibility_of_element_located": EC.visibility_of_element_located,
+}
+# Resource types that can be blocked during flows as url patterns of static
+# files: urls with a query string (tracking pixels) are not matched. Scripts,
+# stylesheets, documents and requests set cookies or render the banner.
+RESOURCE_PATTERNS = {
+    "image": ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico"],
+    "font": ["*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot"],
+    "media": ["*.mp4", "*.webm", "*.ogg", "*.ogv", "*.mp3", "*.wav", "*.m3u8", "*.mov"],
+}
+NEVER_BLOCKED = ["document", "script", "stylesheet", "xhr", "fetch", "websocket"]
+# Endings of the urls of those resources, url patterns of the configuration
+# must not match any of them
+NEVER_BLOCKED_ENDINGS = ["/", ".js", ".mjs", ".html", ".htm", ".php", ".asp", ".aspx", ".jsp", ".json", ".css"]
+# Keys accepted in flow steps and their elements, anything else is a typo
+STEP_KEYS = ["action", "element", "value", "filename", "quiet"]
+ELEMENT_KEYS = ["by", "value", "multiple", "match", "javascript", "condition", "index"]
+# Browser side equivalent of find_elements plus the match over the element
+# text, hidden elements have no text for selenium
+LOCATE_ELEMENT_SCRIPT = """
+var by = arguments[0], value = arguments[1], match = arguments[2];
+var nodes;
+if (by === "css selector") {
+    nodes = document.querySelectorAll(value);
+} else if (by === "id") {
+    nodes = document.querySelectorAll("#" + CSS.escape(value));
+} else if (by === "name") {
+    nodes = document.querySelectorAll("[name='" + CSS.escape(value) + "']");
+} else if (by === "class name") {
+    nodes = document.getElementsByClassName(value);
+} else if (by === "tag name") {
+    nodes = document.getElementsByTagName(value);
+} else if (by === "xpath") {
+    var snapshot = document.evaluate(
+        value, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    nodes = [];
+    for (var i = 0; i < snapshot.snapshotLength; i++) {
+        nodes.push(snapshot.snapshotItem(i));
+    }
+} else {
+    return null;
+}
+for (var j = 0; j < nodes.length; j++) {
+    var node = nodes[j];
+    var text = node.getClientRects().length ? (node.innerText || "") : "";
+    if (text.toLowerCase().indexOf(match) !== -1) {
+        return node;
+    }
+}
+return null;
+"""
 
 LOG = logging.getLogger()
 
@@ -71,60 +277,134 @@ def _set_logging():
         handlers.append(logging.FileHandler("triki.log"))
     logging.basicConfig(
         level=log_level,
-        format="%(asctime)-15s %(levelname)s: %(message)s",
+        format="%(asctime)-15s %(processName)s %(levelname)s: %(message)s",
         handlers=handlers,
     )
+    return LOG.handlers
+
+
+def _worker_init(log_queue, log_level):
+    """
+    Setup a parallel worker process: logs are forwarded to the parent
+    process through a queue and the chrome profile is private to the worker
+    """
+    global PROFILE_PATH
+    PROFILE_PATH = "%s%s" % (WORKER_PROFILE_PREFIX, os.getpid())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(log_level)
+    # Pool workers do not run atexit hooks, close warm browsers on finalize
+    multiprocessing.util.Finalize(None, close_browser_pool, exitpriority=10)
+    multiprocessing.util.Finalize(None, close_result_sink, exitpriority=10)
+    multiprocessing.util.Finalize(None, close_screenshot_writer, exitpriority=10)
 
 
 def _config():
     """
-    read sites configuration and accept and reject flows for cookie extraction
+    read sites configuration and accept and reject flows for cookie extraction,
+    files are parsed as the sites are consumed
     """
-    config = None
+
+    def sites():
+        try:
+            yield from iter_sites()
+        except Exception as e:
+            LOG.error("Could not load triki configuration: %s", e)
+            raise e
+
+    return {"sites": sites()}
+
+
+def start_timings():
+    """
+    Start timing a new flow in this process
+    """
+    FLOW_TIMINGS.clear()
+    FLOW_TIMINGS.update({"phases": {}, "steps": []})
+    del TIMING_STACK[:]
+
+
+@contextmanager
+def timed(phase):
+    """
+    Account the time spent in the block to phase, time spent in nested
+    phases is only accounted to them
+    """
+    frame = [monotonic(), 0]
+    TIMING_STACK.append(frame)
     try:
-        with open("%s/sites.yaml" % CONFIG_PATH, "r", encoding="utf8") as f:
-            config = yaml.load(f, Loader=yaml.FullLoader)
-    except Exception as e:
-        LOG.error("Could not load triki configuration: %s", e)
-        raise e
-    return config
+        yield
+    finally:
+        TIMING_STACK.pop()
+        elapsed = monotonic() - frame[0]
+        phases = FLOW_TIMINGS.setdefault("phases", {})
+        phases[phase] = phases.get(phase, 0) + elapsed - frame[1]
+        if TIMING_STACK:
+            TIMING_STACK[-1][1] += elapsed
 
 
-def _get_duration_in_days(expires_utc):
+def timed_iter(phase, iterable):
     """
-    via: https://stackoverflow.com/questions/43518199/cookies-expiration-time-format
-    and https://stackoverflow.com/questions/51343828/how-to-parse-chrome-bookmarks-date-added-value-to-a-date
+    Yield the items of iterable accounting the time spent producing them
+    to phase (e.g. streaming rows from sqlite)
     """
-    now = arrow.utcnow()
-    epoch_start = arrow.get(1601, 1, 1)
-    expiration_date = epoch_start.shift(microseconds=int(expires_utc))
-    days = (expiration_date - now).days
-    return days
+    iterator = iter(iterable)
+    while True:
+        with timed(phase):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
 
 
-def _sqlite_dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+def percentile(values, percent):
+    """
+    Nearest rank percentile of values
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
 
 
-def get_cookies():
+def iter_cookies(profile_path=None):
     """
-    Access google chrome profile cookies sqlite databasex
+    Stream the cookies of the google chrome profile cookies sqlite database
+    one at a time, columns missing in older chrome versions default to 0
     """
-    results = []
-    db = os.path.join(PROFILE_PATH, "Default", "Cookies")
+    db = os.path.join(profile_path or PROFILE_PATH, "Default", "Cookies")
     try:
         conn = sqlite3.connect(db)
-        conn.row_factory = _sqlite_dict_factory
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM cookies order by host_key, expires_utc desc")
-        results = cursor.fetchall()
-        LOG.info("Encontradas %s cookies", len(results))
     except Exception as e:
         LOG.error("get_cookies: %s", e)
         raise e
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cookies)")}
+        select = ", ".join(
+            column if column in columns else "0" for column in HEADER_COOKIES
+        )
+        cursor = conn.execute(
+            "SELECT %s FROM cookies order by host_key, expires_utc desc" % select
+        )
+        for row in cursor:
+            yield dict(zip(HEADER_COOKIES, row))
+    except Exception as e:
+        LOG.error("get_cookies: %s", e)
+        raise e
+    finally:
+        conn.close()
+
+
+def get_cookies():
+    """
+    Access google chrome profile cookies sqlite databasex
+    """
+    results = list(iter_cookies())
+    LOG.info("Encontradas %s cookies", len(results))
     return results
 
 
@@ -144,6 +424,136 @@ def export_cookies(cookies, path):
         raise e
 
 
+def export_cookies_and_stats(cookies, path, url, now=None):
+    """
+    Export cookies to file while computing their statistics, cookies can
+    be streamed so that a single cookie is held in memory at a time
+    """
+    accumulator = _new_cookie_stats(url, now)
+    try:
+        with open(path, "w") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=HEADER_COOKIES, extrasaction="ignore", restval=0
+            )
+            writer.writeheader()
+            for cookie in cookies:
+                writer.writerow(cookie)
+                _add_cookie_stats(accumulator, cookie)
+    except Exception as e:
+        LOG.error(e)
+        raise e
+    LOG.info("Encontradas %s cookies", accumulator["total"])
+    return _cookie_stats_result(accumulator)
+
+
+def _triki_database():
+    """
+    The analysis database module owns the site_cookies.db schema
+    """
+    if ANALYSIS_PATH not in sys.path:
+        sys.path.append(ANALYSIS_PATH)
+    import triki_database
+
+    return triki_database
+
+
+def _triki_cdp():
+    """
+    Browser contexts are driven with asyncio, only needed with --contexts
+    """
+    import triki_cdp
+
+    return triki_cdp
+
+
+def open_result_sink(params):
+    """
+    Open (once per process) the sink where flow results are stored:
+    the analysis sqlite database or an append-only results file of the run
+    """
+    if RESULT_SINK:
+        return RESULT_SINK
+    RESULT_SINK["type"] = params.sink
+    if params.sink == "database":
+        triki_database = _triki_database()
+        os.makedirs(os.path.dirname(os.path.abspath(params.database)), exist_ok=True)
+        # Several workers may be writing, wait for the lock instead of failing
+        conn = sqlite3.connect(params.database, timeout=120)
+        conn.execute("PRAGMA journal_mode = WAL")
+        triki_database._create_database(conn)
+        triki_database._upgrade_database(conn)
+        RESULT_SINK["conn"] = conn
+        RESULT_SINK["rollups"] = triki_database._table_exists(conn, "rollup_host_date")
+    elif params.sink == "delta":
+        # Every flow appends to its own cookies delta log
+        pass
+    else:
+        RESULT_SINK["fd"] = os.open(
+            params.results_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+    return RESULT_SINK
+
+
+def close_result_sink():
+    """
+    Close the result sink of this process if any
+    """
+    if "conn" in RESULT_SINK:
+        RESULT_SINK["conn"].close()
+    if "fd" in RESULT_SINK:
+        os.close(RESULT_SINK["fd"])
+    RESULT_SINK.clear()
+
+
+def store_results(sink, cookies, site, hostname, date):
+    """
+    Store the cookies of a flow and their stats in the result sink in a
+    single transaction (database) or a single appended line (jsonl and the
+    cookies delta log of the flow). Returns the cookie stats.
+    """
+    accumulator = _new_cookie_stats(site["url"])
+
+    def cookie_rows():
+        for cookie in cookies:
+            _add_cookie_stats(accumulator, cookie)
+            yield [cookie.get(field, 0) for field in HEADER_COOKIES]
+
+    def stats_row():
+        stats = _cookie_stats_result(accumulator)
+        return [stats[field] for field in HEADER_STATS[1:]]
+
+    if sink["type"] == "database":
+        triki_database = _triki_database()
+        attributes_rows = triki_database.flow_attributes(hostname, date, site["flow_type"])
+        with sink["conn"]:
+            triki_database.save_flow(
+                sink["conn"], attributes_rows, cookie_rows(), stats_row, sink["rollups"]
+            )
+    elif sink["type"] == "delta":
+        # Logs are kept by site next to its date folders
+        path = os.path.join(
+            DATA_PATH,
+            hostname,
+            "cookies_%s_%s.jsonl" % (site["flow_type"], hostname.replace(".", "_")),
+        )
+        snapshot = {"url": hostname, "date": date, "flow_type": site["flow_type"], "site_url": site["url"]}
+        _triki_database().append_delta_log(path, snapshot, cookie_rows(), stats_row)
+    else:
+        record = {
+            "url": hostname,
+            "date": date,
+            "flow_type": site["flow_type"],
+            "site_url": site["url"],
+            "cookies": list(cookie_rows()),
+            "stats": stats_row(),
+        }
+        # A single write on a file opened for appending, lines written by
+        # several workers do not get mixed
+        os.write(sink["fd"], (json.dumps(record) + "\n").encode("utf8"))
+    LOG.info("Encontradas %s cookies", accumulator["total"])
+    return _cookie_stats_result(accumulator)
+
+
 def export_stats(stats, path):
     """
     Export cookies pickling them to file
@@ -160,70 +570,58 @@ def export_stats(stats, path):
         raise e
 
 
-def cookie_stats(cookies, url):
+def _element_cache_key(el):
+    return (el["by"], el["value"], el.get("multiple", False), el.get("match"))
+
+
+def clear_element_cache():
     """
-    Compute cookie statistics
+    Forget every located element, needed when the browsing context changes
     """
-    stats = {"url": url}
-    LOG.debug("We have found %s cookies for %s", len(cookies), url)
-    stats["total"] = len(cookies)
-    session_cookies = [cookie for cookie in cookies if not int(cookie["is_persistent"])]
-    LOG.debug("There are %s session cookies", len(session_cookies))
-    stats["session"] = len(session_cookies)
+    ELEMENT_CACHE.clear()
 
-    # Compute expiration maximum and average in days
-    delta_expiration_days = [
-        _get_duration_in_days(cookie["expires_utc"])
-        for cookie in cookies
-        if int(cookie["is_persistent"])
-    ]
-    if delta_expiration_days:
-        stats["max_exp_days"] = max(delta_expiration_days)
-        LOG.debug("max expiration in days is %s", max(delta_expiration_days))
-        stats["avg_exp_days"] = int(
-            round(sum(delta_expiration_days) / len(delta_expiration_days))
+
+def _cached_element(el):
+    """
+    Element located before for the locator, None if there is none or the
+    text of the cached element no longer contains the match of a multiple
+    locator: banners relabel their buttons in place when switching panes
+    """
+    key = _element_cache_key(el)
+    element = ELEMENT_CACHE.get(key)
+    if element is None or not el.get("multiple"):
+        return element
+    try:
+        if el["match"].strip().lower() in element.text.lower():
+            return element
+    except StaleElementReferenceException:
+        pass
+    del ELEMENT_CACHE[key]
+    return None
+
+
+def _match_element(driver, el, match):
+    """
+    Select in a single script execution the first element whose text
+    contains match. Returns None if nothing matches (or the locator strategy
+    is not supported browser side) so that selenium can take over.
+    """
+    try:
+        return driver.execute_script(
+            LOCATE_ELEMENT_SCRIPT, el["by"], el["value"], match or ""
         )
-        LOG.debug("average expiration in days: %s", stats["avg_exp_days"])
-    else:
-        stats["max_exp_days"] = 0
-        stats["avg_exp_days"] = 0
-    # Get secure and httponly stats
-    secure = 0
-    http_only = 0
-    for cookie in cookies:
-        if int(cookie["is_secure"]):
-            secure += 1
-        if int(cookie["is_httponly"]):
-            http_only += 1
-    stats["secure_flag"] = secure
-    LOG.debug("There are %s secure cookies", stats["secure_flag"])
-    stats["httponly_flag"] = http_only
-    LOG.debug("There are %s httpOnly cookies", stats["httponly_flag"])
-
-    #  SameSite
-    same_site = Counter([str(cookie["samesite"]) for cookie in cookies])
-    LOG.debug("same_site %s", same_site)
-    stats["samesite_none_flag"] = same_site["-1"]
-    stats["samesite_lax_flag"] = same_site["0"]
-    stats["samesite_strict_flag"] = same_site["1"]
-    LOG.debug(
-        "There are %s cookies with SameSite set to None", stats["samesite_none_flag"]
-    )
-    LOG.debug(
-        "There are %s cookies with SameSite set to Lax", stats["samesite_lax_flag"]
-    )
-    LOG.debug(
-        "There are %s cookies with SameSite set to Strict",
-        stats["samesite_strict_flag"]
-    )
-    return stats
+    except WebDriverException as e:
+        LOG.debug("Could not match elements browser side: %s", e)
+        return None
 
 
 def _locate_element(driver, el):
     """
     locate an element inside the page using selenium capabilities
     """
-    element = None
+    element = _cached_element(el)
+    if element is not None:
+        return element
     # Check if we expect multiple elements to be selected
     multiple = False
     match = None
@@ -235,33 +633,203 @@ def _locate_element(driver, el):
 
     try:
         if multiple:
-            selection = driver.find_elements(el["by"], el["value"])
-            LOG.debug("found %s", len(selection))
-            # found multiple use match to refine
-            if selection and len(selection) >= 1:
-                for selected in selection:
-                    if match in selected.text.lower():
-                        element = selected
-                        break
+            element = _match_element(driver, el, match)
+            if element is None:
+                # Fallback honours the implicit wait of the session
+                selection = driver.find_elements(el["by"], el["value"])
+                LOG.debug("found %s", len(selection))
+                # found multiple use match to refine
+                if selection and len(selection) >= 1:
+                    for selected in selection:
+                        if match in selected.text.lower():
+                            element = selected
+                            break
         else:
             element = driver.find_element(el["by"], el["value"])
     except Exception as e:
         LOG.error("Could not locate the element in the page: %s", el)
         raise e
+    if element is not None:
+        ELEMENT_CACHE[_element_cache_key(el)] = element
     return element
 
 
-def screenshot(driver, el, filepath, filename=None):
+def _with_element(driver, el, action):
+    """
+    Run action over the located element, a cached element that is no longer
+    attached to the page is located again once
+    """
+    element = _locate_element(driver, el)
+    try:
+        return action(element)
+    except StaleElementReferenceException:
+        ELEMENT_CACHE.pop(_element_cache_key(el), None)
+        return action(_locate_element(driver, el))
+
+
+def _recompress_png(png):
+    """
+    Compress the image data of a png with the best zlib level, chrome
+    favours speed. The png is returned as is if it can not be parsed.
+    """
+    if not png.startswith(PNG_SIGNATURE):
+        return png
+    chunks = []
+    image_data = []
+    position = len(PNG_SIGNATURE)
+    while position < len(png):
+        # Truncated chunk, not worth storing it differently than taken
+        if position + 12 > len(png):
+            return png
+        length, kind = struct.unpack("!I4s", png[position:position + 8])
+        if position + 12 + length > len(png):
+            return png
+        data = png[position + 8:position + 8 + length]
+        position += 12 + length
+        if kind == b"IDAT":
+            if not image_data:
+                chunks.append(None)
+            image_data.append(data)
+        else:
+            chunks.append((kind, data))
+    try:
+        compressed = zlib.compress(zlib.decompress(b"".join(image_data)), 9)
+    except zlib.error:
+        return png
+    result = [PNG_SIGNATURE]
+    for chunk in chunks:
+        kind, data = chunk or (b"IDAT", compressed)
+        result.append(struct.pack("!I4s", len(data), kind) + data)
+        result.append(struct.pack("!I", zlib.crc32(kind + data)))
+    result = b"".join(result)
+    return result if len(result) < len(png) else png
+
+
+def _write_blob(path, data):
+    """
+    Write a file of the screenshot store, renamed into place so that
+    workers storing the same screenshot never see a partial one
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%s.%s" % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _link(blob_path, path):
     """
-    takes a screenshot of an element or the whole site
+    Make path point to a file of the screenshot store, copying it where
+    hard links are not possible (another filesystem)
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(blob_path, path)
+    except OSError:
+        copyfile(blob_path, path)
+
+
+def store_screenshot(png, path, thumbnail=False):
+    """
+    Store a png screenshot once by the hash of its content, recompressed,
+    and link it as path. With thumbnail a smaller copy is linked next to
+    it (<name>.thumb.png). Returns the bytes written to the store, 0 if
+    the screenshot was already stored.
+    """
+    digest = hashlib.sha256(png).hexdigest()
+    blob_path = os.path.join(SCREENSHOTS_PATH, digest[:2], "%s.png" % digest)
+    written = 0
+    if not os.path.exists(blob_path):
+        data = _recompress_png(png)
+        _write_blob(blob_path, data)
+        written = len(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _link(blob_path, path)
+    if thumbnail and Image is not None:
+        thumbnail_path = os.path.join(SCREENSHOTS_PATH, digest[:2], "%s.thumb.png" % digest)
+        if not os.path.exists(thumbnail_path):
+            image = Image.open(BytesIO(png))
+            image.thumbnail(THUMBNAIL_SIZE)
+            output = BytesIO()
+            image.save(output, "PNG", optimize=True)
+            _write_blob(thumbnail_path, output.getvalue())
+            written += output.tell()
+        _link(thumbnail_path, "%s.thumb.png" % os.path.splitext(path)[0])
+    return written
+
+
+def _screenshot_writer(pending, stats):
+    """
+    Store the screenshots queued by the flows of this process until None
+    """
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        png, path, thumbnail = item
+        try:
+            written = store_screenshot(png, path, thumbnail)
+        except Exception as e:
+            LOG.error("Could not store screenshot %s: %s", path, e)
+            continue
+        stats["screenshots"] += 1
+        stats["taken"] += len(png)
+        stats["written"] += written
+        stats["duplicates"] += not written
+
+
+def save_screenshot(png, path, thumbnail=False):
+    """
+    Queue a png screenshot to be stored as path by the writer thread of
+    this process, started on first use
+    """
+    if thumbnail and Image is None:
+        LOG.warning("Thumbnails need Pillow (pip install Pillow), storing %s without it", path)
+        thumbnail = False
+    if not SCREENSHOT_WRITER:
+        pending = Queue(SCREENSHOT_QUEUE_SIZE)
+        stats = {"screenshots": 0, "duplicates": 0, "taken": 0, "written": 0}
+        thread = threading.Thread(target=_screenshot_writer, args=(pending, stats), daemon=True)
+        thread.start()
+        SCREENSHOT_WRITER.update({"queue": pending, "thread": thread, "stats": stats})
+        # Daemon threads are not waited for, flush the queue on exit
+        atexit.register(close_screenshot_writer)
+    SCREENSHOT_WRITER["queue"].put((png, path, thumbnail))
+
+
+def close_screenshot_writer():
+    """
+    Wait until every queued screenshot of this process is stored
+    """
+    if not SCREENSHOT_WRITER:
+        return
+    SCREENSHOT_WRITER["queue"].put(None)
+    SCREENSHOT_WRITER["thread"].join()
+    stats = SCREENSHOT_WRITER["stats"]
+    SCREENSHOT_WRITER.clear()
+    if stats["screenshots"]:
+        LOG.info(
+            "Stored %s screenshots (%s already stored), %.1f MB written of %.1f MB taken",
+            stats["screenshots"],
+            stats["duplicates"],
+            stats["written"] / 1048576.0,
+            stats["taken"] / 1048576.0,
+        )
+
+
+def screenshot(driver, el, filepath, filename=None, thumbnail=False):
+    """
+    takes a screenshot of an element or the whole site, stored in the
+    background (see save_screenshot)
     """
     if not el:
         el = {"by": "tag name", "value": "body"}
     if not filename:
         filename = el["value"].replace(".", "_")
 
-    element = _locate_element(driver, el)
-    element.screenshot("%s/banner_cookies_%s.png" % (filepath, filename))
+    png = _with_element(driver, el, lambda element: element.screenshot_as_png)
+    save_screenshot(png, "%s/banner_cookies_%s.png" % (filepath, filename), thumbnail)
 
 
 def navigate_frame(driver, el):
@@ -272,49 +840,50 @@ def navigate_frame(driver, el):
     if "index" in el:
         driver.switch_to.frame(el["index"])
     else:
-        element = _locate_element(driver, el)
-        driver.switch_to.frame(element)
+        _with_element(driver, el, driver.switch_to.frame)
+    # Elements located in the previous frame are not reachable anymore
+    clear_element_cache()
 
 
 def click(driver, el):
     """
     clicks on an element using selenium capabilities
     """
-    element = _locate_element(driver, el)
-    LOG.debug("element: %s", element)
-    if "javascript" in el:
-        driver.execute_script("arguments[0].scrollIntoView(true);",element)
-        driver.execute_script("arguments[0].click();", element)
-    else:
-        try:
-            element.click()
-        except ElementClickInterceptedException as e:
-            LOG.debug("try click through javascript after exception")
+    def _click(element):
+        LOG.debug("element: %s", element)
+        if "javascript" in el:
             driver.execute_script("arguments[0].scrollIntoView(true);",element)
             driver.execute_script("arguments[0].click();", element)
+        else:
+            try:
+                element.click()
+            except ElementClickInterceptedException as e:
+                LOG.debug("try click through javascript after exception")
+                driver.execute_script("arguments[0].scrollIntoView(true);",element)
+                driver.execute_script("arguments[0].click();", element)
+
+    _with_element(driver, el, _click)
 
 
 def delay(driver, el, value):
     """
     Wait for something to happen in the site
     """
-    TRIKI_AVAILABLE_CONDITIONS = {
-        "element_to_be_clickable": EC.element_to_be_clickable,
-        "presence_of_element_located": EC.presence_of_element_located,
-        "visibility_of_element_located": EC.visibility_of_element_located,
-    }
     if el:
         if "condition" in el:
-            expected_condition_method = TRIKI_AVAILABLE_CONDITIONS[el["condition"]]
+            expected_condition_method = DELAY_CONDITIONS[el["condition"]]
         else:
             expected_condition_method = EC.element_to_be_clickable
         try:
             WebDriverWait(driver, value).until(
                 expected_condition_method((el["by"], el["value"]))
             )
-        except TimeoutException as e:
+        except TimeoutException:
             LOG.info("Timeout for explicit wait on %s", el)
-            raise e
+            # The site changed, retrying the flow will not find it either
+            raise NoSuchElementException(
+                "Element not ready after waiting %s seconds: %s" % (value, el)
+            )
     else:
         driver.implicitly_wait(value)
 
@@ -322,59 +891,40 @@ def keys(driver, el, value):
     """
     Wait for something to happen in the site
     """
-    element = _locate_element(driver, el)
-    element.clear()
-    element.send_keys(value)
+    def _keys(element):
+        element.clear()
+        element.send_keys(value)
+
+    _with_element(driver, el, _keys)
 
 def submit(driver, el):
     """
     clicks on an element using selenium capabilities
     """
-    element = _locate_element(driver, el)
-    element.submit()
+    _with_element(driver, el, lambda element: element.submit())
 
 
-def execute_cookies_flow(site, site_path, hostname):
+def _site_prefs(site):
     """
-    Navigates to a site and depending on the selected flow
-    accepts or rejects all the cookies and stores results, screenshots
-    and statistics on the cookies for the site
+    Chrome preferences requested by the site configuration, the flow type
+    is tagged with every blocking option that has been applied
     """
-    TRIKI_AVAILABLE_ACTIONS = {
-        "screenshot": screenshot,
-        "navigate_frame": navigate_frame,
-        "click": click,
-        "delay": delay,
-        "sleep": sleep,
-        "keys": keys,
-        "submit": submit,
-    }
-    # Clear profile to start fresh always
-
-    if os.path.exists(PROFILE_PATH):
-        rmtree(PROFILE_PATH)
-    os.makedirs(PROFILE_PATH)
-    # Selenium Chrome initialization with a intended profile
-    opts = ChromeOptions()
-    # Seems that it does not create the Cookies sqlite db
-    # opts.add_argument("--headless")
-    opts.add_argument("user-data-dir=%s" % PROFILE_PATH)
     prefs = {}
-    # Force browser language
+    # Force browser language
     if "language" in site:
         prefs["intl.accept_languages"] = site["language"]
     else:
-        # Defaults to spanish
+        # Defaults to spanish
         prefs["intl.accept_languages"] = "es, es-ES"
 
-    # Try to block cookies
+    # Try to block cookies
     # 1: allow, 2: block
     # via: https://stackoverflow.com/questions/32381946/disabling-cookies-in-webdriver-for-chrome-firefox/32416545
     if "block_all_cookies" in site:
         prefs["profile.default_content_setting_values.cookies"] = 2
         site["flow_type"] += "_block_all"
     # Try to block third party cookies
-    # Force browser language
+    # Force browser language
     if "block_third_party_cookies" in site:
         prefs["profile.block_third_party_cookies"] = True
         site["flow_type"] += "_block_third_party"
@@ -383,92 +933,1611 @@ def execute_cookies_flow(site, site_path, hostname):
         prefs["enable_do_not_track"] = True
         site["flow_type"] += "_do_not_track"
 
+    # Blocked while browsing through the DevTools protocol, see block_urls
+    if site.get("blocked_urls"):
+        site["flow_type"] += "_block_resources"
+    return prefs
+
+
+def _chrome_options(prefs, profile_path, headless=False, performance_log=False, cache_dir=None):
+    """
+    Selenium Chrome initialization with a intended profile
+    """
+    opts = ChromeOptions()
+    if cache_dir:
+        # Only the HTTP cache lives there, chrome never stores Set-Cookie
+        # headers in it. Cookies and storage stay in the flow profile.
+        opts.add_argument("--disk-cache-dir=%s" % cache_dir)
+    if headless:
+        # Headless chrome does not create the Cookies sqlite db, cookies
+        # are read through the DevTools protocol instead (get_browser_cookies)
+        # the new headless mode honours profile prefs such as the language
+        opts.add_argument("--headless=new")
+    opts.add_argument("user-data-dir=%s" % profile_path)
     opts.add_experimental_option("prefs", prefs)
     # Fix window size to be consistent across
     opts.add_argument("window-size=1920,1080")
     opts.add_argument("--log-level=3")
+    if performance_log:
+        # Network events tell us which origins stored data during a flow
+        opts.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    return opts
+
+
+def _mask_headless(driver, prefs):
+    """
+    Headless chrome announces itself in the user agent, sites may show a
+    different banner (or none) to it so we present the regular user agent
+    """
+    user_agent = driver.execute_cdp_cmd("Browser.getVersion", {})["userAgent"]
+    driver.execute_cdp_cmd(
+        "Network.setUserAgentOverride",
+        {
+            "userAgent": user_agent.replace("HeadlessChrome", "Chrome"),
+            "acceptLanguage": prefs["intl.accept_languages"],
+        },
+    )
+
+
+def block_urls(driver, patterns):
+    """
+    Block the requests to urls matching the patterns (an empty list
+    unblocks everything)
+    """
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+    if patterns:
+        LOG.debug("Blocking %s", ", ".join(patterns))
 
-    driver = Chrome(options=opts)
+
+def acquire_site_cache(hostname):
+    """
+    Lock the shared HTTP cache of a site for a flow, chrome can not share
+    a cache with another running browser. Returns the cache folder or None
+    if another flow of the site is using it (the flow then uses the cache
+    of its own profile).
+    """
+    if fcntl is None:
+        return None
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    fd = os.open(os.path.join(CACHE_PATH, "%s.lock" % hostname), os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        LOG.info("Analysing %s %sing all cookies", site["url"], site["flow_type"])
-        driver.get(site["url"])
-        if not os.path.exists(site_path):
-            os.makedirs(site_path)
-        for step in site["flow"]:
-            function = TRIKI_AVAILABLE_ACTIONS[step["action"]]
-            if step["action"] == "screenshot":
-                if "filename" not in step:
-                    step["filename"] = None
-                function(driver, step["element"], site_path, step["filename"])
-            elif step["action"] == "navigate_frame":
-                function(driver, step["element"])
-            elif step["action"] == "click":
-                function(driver, step["element"])
-            elif step["action"] == "submit":
-                function(driver, step["element"])
-            elif step["action"] == "keys":
-                function(driver, step["element"], step["value"])
-            elif step["action"] == "delay":
-                function(driver, step["element"], step["value"])
-            elif step["action"] == "sleep":
-                function(step["value"])
-            LOG.info("done with step: %s", step)
-    except Exception as e:
-        LOG.error("Exception while processing flow %s", e)
-        raise
-    finally:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        LOG.debug("Shared cache of %s in use, using a private one", hostname)
+        return None
+    SITE_CACHE["fd"] = fd
+    return os.path.join(CACHE_PATH, hostname)
+
+
+def release_site_cache(profile_path):
+    """
+    Unlock the shared cache of the flow once its browser has exited
+    """
+    if "fd" not in SITE_CACHE:
+        return
+    deadline = monotonic() + CACHE_RELEASE_SECONDS
+    while _browser_pids(profile_path) and monotonic() < deadline:
+        sleep(0.1)
+    os.close(SITE_CACHE.pop("fd"))
+
+
+def _fresh_profile(profile_path):
+    """
+    Clear profile to start fresh always
+    """
+    with timed("profile"):
+        if os.path.exists(profile_path):
+            rmtree(profile_path)
+        os.makedirs(profile_path)
+    LOG.debug("Using chrome profile %s", profile_path)
+
+
+def _performance_events(driver):
+    """
+    Drain the performance log of the browser returning its DevTools events,
+    contacted origins are remembered so that warm browsers can be wiped
+    """
+    events = []
+    origins = VISITED_ORIGINS.setdefault(driver.session_id, set())
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        params = message.get("params", {})
+        events.append(message)
+        if message["method"] == "Network.requestWillBeSent":
+            url = params["request"]["url"]
+        elif message["method"] == "Page.frameNavigated":
+            url = params["frame"]["url"]
+        else:
+            continue
+        parsed = urlparse(url)
+        if parsed.scheme in ("http", "https") and parsed.netloc:
+            origins.add("%s://%s" % (parsed.scheme, parsed.netloc))
+    return events
+
+
+def _visited_origins(driver):
+    """
+    Origins contacted by the browser since the last call
+    """
+    _performance_events(driver)
+    return VISITED_ORIGINS.pop(driver.session_id, set())
+
+
+def reset_browser(driver, keep_cache=False):
+    """
+    Wipe everything a flow left in a warm browser: cookies, cache (unless
+    keep_cache) and the storage (local storage, indexeddb, service workers,
+    cache storage...) of every origin contacted during the flow.
+    Returns the wiped origins.
+    """
+    origins = _visited_origins(driver)
+    # Keep a single blank window so that no page script keeps running
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
         driver.close()
+    driver.switch_to.window(handles[0])
+    driver.switch_to.default_content()
+    driver.get("about:blank")
+    # delay steps without element change the session implicit wait
+    driver.implicitly_wait(0)
+    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    if not keep_cache:
+        driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+    for origin in origins:
+        driver.execute_cdp_cmd(
+            "Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"}
+        )
+    # Navigating to about:blank may have left entries behind
+    origins |= _visited_origins(driver)
+    return origins
 
-    # Retrieve and compute stats over the site cookies
-    # Generate paths
-    cookies_path = "%s/cookies_%s_%s.csv" % (
-        site_path,
-        site["flow_type"],
-        hostname.replace(".", "_"),
+
+def verify_clean_browser(driver, origins):
+    """
+    Check that a warm browser is as clean as a fresh profile after a reset,
+    raises RuntimeError describing whatever survived otherwise
+    """
+    leftovers = []
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    if cookies:
+        leftovers.append("%s cookies" % len(cookies))
+    if len(driver.window_handles) != 1:
+        leftovers.append("%s windows" % len(driver.window_handles))
+    driver.execute_cdp_cmd("DOMStorage.enable", {})
+    for origin in origins:
+        local_storage = driver.execute_cdp_cmd(
+            "DOMStorage.getDOMStorageItems",
+            {"storageId": {"securityOrigin": origin, "isLocalStorage": True}},
+        )["entries"]
+        if local_storage:
+            leftovers.append("local_storage in %s" % origin)
+        usage = driver.execute_cdp_cmd("Storage.getUsageAndQuota", {"origin": origin})
+        for storage in usage["usageBreakdown"]:
+            if storage["usage"]:
+                leftovers.append("%s in %s" % (storage["storageType"], origin))
+    driver.execute_cdp_cmd("DOMStorage.disable", {})
+    if leftovers:
+        raise RuntimeError("Browser not clean after reset: %s" % ", ".join(leftovers))
+
+
+def _quit_browser(session):
+    """
+    Close a warm browser and delete its profile
+    """
+    VISITED_ORIGINS.pop(session["driver"].session_id, None)
+    try:
+        session["driver"].quit()
+    except Exception as e:
+        LOG.debug("Could not quit browser cleanly: %s", e)
+    rmtree(session["profile_path"], ignore_errors=True)
+
+
+def acquire_browser(prefs, pool_size, headless=False):
+    """
+    Get a warm browser launched with the given prefs from the pool, chrome
+    prefs can not be changed once launched so browsers are kept per prefs.
+    The least recently used browser is closed when the pool is full.
+    """
+    key = json.dumps(prefs, sort_keys=True)
+    if key in BROWSER_POOL:
+        BROWSER_POOL.move_to_end(key)
+        return key, BROWSER_POOL[key]["driver"]
+    while len(BROWSER_POOL) >= pool_size:
+        _, session = BROWSER_POOL.popitem(last=False)
+        _quit_browser(session)
+    profile_path = "%s_warm_%s" % (
+        PROFILE_PATH,
+        hashlib.md5(key.encode("utf8")).hexdigest()[:8],
     )
-    stats_path = "%s/stats_%s_%s.csv" % (
-        site_path,
-        site["flow_type"],
-        hostname.replace(".", "_"),
+    _fresh_profile(profile_path)
+    driver = Chrome(
+        options=_chrome_options(prefs, profile_path, headless, performance_log=True)
     )
-
-    # Retrieve cookies from sqlite
-    cookies = get_cookies()
-    LOG.debug(cookies)
-    # Export cookies to csv
-    export_cookies(cookies, cookies_path)
-    # Compute cookie stats
-    stats = cookie_stats(cookies, site["url"])
-    # Export cookie stats to csv
-    export_stats(stats, stats_path)
+    if headless:
+        _mask_headless(driver, prefs)
+    BROWSER_POOL[key] = {"driver": driver, "profile_path": profile_path}
+    LOG.info("Launched warm browser %s", profile_path)
+    return key, driver
 
 
-def run():
+def release_browser(key, keep_cache=False):
     """
-    Analyze cookies for a given site
+    Reset a warm browser so the next flow starts from a clean state, if the
+    reset can not be proven clean the browser is discarded
     """
-    # Configure logging
-    _set_logging()
+    driver = BROWSER_POOL[key]["driver"]
+    try:
+        origins = reset_browser(driver, keep_cache)
+        verify_clean_browser(driver, origins)
+    except Exception as e:
+        LOG.warning("Discarding warm browser: %s", e)
+        discard_browser(key)
 
-    # Create output folders if needed
-    if not os.path.exists(DATA_PATH):
-        os.makedirs(DATA_PATH)
 
-    # Read sites configuration
-    config = _config()
+def discard_browser(key):
+    """
+    Remove a browser from the pool closing it
+    """
+    session = BROWSER_POOL.pop(key, None)
+    if session:
+        _quit_browser(session)
 
-    for site in config["sites"]:
-        try:
-            LOG.debug(site)
-            today = arrow.utcnow().format("YYYYMMDD")
-            url = urlparse(site["url"])
-            site_path = os.path.join(DATA_PATH, url.hostname, today)
-            execute_cookies_flow(site, site_path, url.hostname)
-        except (KeyboardInterrupt, SystemExit):
-            sys.exit()
-        except Exception as e:
-            LOG.error("Found error while processing %s", site["url"])
 
+def close_browser_pool():
+    """
+    Close every warm browser of this process
+    """
+    while BROWSER_POOL:
+        _, session = BROWSER_POOL.popitem()
+        _quit_browser(session)
+
+
+def _fingerprint_cookies(cdp_cookies):
+    """
+    Snapshot of DevTools protocol cookies to detect cookie writes
+    """
+    return sorted(
+        (cookie["domain"], cookie["name"], cookie["path"], cookie["value"], cookie["expires"])
+        for cookie in cdp_cookies
+    )
+
+
+def _cookies_fingerprint(driver):
+    """
+    Snapshot of the browser cookies to detect cookie writes
+    """
+    return _fingerprint_cookies(driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"])
+
+
+def settle(driver, value, quiet=SETTLE_QUIET_SECONDS):
+    """
+    Wait until the site stops making requests and writing cookies for
+    `quiet` seconds, waiting `value` seconds at most.
+    Returns the seconds actually waited.
+    """
+    start = monotonic()
+    last_activity = start
+    inflight = set()
+    cookies = _cookies_fingerprint(driver)
+    while True:
+        sleep(SETTLE_POLL_SECONDS)
+        now = monotonic()
+        try:
+            events = _performance_events(driver)
+        except Exception:
+            # Browser launched without performance log, rely on cookies only
+            events = []
+        for event in events:
+            if event["method"] == "Network.requestWillBeSent":
+                inflight.add(event["params"]["requestId"])
+                last_activity = now
+            elif event["method"] in ("Network.loadingFinished", "Network.loadingFailed"):
+                inflight.discard(event["params"]["requestId"])
+        current_cookies = _cookies_fingerprint(driver)
+        if current_cookies != cookies:
+            cookies = current_cookies
+            last_activity = now
+        if len(inflight) > SETTLE_MAX_INFLIGHT:
+            last_activity = now
+        if now - last_activity >= quiet or now - start >= value:
+            break
+    waited = monotonic() - start
+    LOG.info("Settled after %.1f seconds (quiet %s, max %s)", waited, quiet, value)
+    return waited
+
+
+def _uses_settle(site, params):
+    """
+    Whether the site flow waits for the site to settle, those flows need
+    the browser performance log to follow network activity
+    """
+    return params.settle or any(step["action"] == "settle" for step in site["flow"])
+
+
+def _map_cdp_cookies(cdp_cookies):
+    """
+    Map cookies of the DevTools protocol to the columns of the chrome
+    profile cookies sqlite database
+    """
+    results = []
+    for cookie in cdp_cookies:
+        persistent = not cookie["session"]
+        expires_utc = 0
+        if persistent:
+            expires_utc = int(round((cookie["expires"] + CHROME_EPOCH_OFFSET) * 1000000))
+        results.append(
+            {
+                "host_key": cookie["domain"],
+                "name": cookie["name"],
+                # Chrome stores the value encrypted, the sqlite column is blank
+                "value": "",
+                "path": cookie["path"],
+                "expires_utc": expires_utc,
+                "is_secure": int(cookie["secure"]),
+                "is_httponly": int(cookie["httpOnly"]),
+                "has_expires": int(persistent),
+                "is_persistent": int(persistent),
+                "priority": CDP_PRIORITY.get(cookie.get("priority"), 1),
+                "samesite": CDP_SAMESITE.get(cookie.get("sameSite"), -1),
+                "source_scheme": CDP_SOURCE_SCHEME.get(cookie.get("sourceScheme"), 0),
+            }
+        )
+    # Same order as the query over the sqlite database
+    results.sort(key=lambda cookie: (cookie["host_key"], -cookie["expires_utc"]))
+    return results
+
+
+def get_browser_cookies(driver):
+    """
+    Retrieve every cookie in the browser through the DevTools protocol
+    mapped to the columns of the chrome profile cookies sqlite database
+    """
+    return _map_cdp_cookies(driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"])
+
+
+def _screenshot_step(driver, site_path, el, filename, thumbnail):
+    screenshot(driver, el, site_path, filename, thumbnail)
+
+
+def _element_step(driver, site_path, function, el):
+    function(driver, el)
+
+
+def _value_step(driver, site_path, function, el, value):
+    function(driver, el, value)
+
+
+def _sleep_step(driver, site_path, value):
+    sleep(value)
+
+
+def _settle_step(driver, site_path, value, quiet):
+    return settle(driver, value, quiet)
+
+
+def _compile_element(step, required=True, frame=False):
+    """
+    Validate the element of a step, returns None if the step has no element
+    """
+    el = step.get("element")
+    # yaml reads the `None` of the documentation examples as a string
+    if el is None or el == "None":
+        if required:
+            raise ValueError("missing element")
+        return None
+    if not isinstance(el, dict):
+        raise ValueError("element must be a mapping, found %r" % el)
+    unknown = sorted(set(el) - set(ELEMENT_KEYS))
+    if unknown:
+        raise ValueError("unknown element keys %s" % ", ".join(unknown))
+    if frame and "index" in el:
+        if not isinstance(el["index"], int):
+            raise ValueError("frame index must be an integer, found %r" % el["index"])
+        return el
+    for key in ("by", "value"):
+        if key not in el:
+            raise ValueError("element without %s" % key)
+    if el["by"] not in LOCATOR_STRATEGIES:
+        raise ValueError(
+            "unknown locator strategy %r, use one of: %s"
+            % (el["by"], ", ".join(LOCATOR_STRATEGIES))
+        )
+    if el.get("multiple") and not isinstance(el.get("match"), str):
+        raise ValueError("multiple elements need a match text")
+    return el
+
+
+def _compile_seconds(step, key="value", default=None):
+    """
+    Validate a number of seconds of a step
+    """
+    value = step.get(key, default)
+    if value is None:
+        raise ValueError("missing %s" % key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError("%s must be a number of seconds, found %r" % (key, value))
+    return value
+
+
+def _compile_screenshot(step, params):
+    filename = step.get("filename")
+    if filename is not None and not isinstance(filename, str):
+        raise ValueError("filename must be a string, found %r" % filename)
+    return _screenshot_step, (_compile_element(step, required=False), filename, params.thumbnails)
+
+
+def _compile_navigate_frame(step, params):
+    return _element_step, (navigate_frame, _compile_element(step, frame=True))
+
+
+def _compile_click(step, params):
+    return _element_step, (click, _compile_element(step))
+
+
+def _compile_submit(step, params):
+    return _element_step, (submit, _compile_element(step))
+
+
+def _compile_keys(step, params):
+    if step.get("value") is None:
+        raise ValueError("missing value")
+    return _value_step, (keys, _compile_element(step), step["value"])
+
+
+def _compile_delay(step, params):
+    el = _compile_element(step, required=False)
+    if el is not None and "condition" in el and el["condition"] not in DELAY_CONDITIONS:
+        raise ValueError(
+            "unknown condition %r, use one of: %s"
+            % (el["condition"], ", ".join(DELAY_CONDITIONS))
+        )
+    return _value_step, (delay, el, _compile_seconds(step))
+
+
+def _compile_sleep(step, params):
+    if params.settle:
+        # sleep value becomes the maximum time waiting for the site
+        return _settle_step, (_compile_seconds(step), SETTLE_QUIET_SECONDS)
+    return _sleep_step, (_compile_seconds(step),)
+
+
+def _compile_settle(step, params):
+    return _settle_step, (
+        _compile_seconds(step),
+        _compile_seconds(step, "quiet", SETTLE_QUIET_SECONDS),
+    )
+
+
+TRIKI_AVAILABLE_ACTIONS = {
+    "screenshot": _compile_screenshot,
+    "navigate_frame": _compile_navigate_frame,
+    "click": _compile_click,
+    "delay": _compile_delay,
+    "sleep": _compile_sleep,
+    "keys": _compile_keys,
+    "submit": _compile_submit,
+    "settle": _compile_settle,
+}
+
+
+def _compile_blocked_urls(site, params):
+    """
+    Url patterns blocked during the flow, from the resource types and
+    patterns of the site or the global option if the site has none
+    """
+    resources = site.get("block_resources", params.block_resources)
+    if not isinstance(resources, list):
+        raise ValueError("block_resources must be a list, found %r" % resources)
+    patterns = []
+    for resource in resources:
+        if not isinstance(resource, str):
+            raise ValueError("resources must be strings, found %r" % resource)
+        if resource in RESOURCE_PATTERNS:
+            patterns.extend(RESOURCE_PATTERNS[resource])
+        elif resource in NEVER_BLOCKED:
+            raise ValueError(
+                "%s can set cookies or render the banner and can not be blocked" % resource
+            )
+        elif "*" in resource or "/" in resource:
+            if not resource.strip("*?/:."):
+                raise ValueError("pattern %s blocks every url" % resource)
+            if fnmatch.fnmatchcase(site["url"], resource):
+                raise ValueError("pattern %s blocks the site itself" % resource)
+            # Any url matched once the wildcards are filled, ending as a
+            # script, document or request
+            stem = resource.replace("*", "x").replace("?", "x")
+            for ending in NEVER_BLOCKED_ENDINGS:
+                if fnmatch.fnmatchcase(stem + ending, resource):
+                    raise ValueError(
+                        "pattern %s may block documents, scripts or requests (%s urls), "
+                        "which can set cookies" % (resource, ending)
+                    )
+            patterns.append(resource)
+        else:
+            raise ValueError(
+                "unknown resource %r, use a url pattern or one of: %s"
+                % (resource, ", ".join(RESOURCE_PATTERNS))
+            )
+    return patterns
+
+
+def compile_flow(site, params):
+    """
+    Validate every step of a site flow and resolve the function that runs it.
+    Returns a list of (function, arguments, step) tuples, raises ValueError
+    describing the first invalid step.
+    """
+    if not isinstance(site, dict):
+        raise ValueError("site must be a mapping, found %r" % site)
+    for key in ("url", "flow_type", "flow"):
+        if key not in site:
+            raise ValueError("site without %s" % key)
+    if not urlparse(str(site["url"])).hostname:
+        raise ValueError("url without hostname")
+    if not isinstance(site["flow"], list):
+        raise ValueError("flow must be a list of steps")
+    site["blocked_urls"] = _compile_blocked_urls(site, params)
+    steps = []
+    for index, step in enumerate(site["flow"]):
+        try:
+            if not isinstance(step, dict):
+                raise ValueError("step must be a mapping, found %r" % step)
+            unknown = sorted(set(step) - set(STEP_KEYS))
+            if unknown:
+                raise ValueError("unknown keys %s" % ", ".join(unknown))
+            if step.get("action") not in TRIKI_AVAILABLE_ACTIONS:
+                raise ValueError(
+                    "unknown action %r, use one of: %s"
+                    % (step.get("action"), ", ".join(TRIKI_AVAILABLE_ACTIONS))
+                )
+            function, args = TRIKI_AVAILABLE_ACTIONS[step["action"]](step, params)
+        except ValueError as e:
+            raise ValueError("step %s: %s" % (index + 1, e))
+        steps.append((function, args, step))
+    return steps
+
+
+def compile_sites(sites, params):
+    """
+    Compile the flow of every site of an iterable before launching any
+    browser, every invalid flow is reported and the run is aborted if any
+    is found. Returns the list of compiled sites.
+    """
+    errors = 0
+    compiled = []
+    for position, site in enumerate(sites):
+        compiled.append(site)
+        try:
+            site["steps"] = compile_flow(site, params)
+        except ValueError as e:
+            errors += 1
+            if isinstance(site, dict):
+                LOG.error(
+                    "Invalid flow %s %s: %s", site.get("url"), site.get("flow_type"), e
+                )
+            else:
+                LOG.error("Invalid site number %s: %s", position + 1, e)
+    if errors:
+        raise ValueError("Found %s invalid flows in the configuration" % errors)
+    return compiled
+
+
+def _run_flow(driver, site, site_path, params):
+    """
+    Visit the site and perform every step of its flow, returns the
+    duration of every settle wait
+    """
+    steps = site.get("steps") or compile_flow(site, params)
+    waits = []
+    clear_element_cache()
+    LOG.info("Analysing %s %sing all cookies", site["url"], site["flow_type"])
+    with timed("load"):
+        driver.get(site["url"])
+    # Several workers may be creating the same site folder concurrently
+    os.makedirs(site_path, exist_ok=True)
+    for number, (function, args, step) in enumerate(steps, 1):
+        start = monotonic()
+        with timed("steps"):
+            waited = function(driver, site_path, *args)
+        FLOW_TIMINGS.setdefault("steps", []).append(
+            {"step": number, "action": step["action"], "seconds": monotonic() - start}
+        )
+        if waited is not None:
+            waits.append(waited)
+        LOG.info("done with step: %s", step)
+    if waits:
+        LOG.info(
+            "Settle waits for %s %s: %s",
+            site["url"],
+            site["flow_type"],
+            ", ".join("%.1f" % waited for waited in waits),
+        )
+    return waits
+
+
+def execute_cookies_flow(site, site_path, hostname, params=None):
+    """
+    Navigates to a site and depending on the selected flow
+    accepts or rejects all the cookies and stores results, screenshots
+    and statistics on the cookies for the site
+    """
+    params = params or _arg_parser().parse_args([])
+    if "steps" not in site:
+        site["steps"] = compile_flow(site, params)
+    prefs = _site_prefs(site)
+
+    if params.warm_browsers:
+        with timed("launch"):
+            key, driver = acquire_browser(prefs, params.warm_browsers, params.headless)
+        watch_browser(driver, BROWSER_POOL[key]["profile_path"], params)
+        try:
+            # Warm browsers may come from a flow blocking other urls
+            block_urls(driver, site.get("blocked_urls", []))
+            _run_flow(driver, site, site_path, params)
+            with timed("cookies"):
+                cookies = get_browser_cookies(driver)
+        except Exception as e:
+            LOG.error("Exception while processing flow %s", e)
+            raise
+        finally:
+            with timed("reset"):
+                # With a shared cache warm browsers keep it for the next flows
+                release_browser(key, params.shared_cache)
+    else:
+        _fresh_profile(PROFILE_PATH)
+        cache_dir = acquire_site_cache(hostname) if params.shared_cache else None
+        try:
+            with timed("launch"):
+                driver = Chrome(
+                    options=_chrome_options(
+                        prefs,
+                        PROFILE_PATH,
+                        params.headless,
+                        performance_log=_uses_settle(site, params),
+                        cache_dir=cache_dir,
+                    )
+                )
+                if params.headless:
+                    _mask_headless(driver, prefs)
+        except Exception:
+            release_site_cache(PROFILE_PATH)
+            raise
+        watch_browser(driver, PROFILE_PATH, params)
+        try:
+            if site.get("blocked_urls"):
+                block_urls(driver, site["blocked_urls"])
+            _run_flow(driver, site, site_path, params)
+            if params.headless:
+                # No need to wait for chrome to flush the sqlite db
+                with timed("cookies"):
+                    cookies = get_browser_cookies(driver)
+        except Exception as e:
+            LOG.error("Exception while processing flow %s", e)
+            raise
+        finally:
+            VISITED_ORIGINS.pop(driver.session_id, None)
+            try:
+                with timed("close"):
+                    driver.close()
+            finally:
+                release_site_cache(PROFILE_PATH)
+        if not params.headless:
+            # Retrieve cookies from sqlite, rows are read while exporting
+            cookies = timed_iter("cookies", iter_cookies())
+
+    with timed("export"):
+        export_results(cookies, site, site_path, hostname, params)
+
+
+def export_results(cookies, site, site_path, hostname, params):
+    """
+    Store the cookies of a flow and their stats in the result sink or the
+    csv files of the site folder
+    """
+    if params.sink != "csv":
+        # site path is DATA_PATH/<host>/<date>
+        store_results(
+            open_result_sink(params), cookies, site, hostname, os.path.basename(site_path)
+        )
+        return
+
+    # Retrieve and compute stats over the site cookies
+    # Generate paths
+    cookies_path = "%s/cookies_%s_%s.csv" % (
+        site_path,
+        site["flow_type"],
+        hostname.replace(".", "_"),
+    )
+    stats_path = "%s/stats_%s_%s.csv" % (
+        site_path,
+        site["flow_type"],
+        hostname.replace(".", "_"),
+    )
+
+    # Export cookies to csv computing their stats on the way
+    stats = export_cookies_and_stats(cookies, cookies_path, site["url"])
+    # Export cookie stats to csv
+    export_stats(stats, stats_path)
+
+
+def _browser_pids(profile_path):
+    """
+    Processes of the chrome browsers launched with profile_path
+    """
+    args = {"--user-data-dir=%s" % profile_path, "user-data-dir=%s" % profile_path}
+    pids = []
+    if os.path.isdir("/proc"):
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open("/proc/%s/cmdline" % pid, "rb") as f:
+                    cmdline = f.read().decode("utf8", "replace").split("\0")
+            except OSError:
+                continue
+            if args.intersection(cmdline):
+                pids.append(int(pid))
+    elif which("pgrep"):
+        pattern = "user-data-dir=%s( |$)" % profile_path
+        output = subprocess.run(
+            ["pgrep", "-f", pattern], stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout
+        pids = [int(pid) for pid in output.split()]
+    return pids
+
+
+def kill_browser_processes(profile_path):
+    """
+    Kill the chrome processes left behind by a flow that failed or hung,
+    returns how many were killed (always 0 on windows)
+    """
+    killed = 0
+    for pid in _browser_pids(profile_path):
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed += 1
+        except OSError:
+            pass
+    if killed:
+        LOG.warning("Killed %s chrome processes of %s", killed, profile_path)
+    return killed
+
+
+def watch_browser(driver, profile_path, params):
+    """
+    Bound the page loads of the browser and let the watchdog of the flow
+    kill it if the flow deadline expires
+    """
+    if params.page_timeout:
+        driver.set_page_load_timeout(params.page_timeout)
+    FLOW_WATCHDOG["driver"] = driver
+    FLOW_WATCHDOG["profile_path"] = profile_path
+
+
+def _flow_deadline_expired(seconds):
+    """
+    Kill the browser of the flow (chromedriver and chrome) so that the
+    pending selenium call fails instead of blocking the process forever
+    """
+    FLOW_WATCHDOG["expired"] = True
+    LOG.error("Flow exceeded its deadline of %s seconds, killing its browser", seconds)
+    driver = FLOW_WATCHDOG.get("driver")
+    try:
+        driver.service.process.kill()
+    except Exception:
+        pass
+    if FLOW_WATCHDOG.get("profile_path"):
+        kill_browser_processes(FLOW_WATCHDOG["profile_path"])
+
+
+def _is_transient(error):
+    """
+    Whether retrying the flow may succeed
+    """
+    if isinstance(error, DETERMINISTIC_ERRORS):
+        return False
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def process_site(site, today, params, attempt=1):
+    """
+    Run a single site flow, returns the url, flow type, the error found
+    if any and the flow timings so that parallel executions can be
+    summarized by the caller
+    """
+    error = None
+    transient = False
+    start_timings()
+    FLOW_WATCHDOG.clear()
+    watchdog = None
+    if params.flow_timeout:
+        watchdog = threading.Timer(params.flow_timeout, _flow_deadline_expired, (params.flow_timeout,))
+        watchdog.daemon = True
+        watchdog.start()
+    start = monotonic()
+    try:
+        LOG.debug(site)
+        url = urlparse(site["url"])
+        site_path = os.path.join(DATA_PATH, url.hostname, today)
+        execute_cookies_flow(site, site_path, url.hostname, params)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        LOG.error("Found error while processing %s", site["url"])
+        error = repr(e)
+        transient = _is_transient(e)
+    finally:
+        if watchdog:
+            watchdog.cancel()
+    wall = monotonic() - start
+    if error and FLOW_WATCHDOG.get("expired"):
+        error = "Flow timeout after %s seconds: %s" % (params.flow_timeout, error)
+        transient = True
+    if error and not params.warm_browsers:
+        # A browser that crashed or hung may leave chrome processes behind
+        kill_browser_processes(PROFILE_PATH)
+    FLOW_WATCHDOG.clear()
+    timings = {
+        "url": site["url"],
+        "flow_type": site["flow_type"],
+        "date": today,
+        "wall": wall,
+        "error": error,
+        "attempt": attempt,
+        "transient": transient,
+        "phases": dict(FLOW_TIMINGS["phases"]),
+        "steps": list(FLOW_TIMINGS["steps"]),
+    }
+    timings["phases"]["other"] = max(wall - sum(timings["phases"].values()), 0)
+    return site["url"], site["flow_type"], error, timings
+
+
+def record_timings(result, params):
+    """
+    Append the timings of a processed flow to the metrics file as a json
+    line, prometheus textfiles are written once the run finishes
+    """
+    timings = result[3]
+    if not params.metrics or timings is None or params.metrics.endswith(".prom"):
+        return
+    with open(params.metrics, "a", encoding="utf8") as f:
+        f.write(json.dumps(timings) + "\n")
+
+
+def _timing_series(timings):
+    """
+    Seconds of every flow for the wall time and each phase found
+    """
+    series = OrderedDict([("wall", [t["wall"] for t in timings])])
+    for phase in TIMING_PHASES + ["other"]:
+        if any(phase in t["phases"] for t in timings):
+            series[phase] = [t["phases"].get(phase, 0) for t in timings]
+    return series
+
+
+def summarize_timings(results):
+    """
+    Log the p50/p95 of every phase and the slowest flows of the run
+    """
+    timings = [result[3] for result in results if result[3]]
+    if not timings:
+        return
+    LOG.info(
+        "Flow timings p50/p95 (seconds): %s",
+        ", ".join(
+            "%s %.2f/%.2f" % (name, percentile(values, 50), percentile(values, 95))
+            for name, values in _timing_series(timings).items()
+        ),
+    )
+    for t in sorted(timings, key=lambda t: t["wall"], reverse=True)[:SLOWEST_FLOWS]:
+        slowest_phase = max(t["phases"], key=t["phases"].get)
+        LOG.info(
+            "Slow flow %s %s: %.1fs (%s %.1fs)",
+            t["url"],
+            t["flow_type"],
+            t["wall"],
+            slowest_phase,
+            t["phases"][slowest_phase],
+        )
+
+
+def export_prometheus(results, path, run_seconds):
+    """
+    Write the run timings as a prometheus textfile, renamed into place so
+    that the node exporter never reads a partial file
+    """
+    timings = [result[3] for result in results if result[3]]
+    failed = len([result for result in results if result[2]])
+    lines = [
+        "# HELP triki_flows Flows processed by the last run",
+        "# TYPE triki_flows gauge",
+        'triki_flows{status="ok"} %s' % (len(results) - failed),
+        'triki_flows{status="failed"} %s' % failed,
+        "# HELP triki_run_seconds Duration of the last run",
+        "# TYPE triki_run_seconds gauge",
+        "triki_run_seconds %.3f" % run_seconds,
+        "# HELP triki_flow_seconds Seconds per flow of the last run by phase",
+        "# TYPE triki_flow_seconds summary",
+    ]
+    for name, values in _timing_series(timings).items():
+        for quantile in (50, 95):
+            lines.append(
+                'triki_flow_seconds{phase="%s",quantile="%g"} %.3f'
+                % (name, quantile / 100.0, percentile(values, quantile))
+            )
+        lines.append('triki_flow_seconds_sum{phase="%s"} %.3f' % (name, sum(values)))
+        lines.append('triki_flow_seconds_count{phase="%s"} %s' % (name, len(values)))
+    tmp_path = "%s.%s" % (path, os.getpid())
+    with open(tmp_path, "w", encoding="utf8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _journal_key(site, date):
+    """
+    Identity of a flow in the run journal
+    """
+    options = {option: site[option] for option in SITE_OPTIONS if option in site}
+    return json.dumps([site["url"], site["flow_type"], options, date], sort_keys=True)
+
+
+def open_journal(resume, date):
+    """
+    Open the journal where the run records every flow as it completes.
+    When resuming, the journal of the interrupted run is kept and its date
+    is returned along with the flows already completed, otherwise a new
+    journal is started.
+    """
+    path = os.path.join(DATA_PATH, "journal.jsonl")
+    done = set()
+    resuming = resume and os.path.exists(path)
+    if resuming:
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be partial if the machine went down
+                    continue
+                if "key" in record:
+                    done.add(record["key"])
+                else:
+                    date = record["date"]
+        flags = os.O_WRONLY | os.O_APPEND
+        LOG.info("Resuming run of %s, %s flows already done", date, len(done))
+    else:
+        if resume:
+            LOG.warning("No journal found in %s, starting a new run", path)
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC
+    RUN_JOURNAL["fd"] = os.open(path, flags, 0o644)
+    if not resuming:
+        _write_journal({"date": date, "started": arrow.utcnow().isoformat()})
+    return date, done
+
+
+def _write_journal(record):
+    """
+    Append a record to the journal, synced so that it survives a crash
+    """
+    if "fd" not in RUN_JOURNAL:
+        return
+    os.write(RUN_JOURNAL["fd"], (json.dumps(record) + "\n").encode("utf8"))
+    os.fsync(RUN_JOURNAL["fd"])
+
+
+def record_journal(site, date, result):
+    """
+    Record a flow that will not be processed again in this run: it
+    succeeded or failed after its last attempt
+    """
+    _write_journal(
+        {"key": _journal_key(site, date), "flow_type": result[1], "error": result[2]}
+    )
+
+
+def close_journal():
+    if "fd" in RUN_JOURNAL:
+        os.close(RUN_JOURNAL.pop("fd"))
+
+
+def open_work_queue(path, sites, date):
+    """
+    Open the work queue of a sweep shared by several nodes. A node joins
+    the unfinished sweep if any, otherwise it starts the sweep of date
+    adding every flow of its configuration (adding them again is a no-op).
+    Returns the connection and the date of the sweep, None if the sweep of
+    date is already finished.
+    """
+    # Rollback journal (not WAL) so that the queue can live in a shared folder
+    conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+    for query in QUERY_CREATE_QUEUE:
+        conn.execute(query)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT date FROM sweeps WHERE finished IS NULL ORDER BY date DESC LIMIT 1"
+        ).fetchone()
+        if row:
+            date = row[0]
+            LOG.info("Joining sweep of %s", date)
+        elif conn.execute("SELECT 1 FROM sweeps WHERE date = ?", (date,)).fetchone():
+            LOG.warning("Sweep of %s already finished in %s", date, path)
+            conn.execute("COMMIT")
+            return conn, None
+        else:
+            conn.execute(
+                "INSERT INTO sweeps(date, started) VALUES(?, ?)", (date, arrow.utcnow().isoformat())
+            )
+            LOG.info("Starting sweep of %s", date)
+        conn.executemany(
+            QUERY_INSERT_WORK,
+            (
+                (
+                    _journal_key(site, date),
+                    date,
+                    position,
+                    _hostname(site),
+                    json.dumps({key: value for key, value in site.items() if key != "steps"}),
+                )
+                for position, site in enumerate(sites)
+            ),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return conn, date
+
+
+def lease_flow(conn, date, node, attempts):
+    """
+    Lease the next flow of the sweep to node, flows abandoned by a dead
+    node are leased again until they used every attempt.
+    Returns the queue key, the site and the attempt, None if there is no
+    flow available right now.
+    """
+    now = time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            QUERY_EXPIRE_WORK, ("Lease expired after %s attempts" % attempts, date, now, attempts)
+        )
+        row = conn.execute(QUERY_NEXT_WORK, (date, now, now, date, now)).fetchone()
+        if row:
+            conn.execute(QUERY_LEASE_WORK, (node, now + LEASE_SECONDS, row[0]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if not row:
+        return None
+    key, site, attempt = row
+    if attempt:
+        LOG.warning("Leasing %s again (attempt %s)", key, attempt + 1)
+    return key, json.loads(site), attempt + 1
+
+
+def complete_flow(conn, key, node, result, delay):
+    """
+    Record the outcome of a leased flow: done, failed or pending until
+    the retry delay (seconds) elapses
+    """
+    error = result[2]
+    if delay is None:
+        conn.execute(QUERY_COMPLETE_WORK, ("failed" if error else "done", error, key, node))
+    else:
+        conn.execute(QUERY_RETRY_WORK, (time() + delay, error, key, node))
+
+
+def finish_sweep(conn, date):
+    """
+    Mark the sweep finished if no flow is pending or leased by any node,
+    returns whether it is finished
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        unfinished = conn.execute(
+            "SELECT count(*) FROM work WHERE date = ? AND state IN ('pending', 'leased')", (date,)
+        ).fetchone()[0]
+        if not unfinished:
+            conn.execute(
+                "UPDATE sweeps SET finished = ? WHERE date = ? AND finished IS NULL",
+                (arrow.utcnow().isoformat(), date),
+            )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return not unfinished
+
+
+def _heartbeat(path, node, stop):
+    """
+    Extend the leases of the node until stop is set, flows may take
+    longer than a lease
+    """
+    conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+    try:
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                conn.execute(QUERY_HEARTBEAT, (time() + LEASE_SECONDS, node))
+            except sqlite3.Error as e:
+                LOG.warning("Could not extend the leases of %s: %s", node, e)
+    finally:
+        conn.close()
+
+
+def _retry(result, params, lost=None):
+    """
+    Seconds to wait before retrying a failed flow, None if it should not
+    be retried: it succeeded, failed for a deterministic reason or has
+    no attempts left. lost is the attempt of a flow lost along with its
+    worker process, a transient failure without timings.
+    """
+    url, flow_type, error, timings = result
+    if lost is not None:
+        attempt = lost
+    elif not error or not timings or not timings["transient"]:
+        return None
+    else:
+        attempt = timings["attempt"]
+    if attempt > params.retries:
+        return None
+    delay = params.retry_backoff * 2 ** (attempt - 1)
+    LOG.warning(
+        "Retrying %s %s in %s seconds (attempt %s of %s): %s",
+        url,
+        flow_type,
+        delay,
+        attempt + 1,
+        params.retries + 1,
+        error,
+    )
+    return delay
+
+
+def _available_memory_mb():
+    """
+    Memory available for new processes, None where it can not be read
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _cpu_load():
+    """
+    Load average of the last minute per cpu, None where not available
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def new_scaler(maximum, adaptive=False, flow_mb=ADAPTIVE_FLOW_MB):
+    """
+    Concurrency of a run: fixed to maximum or, if adaptive, starting with
+    a single flow and following the resources of the machine
+    """
+    return {
+        "limit": 1 if adaptive else maximum,
+        "maximum": maximum,
+        "adaptive": adaptive,
+        "flow_mb": flow_mb,
+        "durations": deque(maxlen=ADAPTIVE_WINDOW),
+        "best": None,
+        "next": monotonic() + ADAPTIVE_INTERVAL,
+    }
+
+
+def record_flow_duration(scaler, timings):
+    """
+    Follow the launch and page load times of the flows, they grow with
+    the contention of the machine unlike the waits of the flow steps
+    """
+    if scaler["adaptive"] and timings and not timings["error"]:
+        phases = timings["phases"]
+        scaler["durations"].append(phases.get("launch", 0) + phases.get("load", 0))
+
+
+def adjust_concurrency(scaler, running):
+    """
+    Grow the number of concurrent flows by one while every slot is busy
+    and the machine has memory and cpu to spare, shrink it when it runs
+    out of them or flows slow down. Returns the current limit.
+    """
+    now = monotonic()
+    if not scaler["adaptive"] or now < scaler["next"]:
+        return scaler["limit"]
+    scaler["next"] = now + ADAPTIVE_INTERVAL
+    memory = _available_memory_mb()
+    load = _cpu_load()
+    durations = scaler["durations"]
+    slowdown = None
+    if len(durations) >= ADAPTIVE_WINDOW // 2:
+        median = percentile(list(durations), 50)
+        if len(durations) == ADAPTIVE_WINDOW:
+            scaler["best"] = median if scaler["best"] is None else min(scaler["best"], median)
+        if scaler["best"]:
+            slowdown = median / scaler["best"]
+    limit = scaler["limit"]
+    if memory is not None and memory < ADAPTIVE_MIN_MB:
+        limit = max(limit // 2, 1)
+    elif (load is not None and load > ADAPTIVE_MAX_LOAD) or (slowdown or 0) > ADAPTIVE_SLOWDOWN:
+        limit = max(limit - 1, 1)
+    elif (
+        running >= limit
+        and limit < scaler["maximum"]
+        and (memory is None or memory > ADAPTIVE_MIN_MB + scaler["flow_mb"])
+        and (load is None or load < ADAPTIVE_SCALE_UP_LOAD)
+    ):
+        limit += 1
+    if limit != scaler["limit"]:
+        LOG.info(
+            "Concurrent flows %s -> %s (available memory %s MB, load %s, launch and load slowdown %s)",
+            scaler["limit"],
+            limit,
+            "%.0f" % memory if memory is not None else "?",
+            "%.2f" % load if load is not None else "?",
+            "%.2f" % slowdown if slowdown is not None else "?",
+        )
+        scaler["limit"] = limit
+        # Durations measured with the previous concurrency do not count
+        durations.clear()
+    return limit
+
+
+def _hostname(site):
+    return urlparse(site["url"]).hostname
+
+
+def next_flow(ready, busy_hosts):
+    """
+    Take the first ready flow whose site is not being visited by another
+    flow, so that the flows of a site do not hit it at the same time.
+    Returns None if every ready flow is waiting for its site.
+    """
+    for index, (position, attempt, site) in enumerate(ready):
+        if _hostname(site) not in busy_hosts:
+            return ready.pop(index)
+    return None
+
+
+def _run_sequential(sites, today, params):
+    """
+    Process every site one after another in the current process, failed
+    flows are retried once every other site has been processed
+    """
+    results = []
+    # (not before, position, attempt, site)
+    pending = [(0, position, 1, site) for position, site in enumerate(sites)]
+    while pending:
+        not_before, position, attempt, site = heapq.heappop(pending)
+        try:
+            if not_before > monotonic():
+                sleep(not_before - monotonic())
+            # flow type gets the browser options suffixes, retry the original
+            result = process_site(dict(site), today, params, attempt)
+        except (KeyboardInterrupt, SystemExit):
+            sys.exit()
+        record_timings(result, params)
+        delay = _retry(result, params)
+        if delay is None:
+            results.append(result)
+            record_journal(site, today, result)
+        else:
+            heapq.heappush(pending, (monotonic() + delay, position, attempt + 1, site))
+    return results
+
+
+def _worker_pool(params, handlers):
+    """
+    Pool of worker processes whose logs are merged into the handlers of
+    the parent through the returned listener. A plain queue is enough as
+    it only reaches the workers through the initializer arguments.
+    """
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    executor = ProcessPoolExecutor(
+        max_workers=params.workers,
+        initializer=_worker_init,
+        initargs=(log_queue, LOG.getEffectiveLevel()),
+    )
+    return executor, listener
+
+
+def _restart_pool(executor, listener, params, handlers):
+    """
+    Replace a pool broken by the death of one of its workers, killed when
+    the machine runs out of memory: it takes every running flow with it
+    and accepts no more flows
+    """
+    executor.shutdown(wait=False)
+    listener.stop()
+    return _worker_pool(params, handlers)
+
+
+def _wait_flows(futures, timeout):
+    """
+    Wait for the first flows to finish. When the pool is broken every
+    running flow fails with it, all of them are returned along with
+    whether the pool must be restarted.
+    """
+    done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+    broken = any(isinstance(future.exception(), BrokenExecutor) for future in done)
+    if broken:
+        done, _ = wait(futures)
+    return done, broken
+
+
+def _run_parallel(sites, today, params, handlers):
+    """
+    Process sites over a pool of worker processes, each one with its own
+    chrome profile. Worker logs are merged into the parent handlers.
+    Flows of the same site are never processed at the same time, with
+    --adaptive the number of concurrent flows follows the machine
+    resources up to the number of workers. Failed flows are submitted
+    again once their backoff has elapsed.
+    """
+    executor, listener = _worker_pool(params, handlers)
+    interrupted = False
+    results = []
+    scaler = new_scaler(params.workers, params.adaptive)
+    futures = {}
+    # (position, attempt, site) ready to be processed
+    ready = [(position, 1, site) for position, site in enumerate(sites)]
+    # (not before, position, attempt, site)
+    pending = []
+    try:
+        while ready or futures or pending:
+            while pending and pending[0][0] <= monotonic():
+                _, position, attempt, site = heapq.heappop(pending)
+                ready.append((position, attempt, site))
+            limit = adjust_concurrency(scaler, len(futures))
+            busy_hosts = {_hostname(site) for _, _, site in futures.values()}
+            while len(futures) < limit:
+                flow = next_flow(ready, busy_hosts)
+                if flow is None:
+                    break
+                position, attempt, site = flow
+                future = executor.submit(process_site, site, today, params, attempt)
+                futures[future] = flow
+                busy_hosts.add(_hostname(site))
+            timeouts = [pending[0][0] - monotonic()] if pending else []
+            if params.adaptive:
+                timeouts.append(scaler["next"] - monotonic())
+            timeout = max(min(timeouts), 0) if timeouts else None
+            if not futures:
+                sleep(timeout)
+                continue
+            done, broken = _wait_flows(futures, timeout)
+            for future in done:
+                position, attempt, site = futures.pop(future)
+                lost = None
+                try:
+                    result = future.result()
+                except BrokenExecutor as e:
+                    LOG.error("Worker lost while processing %s: %s", site["url"], e)
+                    result = (site["url"], site["flow_type"], repr(e), None)
+                    lost = attempt
+                except Exception as e:
+                    LOG.error("Worker failed while processing %s: %s", site["url"], e)
+                    result = (site["url"], site["flow_type"], repr(e), None)
+                record_timings(result, params)
+                record_flow_duration(scaler, result[3])
+                delay = _retry(result, params, lost)
+                if delay is None:
+                    results.append(result)
+                    # A flow lost with its worker is run again on --resume
+                    if lost is None:
+                        record_journal(site, today, result)
+                else:
+                    heapq.heappush(pending, (monotonic() + delay, position, attempt + 1, site))
+            if broken:
+                executor, listener = _restart_pool(executor, listener, params, handlers)
+    except (KeyboardInterrupt, SystemExit):
+        for future in futures:
+            future.cancel()
+        interrupted = True
+        sys.exit()
+    finally:
+        # Do not wait for the running flows after an interrupt
+        executor.shutdown(wait=not interrupted)
+        listener.stop()
+    # Each worker leaves its profile behind
+    for profile in glob.glob("%s*" % WORKER_PROFILE_PREFIX):
+        rmtree(profile, ignore_errors=True)
+    return results
+
+
+def _run_queue(queue, date, params, handlers):
+    """
+    Process the flows leased from the work queue of a sweep over a pool of
+    worker processes until no flow is left for any node. Leases are
+    extended while the flows run, a failed flow goes back to the queue so
+    that any node retries it once its backoff has elapsed.
+    """
+    node = params.node
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(params.queue, node, stop), daemon=True)
+    heartbeat.start()
+    executor, listener = _worker_pool(params, handlers)
+    interrupted = False
+    results = []
+    scaler = new_scaler(params.workers, params.adaptive)
+    futures = {}
+    try:
+        while True:
+            limit = adjust_concurrency(scaler, len(futures))
+            while len(futures) < limit:
+                leased = lease_flow(queue, date, node, params.retries + 1)
+                if leased is None:
+                    break
+                key, site, attempt = leased
+                futures[executor.submit(process_site, site, date, params, attempt)] = (key, site, attempt)
+            if not futures:
+                if finish_sweep(queue, date):
+                    break
+                # Flows leased by other nodes or waiting for their retry
+                sleep(QUEUE_POLL_SECONDS)
+                continue
+            timeout = QUEUE_POLL_SECONDS
+            if params.adaptive:
+                timeout = max(min(timeout, scaler["next"] - monotonic()), 0)
+            done, broken = _wait_flows(futures, timeout)
+            for future in done:
+                key, site, attempt = futures.pop(future)
+                lost = None
+                try:
+                    result = future.result()
+                except BrokenExecutor as e:
+                    LOG.error("Worker lost while processing %s: %s", site["url"], e)
+                    result = (site["url"], site["flow_type"], repr(e), None)
+                    lost = attempt
+                except Exception as e:
+                    LOG.error("Worker failed while processing %s: %s", site["url"], e)
+                    result = (site["url"], site["flow_type"], repr(e), None)
+                record_timings(result, params)
+                record_flow_duration(scaler, result[3])
+                delay = _retry(result, params, lost)
+                complete_flow(queue, key, node, result, delay)
+                if delay is None:
+                    results.append(result)
+            if broken:
+                executor, listener = _restart_pool(executor, listener, params, handlers)
+    except (KeyboardInterrupt, SystemExit):
+        # Hand the running flows back to the other nodes
+        queue.execute(QUERY_RELEASE_WORK, (node,))
+        for future in futures:
+            future.cancel()
+        interrupted = True
+        sys.exit()
+    finally:
+        stop.set()
+        # Do not wait for the running flows after an interrupt
+        executor.shutdown(wait=not interrupted)
+        listener.stop()
+    for profile in glob.glob("%s*" % WORKER_PROFILE_PREFIX):
+        rmtree(profile, ignore_errors=True)
+    return results
+
+
+def export_failed(results, path):
+    """
+    Write the flows that failed in the run with their last error
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER_FAILED)
+        for url, flow_type, error, timings in results:
+            if error:
+                writer.writerow(
+                    [
+                        url,
+                        flow_type,
+                        timings["attempt"] if timings else 1,
+                        int(bool(timings and timings["transient"])),
+                        error,
+                    ]
+                )
+
+
+def run(params):
+    """
+    Analyze cookies for a given site
+    """
+    start = monotonic()
+    # Configure logging
+    handlers = _set_logging()
+
+    # Create output folders if needed
+    if not os.path.exists(DATA_PATH):
+        os.makedirs(DATA_PATH)
+
+    # Configuration files are parsed while their flows are compiled, every
+    # flow is kept as malformed flows are rejected before launching any
+    # browser and flows are scheduled spreading the load of each site
+    config_sites = compile_sites(_config()["sites"], params)
+    now = arrow.utcnow()
+    queue = None
+    if params.queue:
+        if params.contexts:
+            raise ValueError("--queue runs flows in worker processes, it can not be used with --contexts")
+        # The queue keeps track of the flows completed by every node
+        queue, today = open_work_queue(params.queue, config_sites, now.format("YYYYMMDD"))
+        if today is None:
+            return
+        sites = []
+    else:
+        # A resumed run keeps storing results under the date it started
+        today, done = open_journal(params.resume, now.format("YYYYMMDD"))
+        sites = [site for site in config_sites if _journal_key(site, today) not in done]
+    if params.sink == "jsonl":
+        # Nodes of a sweep may share the data folder
+        params.results_path = os.path.join(
+            DATA_PATH,
+            "results_%s%s.jsonl"
+            % (now.format("YYYYMMDD_HHmmss"), "_%s" % params.node if queue else ""),
+        )
+        LOG.info("Storing results in %s", params.results_path)
+    elif params.sink == "database":
+        # Create or upgrade the schema once before any worker uses it
+        open_result_sink(params)
+        close_result_sink()
+
+    try:
+        if queue:
+            LOG.info("Processing flows of the sweep of %s as node %s", today, params.node)
+            try:
+                results = _run_queue(queue, today, params, handlers)
+            finally:
+                queue.close()
+        elif params.contexts:
+            LOG.info("Processing %s flows in up to %s browser contexts", len(sites), params.contexts)
+            try:
+                results = _triki_cdp().run_contexts(sites, today, params)
+            finally:
+                close_result_sink()
+        elif params.workers > 1:
+            LOG.info("Processing %s flows with %s workers", len(sites), params.workers)
+            results = _run_parallel(sites, today, params, handlers)
+        else:
+            try:
+                results = _run_sequential(sites, today, params)
+            finally:
+                close_browser_pool()
+                close_result_sink()
+    finally:
+        close_journal()
+        close_screenshot_writer()
+
+    failed = [result for result in results if result[2]]
+    LOG.info("Processed %s flows, %s failed", len(results), len(failed))
+    for url, flow_type, error, _ in failed:
+        LOG.warning("Failed %s %s: %s", url, flow_type, error)
+    if failed:
+        failed_path = os.path.join(
+            DATA_PATH, "failed_%s.csv" % now.format("YYYYMMDD_HHmmss")
+        )
+        export_failed(results, failed_path)
+        LOG.info("Failed flows written to %s", failed_path)
+    summarize_timings(results)
+    if params.metrics and params.metrics.endswith(".prom"):
+        export_prometheus(results, params.metrics, monotonic() - start)
 
     # Delete last profile from selenium execution adding more time for windows
     if platform.system() == "Windows":
@@ -477,5 +2546,50 @@ def run():
         rmtree(PROFILE_PATH)
 
 
+def _arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", "-w", dest="workers", type=int, default=1,
+                        help="Number of sites processed in parallel, each worker uses its own chrome profile")
+    parser.add_argument("--adaptive", action="store_true", default=False, dest="adaptive",
+                        help="Scale the flows processed at the same time up to --workers (or --contexts) following free memory, cpu load and flow slowdowns")
+    parser.add_argument("--warm-browsers", dest="warm_browsers", type=int, default=0,
+                        help="Keep up to N browsers alive per worker and reset them between flows instead of relaunching chrome")
+    parser.add_argument("--contexts", dest="contexts", type=int, default=0,
+                        help="Run up to N flows at the same time, each one in an isolated context of a single chrome driven through the DevTools protocol")
+    parser.add_argument("--headless", action="store_true", default=False, dest="headless",
+                        help="Run chrome headless reading cookies through the DevTools protocol")
+    parser.add_argument("--sink", dest="sink", choices=["csv", "database", "jsonl", "delta"], default="csv",
+                        help="Where flow results are stored: csv files per flow, the analysis sqlite database, a results file per run or a cookies delta log per flow")
+    parser.add_argument("--page-timeout", dest="page_timeout", type=float, default=60,
+                        help="Seconds to wait for a page to load, 0 waits forever")
+    parser.add_argument("--flow-timeout", dest="flow_timeout", type=float, default=600,
+                        help="Deadline in seconds of a whole flow, its browser is killed once expired, 0 disables it")
+    parser.add_argument("--retries", dest="retries", type=int, default=2,
+                        help="Times a flow that failed for a transient reason (timeouts, browser crashes...) is retried")
+    parser.add_argument("--retry-backoff", dest="retry_backoff", type=float, default=30,
+                        help="Seconds before the first retry of a flow, doubled on every retry")
+    parser.add_argument("--block-resources", dest="block_resources", nargs="+", default=[],
+                        help="Resource types (image, font, media) or url patterns blocked in the flows of sites without block_resources")
+    parser.add_argument("--shared-cache", action="store_true", default=False, dest="shared_cache",
+                        help="Share the HTTP cache between the flows of each site, cookies and storage stay in each flow profile")
+    parser.add_argument("--resume", action="store_true", default=False, dest="resume",
+                        help="Continue the last run skipping the flows it already completed")
+    parser.add_argument("--queue", dest="queue", type=str, default=None,
+                        help="sqlite work queue shared by the nodes of a sweep, every node leases flows from it until none is left")
+    parser.add_argument("--node", dest="node", type=str, default="%s_%s" % (platform.node(), os.getpid()),
+                        help="Name of this node in the work queue and its results files")
+    parser.add_argument("--metrics", dest="metrics", type=str, default=None,
+                        help="Append the timings of every flow to this file as json lines, or write a prometheus textfile if it ends with .prom")
+    parser.add_argument("--database", dest="database", type=str,
+                        default=os.path.join(ANALYSIS_PATH, "db", "site_cookies.db"),
+                        help="sqlite database used by --sink database")
+    parser.add_argument("--thumbnails", action="store_true", default=False, dest="thumbnails",
+                        help="Store a thumbnail next to every screenshot (needs Pillow)")
+    parser.add_argument("--settle", action="store_true", default=False, dest="settle",
+                        help="Turn sleep steps into settle waits, using the sleep value as the maximum wait")
+    return parser
+
+
 if __name__ == "__main__":
-    run()
+    params = _arg_parser().parse_args()
+    run(params)
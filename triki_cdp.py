@@ -0,0 +1,986 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Runs Triki flows concurrently as isolated browser contexts of a single
+   chrome driven through the DevTools protocol with asyncio. Every flow
+   gets its own context (cookies, storage and cache are not shared with
+   the other flows) and runs the same steps as the selenium flows, a
+   context costs a fraction of the memory of a whole browser."""
+import asyncio
+import base64
+import heapq
+import json
+import logging
+import os
+import platform
+import struct
+from asyncio import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from shutil import rmtree, which
+from subprocess import DEVNULL
+from time import monotonic
+from urllib.parse import urlparse
+
+from selenium.common.exceptions import (ElementNotInteractableException,
+                                        NoSuchElementException,
+                                        NoSuchFrameException,
+                                        TimeoutException, WebDriverException)
+
+import triki
+
+# Chrome executables looked up in the path, TRIKI_CHROME_BINARY overrides them
+CHROME_BINARIES = ["google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome"]
+CHROME_MAC_BINARY = "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"
+CHROME_LAUNCH_SECONDS = 30
+# Same poll frequency as selenium waits
+POLL_SECONDS = 0.5
+# Frames of other sites run in the process of the page, so that they are
+# reachable from its target like they are for chromedriver
+CHROME_ARGS = [
+    "--remote-debugging-port=0",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--disable-site-isolation-trials",
+    "--disable-features=IsolateOrigins,site-per-process",
+    "--window-size=1920,1080",
+    "--log-level=3",
+]
+# Browsers of the run keyed by their chrome prefs
+CONTEXT_BROWSERS = {}
+# Thread running the blocking work of the flows, see run_blocking
+IO_EXECUTOR = {}
+# Free memory needed to run one more flow with --adaptive, a context is
+# a tab of a running browser
+CONTEXT_FLOW_MB = 150
+
+# Browser side functions, `this` is the element when called over one
+LOCATE_ELEMENT_FUNCTION = "function () {%s}" % triki.LOCATE_ELEMENT_SCRIPT
+FRAME_BY_INDEX_FUNCTION = """function (index) {
+    return document.querySelectorAll("iframe, frame")[index] || null;
+}"""
+FRAME_OFFSET_FUNCTION = """function () {
+    var rect = this.getBoundingClientRect();
+    return [rect.left + this.clientLeft, rect.top + this.clientTop];
+}"""
+ELEMENT_BOX_FUNCTION = """function () {
+    this.scrollIntoView({block: "center", inline: "center"});
+    var rect = this.getBoundingClientRect();
+    var hit = document.elementFromPoint(rect.left + rect.width / 2, rect.top + rect.height / 2);
+    return {x: rect.left, y: rect.top, width: rect.width, height: rect.height,
+            reachable: hit !== null && (hit === this || this.contains(hit))};
+}"""
+ELEMENT_STATE_FUNCTION = """function () {
+    var style = window.getComputedStyle(this);
+    return {visible: this.getClientRects().length > 0 && style.visibility !== "hidden",
+            enabled: !this.disabled};
+}"""
+JAVASCRIPT_CLICK_FUNCTION = """function () {
+    this.scrollIntoView(true);
+    this.click();
+}"""
+CLEAR_FUNCTION = """function () {
+    this.scrollIntoView({block: "center"});
+    this.focus();
+    if ("value" in this) {
+        this.value = "";
+        this.dispatchEvent(new Event("input", {bubbles: true}));
+        this.dispatchEvent(new Event("change", {bubbles: true}));
+    }
+}"""
+SUBMIT_FUNCTION = """function () {
+    var form = this.tagName === "FORM" ? this : this.form;
+    if (!form) {
+        return false;
+    }
+    if (form.requestSubmit) {
+        form.requestSubmit();
+    } else {
+        form.submit();
+    }
+    return true;
+}"""
+# Element states required by the conditions of delay steps
+DELAY_STATES = {
+    "element_to_be_clickable": lambda state: state["visible"] and state["enabled"],
+    "presence_of_element_located": lambda state: True,
+    "visibility_of_element_located": lambda state: state["visible"],
+}
+
+LOG = logging.getLogger()
+
+
+def _ws_mask(payload, mask):
+    """
+    Mask a websocket payload, xor over big integers is much faster than
+    a loop over its bytes
+    """
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+
+def _ws_frame(opcode, payload):
+    """
+    Single masked websocket frame, as required for clients
+    """
+    length = len(payload)
+    header = bytes([0x80 | opcode])
+    if length < 126:
+        header += bytes([0x80 | length])
+    elif length < 65536:
+        header += bytes([0x80 | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+    mask = os.urandom(4)
+    return header + mask + _ws_mask(payload, mask)
+
+
+async def _ws_connect(url):
+    """
+    Open the websocket of the DevTools protocol
+    """
+    parsed = urlparse(url)
+    reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    writer.write(
+        (
+            "GET %s HTTP/1.1\r\n"
+            "Host: %s:%s\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: %s\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n" % (parsed.path, parsed.hostname, parsed.port, key)
+        ).encode("ascii")
+    )
+    response = await reader.readuntil(b"\r\n\r\n")
+    if not response.startswith(b"HTTP/1.1 101"):
+        writer.close()
+        raise ConnectionError(
+            "DevTools refused the websocket: %s" % response.split(b"\r\n")[0].decode("latin1")
+        )
+    return reader, writer
+
+
+async def _ws_receive(reader, writer):
+    """
+    Read the next text message, answering pings on the way
+    """
+    message = b""
+    while True:
+        head = await reader.readexactly(2)
+        final, opcode = head[0] & 0x80, head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        mask = await reader.readexactly(4) if head[1] & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = _ws_mask(payload, mask)
+        if opcode == 0x8:
+            raise ConnectionError("DevTools closed the websocket")
+        if opcode == 0x9:
+            writer.write(_ws_frame(0xA, payload))
+            continue
+        if opcode == 0xA:
+            continue
+        message += payload
+        if final:
+            return message.decode("utf8")
+
+
+async def _dispatch(connection):
+    """
+    Resolve the pending commands and notify the event listeners of a
+    connection until it is closed, then fail every pending command
+    """
+    try:
+        while True:
+            message = json.loads(await _ws_receive(connection["reader"], connection["writer"]))
+            if "id" in message:
+                future, method = connection["pending"].pop(message["id"], (None, None))
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(
+                        WebDriverException("%s: %s" % (method, message["error"].get("message")))
+                    )
+                else:
+                    future.set_result(message.get("result", {}))
+            else:
+                key = (message.get("sessionId"), message["method"])
+                for listener in list(connection["listeners"].get(key, [])):
+                    listener(message.get("params", {}))
+    except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+        connection["closed"] = ConnectionError("DevTools connection lost: %r" % e)
+        for future, _ in connection["pending"].values():
+            if not future.done():
+                future.set_exception(connection["closed"])
+        connection["pending"].clear()
+
+
+async def cdp(connection, method, params=None, session=None):
+    """
+    Send a DevTools protocol command to the browser or to the target
+    attached as session and wait for its result
+    """
+    if connection["closed"]:
+        raise connection["closed"]
+    connection["last_id"] += 1
+    message = {"id": connection["last_id"], "method": method, "params": params or {}}
+    if session:
+        message["sessionId"] = session
+    future = asyncio.get_running_loop().create_future()
+    connection["pending"][message["id"]] = (future, method)
+    connection["writer"].write(_ws_frame(0x1, json.dumps(message).encode("utf8")))
+    await connection["writer"].drain()
+    return await future
+
+
+def listen(connection, session, method, listener):
+    """
+    Call listener with the params of every event of a session (None for
+    browser events), returns the function that stops listening
+    """
+    listeners = connection["listeners"].setdefault((session, method), [])
+    listeners.append(listener)
+    return lambda: listeners.remove(listener)
+
+
+def _chrome_binary():
+    """
+    Chrome executable launched for the browser contexts
+    """
+    binary = os.getenv("TRIKI_CHROME_BINARY")
+    if binary:
+        return binary
+    if platform.system() == "Darwin" and os.path.exists(CHROME_MAC_BINARY):
+        return CHROME_MAC_BINARY
+    for name in CHROME_BINARIES:
+        binary = which(name)
+        if binary:
+            return binary
+    raise FileNotFoundError(
+        "Chrome not found in the path (%s), set TRIKI_CHROME_BINARY" % ", ".join(CHROME_BINARIES)
+    )
+
+
+def _context_prefs(prefs):
+    """
+    Chrome prefs as stored in the Preferences file of a profile. Contexts
+    are off the record profiles and chrome blocks third party cookies in
+    them by default, they only do when the site asks for it.
+    """
+    prefs = dict(prefs)
+    prefs["profile.cookie_controls_mode"] = 1 if prefs.get("profile.block_third_party_cookies") else 0
+    nested = {}
+    for key, value in prefs.items():
+        parent = nested
+        parts = key.split(".")
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[parts[-1]] = value
+    return nested
+
+
+async def launch_browser(prefs, profile_path, headless=False):
+    """
+    Launch chrome with the prefs and connect to its DevTools websocket
+    """
+    if os.path.exists(profile_path):
+        rmtree(profile_path)
+    os.makedirs(os.path.join(profile_path, "Default"))
+    with open(os.path.join(profile_path, "Default", "Preferences"), "w", encoding="utf8") as f:
+        json.dump(_context_prefs(prefs), f)
+    args = [_chrome_binary(), "--user-data-dir=%s" % profile_path] + CHROME_ARGS
+    if headless:
+        args.append("--headless=new")
+    process = await asyncio.create_subprocess_exec(
+        *args, "about:blank", stdout=DEVNULL, stderr=DEVNULL
+    )
+    # With port 0 chrome writes the port and path of its websocket there
+    port_file = os.path.join(profile_path, "DevToolsActivePort")
+    deadline = monotonic() + CHROME_LAUNCH_SECONDS
+    lines = []
+    while len(lines) < 2:
+        if process.returncode is not None or monotonic() > deadline:
+            if process.returncode is None:
+                process.kill()
+            raise WebDriverException("Chrome did not start with profile %s" % profile_path)
+        await asyncio.sleep(0.1)
+        if os.path.exists(port_file):
+            with open(port_file, encoding="utf8") as f:
+                lines = f.read().split()
+    reader, writer = await _ws_connect("ws://127.0.0.1:%s%s" % (lines[0], lines[1]))
+    connection = {
+        "reader": reader,
+        "writer": writer,
+        "last_id": 0,
+        "pending": {},
+        "listeners": {},
+        "closed": None,
+    }
+    connection["task"] = asyncio.ensure_future(_dispatch(connection))
+    version = await cdp(connection, "Browser.getVersion")
+    LOG.info("Launched %s for browser contexts", version["product"])
+    return {
+        "process": process,
+        "connection": connection,
+        "profile_path": profile_path,
+        # Sites may show a different banner (or none) to headless chrome
+        "user_agent": version["userAgent"].replace("HeadlessChrome", "Chrome"),
+    }
+
+
+async def close_browser(browser):
+    """
+    Close the DevTools connection and chrome, killing any process left
+    """
+    browser["connection"]["writer"].close()
+    browser["connection"]["task"].cancel()
+    if browser["process"].returncode is None:
+        browser["process"].terminate()
+        try:
+            await asyncio.wait_for(browser["process"].wait(), triki.CACHE_RELEASE_SECONDS)
+        except asyncio.TimeoutError:
+            browser["process"].kill()
+    triki.kill_browser_processes(browser["profile_path"])
+    rmtree(browser["profile_path"], ignore_errors=True)
+
+
+async def acquire_context_browser(prefs, params):
+    """
+    Browser of the run for the prefs, launched on first use and again if
+    it crashed. Chrome prefs can only be set at launch, so there is a
+    browser for each combination of them.
+    """
+    key = json.dumps(prefs, sort_keys=True)
+    entry = CONTEXT_BROWSERS.setdefault(key, {"lock": asyncio.Lock(), "browser": None})
+    async with entry["lock"]:
+        browser = entry["browser"]
+        if browser is None or browser["connection"]["closed"]:
+            if browser is not None:
+                LOG.warning("Browser for contexts lost, launching it again")
+                await close_browser(browser)
+            profile_path = "%s_contexts_%s" % (triki.PROFILE_PATH, list(CONTEXT_BROWSERS).index(key))
+            entry["browser"] = await launch_browser(prefs, profile_path, params.headless)
+        return entry["browser"]
+
+
+async def close_context_browsers():
+    """
+    Close every browser of the run
+    """
+    while CONTEXT_BROWSERS:
+        _, entry = CONTEXT_BROWSERS.popitem()
+        if entry["browser"]:
+            await close_browser(entry["browser"])
+
+
+@contextmanager
+def timed(timings, phase):
+    """
+    Account the time spent in the block to a phase of the flow timings,
+    flows run concurrently so they can not use the timings of the process
+    """
+    start = monotonic()
+    try:
+        yield
+    finally:
+        phases = timings["phases"]
+        phases[phase] = phases.get(phase, 0) + monotonic() - start
+
+
+async def open_page(browser, prefs, site):
+    """
+    Create an isolated browser context for the flow with a page in it,
+    returns the page: the target session plus the state of the flow
+    """
+    connection = browser["connection"]
+    context = (await cdp(connection, "Target.createBrowserContext"))["browserContextId"]
+    page = {
+        "connection": connection,
+        "browser_context": context,
+        "session": None,
+        "frame": None,
+        "frames": [],
+        "world": None,
+        "implicit_wait": 0,
+        "inflight": set(),
+        "activity": monotonic(),
+        "stop": [],
+    }
+    try:
+        target = await cdp(
+            connection,
+            "Target.createTarget",
+            {"url": "about:blank", "browserContextId": context, "newWindow": True, "width": 1920, "height": 1080},
+        )
+        page["session"] = (
+            await cdp(connection, "Target.attachToTarget", {"targetId": target["targetId"], "flatten": True})
+        )["sessionId"]
+        await _setup_page(page, browser, prefs, site)
+    except Exception:
+        await close_page(page)
+        raise
+    return page
+
+
+async def _setup_page(page, browser, prefs, site):
+    """
+    Follow the network activity of the page and apply the browser options
+    of the site that are set per page
+    """
+    connection = page["connection"]
+    session = page["session"]
+
+    def request_sent(params):
+        page["inflight"].add(params["requestId"])
+        page["activity"] = monotonic()
+
+    def request_done(params):
+        page["inflight"].discard(params["requestId"])
+
+    page["stop"] = [
+        listen(connection, session, "Network.requestWillBeSent", request_sent),
+        listen(connection, session, "Network.loadingFinished", request_done),
+        listen(connection, session, "Network.loadingFailed", request_done),
+    ]
+    await cdp(connection, "Page.enable", session=session)
+    await cdp(connection, "Network.enable", session=session)
+    await cdp(
+        connection,
+        "Network.setUserAgentOverride",
+        {"userAgent": browser["user_agent"], "acceptLanguage": prefs["intl.accept_languages"]},
+        session,
+    )
+    if prefs.get("enable_do_not_track"):
+        await cdp(connection, "Network.setExtraHTTPHeaders", {"headers": {"DNT": "1"}}, session)
+    if site.get("blocked_urls"):
+        await cdp(connection, "Network.setBlockedURLs", {"urls": site["blocked_urls"]}, session)
+        LOG.debug("Blocking %s", ", ".join(site["blocked_urls"]))
+
+
+async def close_page(page):
+    """
+    Dispose the browser context of the flow along with its pages, cookies
+    and storage
+    """
+    for stop in page["stop"]:
+        stop()
+    if not page["connection"]["closed"]:
+        await cdp(
+            page["connection"],
+            "Target.disposeBrowserContext",
+            {"browserContextId": page["browser_context"]},
+        )
+
+
+async def _page_cmd(page, method, params=None):
+    return await cdp(page["connection"], method, params, page["session"])
+
+
+async def load(page, url, timeout):
+    """
+    Navigate the page to url and wait for its load event like driver.get
+    """
+    loaded = asyncio.get_running_loop().create_future()
+
+    def load_fired(params):
+        if not loaded.done():
+            loaded.set_result(params)
+
+    stop = listen(page["connection"], page["session"], "Page.loadEventFired", load_fired)
+    try:
+        navigation = await _page_cmd(page, "Page.navigate", {"url": url})
+        if navigation.get("errorText"):
+            raise WebDriverException("unknown error: %s" % navigation["errorText"])
+        # Events never arrive once the connection is lost
+        done, _ = await asyncio.wait(
+            [loaded, page["connection"]["task"]], timeout=timeout or None, return_when=FIRST_COMPLETED
+        )
+        if page["connection"]["closed"]:
+            raise page["connection"]["closed"]
+        if not done:
+            raise TimeoutException("Timed out receiving message from renderer: %s" % timeout)
+    finally:
+        stop()
+    page["frame"] = (await _page_cmd(page, "Page.getFrameTree"))["frameTree"]["frame"]["id"]
+    page["frames"] = []
+    page["world"] = None
+
+
+async def _call(page, function, *args, object_id=None, by_value=False):
+    """
+    Call a function browser side in the current frame, over the element
+    object_id if given. Scripts run in an isolated world of the frame,
+    created again if a navigation destroyed it.
+    """
+    params = {
+        "functionDeclaration": function,
+        "arguments": [{"value": arg} for arg in args],
+        "returnByValue": by_value,
+        "awaitPromise": True,
+    }
+    if object_id:
+        params["objectId"] = object_id
+        result = await _page_cmd(page, "Runtime.callFunctionOn", params)
+    else:
+        for attempt in range(2):
+            if page["world"] is None:
+                page["world"] = (
+                    await _page_cmd(
+                        page, "Page.createIsolatedWorld", {"frameId": page["frame"], "worldName": "triki"}
+                    )
+                )["executionContextId"]
+            params["executionContextId"] = page["world"]
+            try:
+                result = await _page_cmd(page, "Runtime.callFunctionOn", params)
+                break
+            except WebDriverException:
+                page["world"] = None
+                if attempt:
+                    raise
+    if "exceptionDetails" in result:
+        details = result["exceptionDetails"]
+        raise WebDriverException(
+            "javascript error: %s" % details.get("exception", {}).get("description", details.get("text"))
+        )
+    return result["result"].get("value") if by_value else result["result"]
+
+
+def _xpath_literal(value):
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    return "concat(%s)" % ", '\"', ".join('"%s"' % part for part in value.split('"'))
+
+
+def _locator(el):
+    """
+    Locator strategy and value resolved browser side, link texts are
+    located through xpath
+    """
+    if el["by"] == "link text":
+        return "xpath", "//a[normalize-space(.)=%s]" % _xpath_literal(el["value"].strip())
+    if el["by"] == "partial link text":
+        return "xpath", "//a[contains(., %s)]" % _xpath_literal(el["value"])
+    return el["by"], el["value"]
+
+
+async def _locate_element(page, el):
+    """
+    Locate an element of the current frame honouring the implicit wait
+    set by delay steps, returns its remote object id
+    """
+    by, value = _locator(el)
+    match = el["match"].strip().lower() if el.get("multiple") else ""
+    deadline = monotonic() + page["implicit_wait"]
+    while True:
+        element = await _call(page, LOCATE_ELEMENT_FUNCTION, by, value, match)
+        if element.get("objectId"):
+            return element["objectId"]
+        if monotonic() >= deadline:
+            LOG.error("Could not locate the element in the page: %s", el)
+            raise NoSuchElementException("Unable to locate element: %s" % el)
+        await asyncio.sleep(POLL_SECONDS)
+
+
+async def _element_box(page, element):
+    """
+    Scroll the element into view and return its box in the coordinates of
+    the page viewport and whether its center receives clicks
+    """
+    box = await _call(page, ELEMENT_BOX_FUNCTION, object_id=element, by_value=True)
+    for frame_element in page["frames"]:
+        x, y = await _call(page, FRAME_OFFSET_FUNCTION, object_id=frame_element, by_value=True)
+        box["x"] += x
+        box["y"] += y
+    return box
+
+
+async def screenshot(page, el, filepath, filename=None, thumbnail=False):
+    """
+    takes a screenshot of an element or the whole site, stored in the
+    background (see triki.save_screenshot)
+    """
+    if not el:
+        el = {"by": "tag name", "value": "body"}
+    if not filename:
+        filename = el["value"].replace(".", "_")
+    box = await _element_box(page, await _locate_element(page, el))
+    metrics = await _page_cmd(page, "Page.getLayoutMetrics")
+    viewport = metrics.get("cssVisualViewport") or metrics["visualViewport"]
+    shot = await _page_cmd(
+        page,
+        "Page.captureScreenshot",
+        {
+            "format": "png",
+            "captureBeyondViewport": True,
+            "clip": {
+                "x": box["x"] + viewport["pageX"],
+                "y": box["y"] + viewport["pageY"],
+                "width": box["width"],
+                "height": box["height"],
+                "scale": 1,
+            },
+        },
+    )
+    await run_blocking(
+        triki.save_screenshot,
+        base64.b64decode(shot["data"]),
+        "%s/banner_cookies_%s.png" % (filepath, filename),
+        thumbnail,
+    )
+
+
+async def navigate_frame(page, el):
+    """
+    navigate to an iframe by index or element
+    """
+    if "index" in el:
+        frame_element = (await _call(page, FRAME_BY_INDEX_FUNCTION, el["index"])).get("objectId")
+        if not frame_element:
+            raise NoSuchFrameException("Unable to locate frame: %s" % el["index"])
+    else:
+        frame_element = await _locate_element(page, el)
+    node = (await _page_cmd(page, "DOM.describeNode", {"objectId": frame_element}))["node"]
+    if not node.get("frameId"):
+        raise NoSuchFrameException("Element is not a frame: %s" % el)
+    page["frame"] = node["frameId"]
+    page["frames"].append(frame_element)
+    page["world"] = None
+
+
+async def click(page, el):
+    """
+    clicks on an element with the mouse, through javascript if asked to or
+    if another element would receive the click
+    """
+    element = await _locate_element(page, el)
+    if "javascript" not in el:
+        box = await _element_box(page, element)
+        if not box["width"] or not box["height"]:
+            raise ElementNotInteractableException("element not interactable: %s" % el)
+        if box["reachable"]:
+            x = box["x"] + box["width"] / 2
+            y = box["y"] + box["height"] / 2
+            for event in ("mousePressed", "mouseReleased"):
+                await _page_cmd(
+                    page,
+                    "Input.dispatchMouseEvent",
+                    {"type": event, "x": x, "y": y, "button": "left", "clickCount": 1},
+                )
+            return
+        LOG.debug("try click through javascript, the element is covered")
+    await _call(page, JAVASCRIPT_CLICK_FUNCTION, object_id=element)
+
+
+async def delay(page, el, value):
+    """
+    Wait for something to happen in the site
+    """
+    if not el:
+        page["implicit_wait"] = value
+        return
+    ready = DELAY_STATES[el.get("condition", "element_to_be_clickable")]
+    by, locator = _locator(el)
+    deadline = monotonic() + value
+    while True:
+        element = await _call(page, LOCATE_ELEMENT_FUNCTION, by, locator, "")
+        if element.get("objectId"):
+            state = await _call(page, ELEMENT_STATE_FUNCTION, object_id=element["objectId"], by_value=True)
+            if ready(state):
+                return
+        if monotonic() >= deadline:
+            LOG.info("Timeout for explicit wait on %s", el)
+            raise NoSuchElementException("Element not ready after waiting %s seconds: %s" % (value, el))
+        await asyncio.sleep(POLL_SECONDS)
+
+
+async def keys(page, el, value):
+    """
+    Type value in an element replacing its content
+    """
+    element = await _locate_element(page, el)
+    await _call(page, CLEAR_FUNCTION, object_id=element)
+    await _page_cmd(page, "Input.insertText", {"text": str(value)})
+
+
+async def submit(page, el):
+    """
+    Submit the form of an element
+    """
+    element = await _locate_element(page, el)
+    if not await _call(page, SUBMIT_FUNCTION, object_id=element, by_value=True):
+        raise NoSuchElementException("Unable to locate enclosing form: %s" % el)
+
+
+async def _context_cookies(page):
+    return (
+        await cdp(page["connection"], "Storage.getCookies", {"browserContextId": page["browser_context"]})
+    )["cookies"]
+
+
+async def settle(page, value, quiet=triki.SETTLE_QUIET_SECONDS):
+    """
+    Wait until the site stops making requests and writing cookies for
+    `quiet` seconds, waiting `value` seconds at most.
+    Returns the seconds actually waited.
+    """
+    start = monotonic()
+    last_activity = start
+    cookies = triki._fingerprint_cookies(await _context_cookies(page))
+    while True:
+        await asyncio.sleep(triki.SETTLE_POLL_SECONDS)
+        now = monotonic()
+        last_activity = max(last_activity, page["activity"])
+        current_cookies = triki._fingerprint_cookies(await _context_cookies(page))
+        if current_cookies != cookies:
+            cookies = current_cookies
+            last_activity = now
+        if len(page["inflight"]) > triki.SETTLE_MAX_INFLIGHT:
+            last_activity = now
+        if now - last_activity >= quiet or now - start >= value:
+            break
+    waited = monotonic() - start
+    LOG.info("Settled after %.1f seconds (quiet %s, max %s)", waited, quiet, value)
+    return waited
+
+
+async def _screenshot_step(page, site_path, el, filename, thumbnail):
+    await screenshot(page, el, site_path, filename, thumbnail)
+
+
+async def _element_step(page, site_path, function, el):
+    await function(page, el)
+
+
+async def _value_step(page, site_path, function, el, value):
+    await function(page, el, value)
+
+
+async def _sleep_step(page, site_path, value):
+    await asyncio.sleep(value)
+
+
+async def _settle_step(page, site_path, value, quiet):
+    return await settle(page, value, quiet)
+
+
+# Coroutines replacing the step functions and actions of the flows compiled
+# by triki.compile_flow
+CONTEXT_STEPS = {
+    triki._screenshot_step: _screenshot_step,
+    triki._element_step: _element_step,
+    triki._value_step: _value_step,
+    triki._sleep_step: _sleep_step,
+    triki._settle_step: _settle_step,
+}
+CONTEXT_ACTIONS = {
+    triki.navigate_frame: navigate_frame,
+    triki.click: click,
+    triki.delay: delay,
+    triki.keys: keys,
+    triki.submit: submit,
+}
+
+
+def compile_steps(steps):
+    """
+    Resolve the coroutines running the steps compiled by triki.compile_flow,
+    raises ValueError for steps that browser contexts can not run
+    """
+    compiled = []
+    for number, (function, args, step) in enumerate(steps, 1):
+        actions = [arg for arg in args if callable(arg)]
+        if function not in CONTEXT_STEPS or any(action not in CONTEXT_ACTIONS for action in actions):
+            raise ValueError("step %s: %s is not supported in browser contexts" % (number, step["action"]))
+        args = tuple(CONTEXT_ACTIONS[arg] if callable(arg) else arg for arg in args)
+        compiled.append((CONTEXT_STEPS[function], args, step))
+    return compiled
+
+
+async def run_blocking(function, *args):
+    """
+    Run blocking work of a flow (queueing screenshots, storing results) in
+    the io thread, started on first use, so that it never stalls the other
+    flows. A single thread keeps the result sink used from one thread.
+    """
+    if not IO_EXECUTOR:
+        IO_EXECUTOR["executor"] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="triki_io")
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR["executor"], function, *args)
+
+
+async def close_io_executor():
+    """
+    Close the result sink opened by the io thread and stop it
+    """
+    if not IO_EXECUTOR:
+        return
+    await run_blocking(triki.close_result_sink)
+    IO_EXECUTOR.pop("executor").shutdown()
+
+
+async def execute_cookies_flow(site, site_path, hostname, params, timings):
+    """
+    Navigates to a site in its own browser context and depending on the
+    selected flow accepts or rejects all the cookies and stores results,
+    screenshots and statistics on the cookies for the site
+    """
+    steps = compile_steps(site.get("steps") or triki.compile_flow(site, params))
+    prefs = triki._site_prefs(site)
+    with timed(timings, "launch"):
+        browser = await acquire_context_browser(prefs, params)
+        page = await open_page(browser, prefs, site)
+    try:
+        waits = []
+        LOG.info("Analysing %s %sing all cookies", site["url"], site["flow_type"])
+        with timed(timings, "load"):
+            await load(page, site["url"], params.page_timeout)
+        os.makedirs(site_path, exist_ok=True)
+        for number, (function, args, step) in enumerate(steps, 1):
+            start = monotonic()
+            with timed(timings, "steps"):
+                waited = await function(page, site_path, *args)
+            timings["steps"].append(
+                {"step": number, "action": step["action"], "seconds": monotonic() - start}
+            )
+            if waited is not None:
+                waits.append(waited)
+            LOG.info("done with step: %s", step)
+        if waits:
+            LOG.info(
+                "Settle waits for %s %s: %s",
+                site["url"],
+                site["flow_type"],
+                ", ".join("%.1f" % waited for waited in waits),
+            )
+        with timed(timings, "cookies"):
+            cookies = triki._map_cdp_cookies(await _context_cookies(page))
+    except Exception as e:
+        LOG.error("Exception while processing flow %s", e)
+        raise
+    finally:
+        with timed(timings, "close"):
+            await close_page(page)
+    with timed(timings, "export"):
+        await run_blocking(triki.export_results, cookies, site, site_path, hostname, params)
+
+
+async def process_site(site, today, params, attempt=1):
+    """
+    Run a single site flow in its own browser context, returns the same
+    results as triki.process_site
+    """
+    error = None
+    transient = False
+    timings = {"phases": {}, "steps": []}
+    start = monotonic()
+    try:
+        LOG.debug(site)
+        url = urlparse(site["url"])
+        site_path = os.path.join(triki.DATA_PATH, url.hostname, today)
+        await asyncio.wait_for(
+            execute_cookies_flow(site, site_path, url.hostname, params, timings),
+            params.flow_timeout or None,
+        )
+    except asyncio.TimeoutError:
+        LOG.error("Flow exceeded its deadline of %s seconds", params.flow_timeout)
+        error = "Flow timeout after %s seconds" % params.flow_timeout
+        transient = True
+    except Exception as e:
+        LOG.error("Found error while processing %s", site["url"])
+        error = repr(e)
+        transient = triki._is_transient(e)
+    wall = monotonic() - start
+    timings.update(
+        {
+            "url": site["url"],
+            "flow_type": site["flow_type"],
+            "date": today,
+            "wall": wall,
+            "error": error,
+            "attempt": attempt,
+            "transient": transient,
+        }
+    )
+    timings["phases"]["other"] = max(wall - sum(timings["phases"].values()), 0)
+    return site["url"], site["flow_type"], error, timings
+
+
+async def _run_contexts(sites, today, params):
+    """
+    Process the flows as tasks of the event loop, the same way as
+    triki._run_parallel processes them in worker processes
+    """
+    scaler = triki.new_scaler(params.contexts, params.adaptive, CONTEXT_FLOW_MB)
+    results = []
+    tasks = {}
+    # (position, attempt, site) ready to be processed
+    ready = [(position, 1, site) for position, site in enumerate(sites)]
+    # (not before, position, attempt, site)
+    pending = []
+    try:
+        while ready or tasks or pending:
+            while pending and pending[0][0] <= monotonic():
+                _, position, attempt, site = heapq.heappop(pending)
+                ready.append((position, attempt, site))
+            limit = triki.adjust_concurrency(scaler, len(tasks))
+            busy_hosts = {triki._hostname(site) for _, _, site in tasks.values()}
+            while len(tasks) < limit:
+                flow = triki.next_flow(ready, busy_hosts)
+                if flow is None:
+                    break
+                position, attempt, site = flow
+                # flow type gets the browser options suffixes, retry the original
+                task = asyncio.ensure_future(process_site(dict(site), today, params, attempt))
+                tasks[task] = flow
+                busy_hosts.add(triki._hostname(site))
+            timeouts = [pending[0][0] - monotonic()] if pending else []
+            if params.adaptive:
+                timeouts.append(scaler["next"] - monotonic())
+            timeout = max(min(timeouts), 0) if timeouts else None
+            if not tasks:
+                await asyncio.sleep(timeout)
+                continue
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=FIRST_COMPLETED)
+            for task in done:
+                position, attempt, site = tasks.pop(task)
+                result = task.result()
+                triki.record_timings(result, params)
+                triki.record_flow_duration(scaler, result[3])
+                delay = triki._retry(result, params)
+                if delay is None:
+                    results.append(result)
+                    triki.record_journal(site, today, result)
+                else:
+                    heapq.heappush(pending, (monotonic() + delay, position, attempt + 1, site))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await close_context_browsers()
+        await close_io_executor()
+    return results
+
+
+def run_contexts(sites, today, params):
+    """
+    Process every site flow in browser contexts of a single chrome, up to
+    params.contexts flows at the same time
+    """
+    # Fail before processing any flow if there is no chrome to drive or a
+    # flow has steps that can not run in a context
+    _chrome_binary()
+    for site in sites:
+        try:
+            compile_steps(site.get("steps") or triki.compile_flow(site, params))
+        except ValueError as e:
+            raise ValueError("Invalid flow %s %s: %s" % (site["url"], site["flow_type"], e))
+    if params.warm_browsers or params.workers > 1:
+        LOG.warning("Browser contexts ignore --workers and --warm-browsers")
+    if params.shared_cache:
+        LOG.warning("Browser contexts keep their HTTP cache in memory, --shared-cache is ignored")
+    return asyncio.run(_run_contexts(sites, today, params))
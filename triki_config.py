@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Loads the sites configuration of Triki: the sites.yaml file and the
+   yaml files of the sites.d folder, parsed lazily and cached between runs.
+   Kept apart from triki.py so that the analysis scripts can read the
+   configuration without the crawler dependencies."""
+import glob
+import hashlib
+import logging
+import os
+import pickle
+
+import yaml
+
+CWD = os.path.dirname(__file__)
+CONFIG_PATH = os.path.join(CWD, "config")
+# Optional folder with the sites split in many yaml files
+SITES_PATH = os.path.join(CONFIG_PATH, "sites.d")
+# Parsed configuration files keyed by path, reused while they do not change
+CONFIG_CACHE_PATH = os.path.join(CONFIG_PATH, ".sites_cache.pickle")
+CONFIG_CACHE_VERSION = 1
+# libyaml based loader if pyyaml was built with it
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+LOG = logging.getLogger()
+
+
+def _load_config_cache():
+    """
+    Parsed configuration files of previous runs, empty if there is no
+    usable cache
+    """
+    if os.getenv("TRIKI_NO_CONFIG_CACHE"):
+        return {}
+    try:
+        with open(CONFIG_CACHE_PATH, "rb") as f:
+            cache = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        LOG.debug("Ignoring configuration cache: %s", e)
+        return {}
+    if cache.get("version") != (CONFIG_CACHE_VERSION, YAML_LOADER.__name__):
+        return {}
+    return cache["files"]
+
+
+def _save_config_cache(files):
+    """
+    Store the parsed configuration files, written aside and renamed so
+    that concurrent runs never read a partial cache
+    """
+    if os.getenv("TRIKI_NO_CONFIG_CACHE"):
+        return
+    tmp_path = "%s.%s" % (CONFIG_CACHE_PATH, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"version": (CONFIG_CACHE_VERSION, YAML_LOADER.__name__), "files": files},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, CONFIG_CACHE_PATH)
+    except OSError as e:
+        LOG.debug("Could not write configuration cache: %s", e)
+
+
+def _load_config_file(path, cache):
+    """
+    Parse a yaml configuration file unless the cache holds the same file,
+    unchanged if its modification time and size match or, after touching
+    it, its hash does. Returns the parsed content and whether the cache
+    was updated.
+    """
+    stat = os.stat(path)
+    entry = cache.get(path)
+    if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        return pickle.loads(entry["data"]), False
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if entry and entry["hash"] == digest:
+        entry["mtime"], entry["size"] = stat.st_mtime_ns, stat.st_size
+        return pickle.loads(entry["data"]), True
+    data = yaml.load(content.decode("utf8"), Loader=YAML_LOADER)
+    cache[path] = {
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": digest,
+        # Each load gets its own copy, callers modify the sites
+        "data": pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+    }
+    return data, True
+
+
+def _sites_in(data, path):
+    """
+    Sites of a split configuration file: a mapping with a list of sites,
+    a list of sites or a single site
+    """
+    if isinstance(data, dict) and "sites" in data:
+        return data["sites"] or []
+    if isinstance(data, dict):
+        return [data]
+    if isinstance(data, list):
+        return data
+    raise ValueError("%s does not contain any site" % path)
+
+
+def iter_sites():
+    """
+    Yield the sites of the configuration file followed by those of every
+    yaml file in the sites.d folder, files are parsed as they are reached
+    """
+    cache = _load_config_cache()
+    changed = False
+    try:
+        path = "%s/sites.yaml" % CONFIG_PATH
+        if os.path.exists(path) or not os.path.isdir(SITES_PATH):
+            config, changed = _load_config_file(path, cache)
+            for site in (config or {}).get("sites") or []:
+                yield site
+        split_files = sorted(
+            glob.glob(os.path.join(SITES_PATH, "*.yaml"))
+            + glob.glob(os.path.join(SITES_PATH, "*.yml"))
+        )
+        for path in split_files:
+            data, updated = _load_config_file(path, cache)
+            changed = changed or updated
+            for site in _sites_in(data, path):
+                yield site
+    finally:
+        if changed:
+            # Forget files that no longer exist
+            for path in list(cache):
+                if not os.path.exists(path):
+                    del cache[path]
+            _save_config_cache(cache)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cookie fields and statistics of Triki, shared by the crawler and the
+   analysis scripts without the crawler dependencies."""
+import logging
+from collections import Counter
+
+import arrow
+
+HEADER_COOKIES = [
+    "host_key",
+    "name",
+    "value",
+    "path",
+    "expires_utc",
+    "is_secure",
+    "is_httponly",
+    "has_expires",
+    "is_persistent",
+    "priority",
+    "samesite",
+    "source_scheme",
+]
+HEADER_STATS = [
+    "url",
+    "total",
+    "session",
+    "max_exp_days",
+    "avg_exp_days",
+    "secure_flag",
+    "httponly_flag",
+    "samesite_none_flag",
+    "samesite_lax_flag",
+    "samesite_strict_flag",
+]
+# Seconds between chrome cookies epoch (1601-01-01) and unix epoch
+CHROME_EPOCH_OFFSET = 11644473600
+MICROSECONDS_PER_DAY = 86400 * 1000000
+
+LOG = logging.getLogger()
+
+
+def chrome_time(moment=None):
+    """
+    Microseconds since chrome cookies epoch (1601-01-01) for the given
+    arrow moment, now by default
+    """
+    if moment is None:
+        moment = arrow.utcnow()
+    delta = moment - arrow.get(1601, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _get_duration_in_days(expires_utc, now=None):
+    """
+    via: https://stackoverflow.com/questions/43518199/cookies-expiration-time-format
+    and https://stackoverflow.com/questions/51343828/how-to-parse-chrome-bookmarks-date-added-value-to-a-date
+    now is given in chrome time so that it is computed only once per run
+    """
+    if now is None:
+        now = chrome_time()
+    # Floor division gives the same days as a timedelta
+    return (int(expires_utc) - now) // MICROSECONDS_PER_DAY
+
+
+def _new_cookie_stats(url, now=None):
+    """
+    Accumulator to compute cookie statistics incrementally
+    """
+    return {
+        "url": url,
+        "now": chrome_time() if now is None else now,
+        "total": 0,
+        "session": 0,
+        "persistent": 0,
+        "sum_exp_days": 0,
+        "max_exp_days": None,
+        "secure": 0,
+        "http_only": 0,
+        "same_site": Counter(),
+    }
+
+
+def _add_cookie_stats(accumulator, cookie):
+    """
+    Account a cookie in the statistics accumulator
+    """
+    accumulator["total"] += 1
+    if int(cookie["is_persistent"]):
+        # Compute expiration maximum and average in days
+        days = _get_duration_in_days(cookie["expires_utc"], accumulator["now"])
+        accumulator["persistent"] += 1
+        accumulator["sum_exp_days"] += days
+        if accumulator["max_exp_days"] is None or days > accumulator["max_exp_days"]:
+            accumulator["max_exp_days"] = days
+    else:
+        accumulator["session"] += 1
+    # Get secure and httponly stats
+    if int(cookie["is_secure"]):
+        accumulator["secure"] += 1
+    if int(cookie["is_httponly"]):
+        accumulator["http_only"] += 1
+    #  SameSite
+    accumulator["same_site"][str(cookie["samesite"])] += 1
+
+
+def _cookie_stats_result(accumulator):
+    """
+    Cookie statistics for the accumulated cookies
+    """
+    persistent = accumulator["persistent"]
+    same_site = accumulator["same_site"]
+    stats = {
+        "url": accumulator["url"],
+        "total": accumulator["total"],
+        "session": accumulator["session"],
+        "max_exp_days": accumulator["max_exp_days"] if persistent else 0,
+        "avg_exp_days": int(round(accumulator["sum_exp_days"] / persistent))
+        if persistent
+        else 0,
+        "secure_flag": accumulator["secure"],
+        "httponly_flag": accumulator["http_only"],
+        "samesite_none_flag": same_site["-1"],
+        "samesite_lax_flag": same_site["0"],
+        "samesite_strict_flag": same_site["1"],
+    }
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Cookie stats for %s: %s (same_site %s)", stats["url"], stats, same_site)
+    return stats
+
+
+def cookie_stats(cookies, url, now=None):
+    """
+    Compute cookie statistics in a single pass over the cookies
+    """
+    accumulator = _new_cookie_stats(url, now)
+    for cookie in cookies:
+        _add_cookie_stats(accumulator, cookie)
+    return _cookie_stats_result(accumulator)